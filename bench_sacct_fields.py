@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import sys
+import time
+import datetime
+import argparse
+import numpy as np
+import pandas as pd
+
+from slurm_accounting_free import sacct_fields
+
+# Benchmark of the vectorized sacct field decoders on synthetic job steps,
+# against the per-row decoding make_job_stats() used to do with
+# Series.apply().
+#
+#     python bench_sacct_fields.py                  # 1,000,000 steps
+#     python bench_sacct_fields.py -n 100000 --per-row
+
+
+def make_steps(n, seed=1):
+    """Return DataFrame of n sacct job step records, as strings"""
+    rng = np.random.default_rng(seed)
+
+    jobids = 1000000 + np.arange(n) // 3
+    step = np.array(['', '.batch', '.extern'])[np.arange(n) % 3]
+    tasks = rng.integers(0, 100, n)
+    jobid = pd.Series(jobids.astype(str)) + np.where(rng.random(n) < 0.2, '_' + pd.Series(tasks.astype(str)), '') + step
+
+    elapsed_s = rng.integers(0, 5 * 86400, n)
+    d, rem = np.divmod(elapsed_s, 86400)
+    h, rem = np.divmod(rem, 3600)
+    m, s = np.divmod(rem, 60)
+    hms = (pd.Series(h).astype(str).str.zfill(2) + ':' + pd.Series(m).astype(str).str.zfill(2) + ':'
+           + pd.Series(s).astype(str).str.zfill(2))
+    elapsed = pd.Series(np.where(d > 0, pd.Series(d).astype(str) + '-' + hms, hms))
+
+    # TotalCPU style: MM:SS.mmm under an hour
+    ms = rng.integers(0, 1000, n)
+    short = pd.Series(m).astype(str).str.zfill(2) + ':' + pd.Series(s).astype(str).str.zfill(2) + '.' + pd.Series(ms).astype(str).str.zfill(3)
+    totalcpu = pd.Series(np.where((d == 0) & (h == 0), short, elapsed))
+
+    kib = rng.integers(4, 64 * 1048576, n)
+    maxvmsize = pd.Series(kib.astype(str)) + 'K'
+    maxvmsize[rng.random(n) < 0.1] = ''
+
+    submit = pd.Timestamp('2023-12-01') + pd.to_timedelta(rng.integers(0, 30 * 86400, n), unit='s')
+    start = submit + pd.to_timedelta(rng.integers(0, 3600, n), unit='s')
+    fmt = sacct_fields.SACCT_TIME_FORMAT
+
+    states = np.array(['COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED by 12345', 'OUT_OF_MEMORY'])
+    state = states[rng.choice(len(states), n, p=[0.7, 0.1, 0.05, 0.1, 0.05])]
+
+    return pd.DataFrame({'JobID': jobid,
+                         'State': state,
+                         'Submit': pd.Series(submit.strftime(fmt)),
+                         'Start': pd.Series(start.strftime(fmt)),
+                         'Elapsed': elapsed,
+                         'TotalCPU': totalcpu,
+                         'MaxVMSize': maxvmsize})
+
+
+# per-row decoding, as it was before sacct_fields
+
+def kib_to_gib(kibstr):
+    kib = 0.
+    if isinstance(kibstr, str):
+        if not kibstr.strip() == "" and not kibstr.strip().casefold() == "nan":
+            kib = float(kibstr[:-1])
+
+    return kib / 1048576.
+
+
+def sacct_dt_to_timedelta(sacct_dt):
+    d = 0
+    split_dt = sacct_dt.split('-')
+    if len(split_dt) > 1:
+        d = int(split_dt[0])
+
+    h, m, s = (int(x) for x in split_dt[-1].split(':'))
+
+    return datetime.timedelta(days=d, hours=h, minutes=m, seconds=s)
+
+
+def timed(label, n, func, *args, **kwargs):
+    tic = time.perf_counter()
+    result = func(*args, **kwargs)
+    toc = time.perf_counter()
+    print(f'    {label:<40} {toc - tic:8.3f} s  {n / (toc - tic):>12,.0f} rows/s')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sacct field decoding')
+    parser.add_argument('-n', '--steps', type=int, default=1000000,
+                        help='Number of job steps (Default: 1,000,000)')
+    parser.add_argument('--per-row', action='store_true',
+                        help='Also time the old per-row decoding (slow)')
+    args = parser.parse_args()
+
+    n = args.steps
+
+    tic = time.perf_counter()
+    steps = make_steps(n)
+    print(f'Made {n:,} job steps in {time.perf_counter() - tic:.1f} s')
+
+    print('Vectorized (sacct_fields):')
+    timed('decode_jobid(JobID)', n, sacct_fields.decode_jobid, steps['JobID'])
+    timed('decode_state(State)', n, sacct_fields.decode_state, steps['State'])
+    timed('decode_timestamp(Submit)', n, sacct_fields.decode_timestamp, steps['Submit'])
+    timed('decode_timestamp(Start)', n, sacct_fields.decode_timestamp, steps['Start'])
+    elapsed = timed('decode_duration(Elapsed)', n, sacct_fields.decode_duration, steps['Elapsed'])
+    timed('decode_duration(TotalCPU)', n, sacct_fields.decode_duration, steps['TotalCPU'])
+    vm = timed('decode_size(MaxVMSize, unit=G)', n, sacct_fields.decode_size, steps['MaxVMSize'], unit='G')
+
+    if args.per_row:
+        print('Per-row (Series.apply):')
+        elapsed_old = timed('sacct_dt_to_timedelta(Elapsed)', n, steps['Elapsed'].apply, sacct_dt_to_timedelta)
+        vm_old = timed('kib_to_gib(MaxVMSize)', n, steps['MaxVMSize'].apply, kib_to_gib)
+
+        # check the vectorized decoders agree
+        if not (elapsed == pd.to_timedelta(elapsed_old)).all():
+            print('ERROR: bench_sacct_fields: Elapsed decoded differently')
+            sys.exit(1)
+
+        if not np.allclose(vm.fillna(0.), vm_old):
+            print('ERROR: bench_sacct_fields: MaxVMSize decoded differently')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
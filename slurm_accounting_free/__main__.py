@@ -3,25 +3,44 @@ import sys
 import os
 from os.path import basename
 from pathlib import Path
-from io import StringIO
 import typing
 import argparse
 import re
 import csv
+import json
+import hashlib
 import grp
 import calendar
 import fiscalyear
 import decimal
-import ldap3
 import delorean
 import datetime
-from delorean import Delorean, epoch, parse
+from delorean import Delorean, epoch
 from decimal import Decimal
 from operator import itemgetter
-import subprocess
 import weasyprint
+try:
+    from weasyprint.text.fonts import FontConfiguration
+except ImportError:
+    # WeasyPrint < 53
+    from weasyprint.fonts import FontConfiguration
 
 from . import __version__
+from . import slurm_cli
+from . import directory
+from . import ledger
+from . import mail_queue
+from . import outbox
+from . import job_stats
+from . import job_efficiency
+from . import job_charges
+from . import job_cache
+from . import reconcile
+from . import pipeline
+from . import profiling
+from . import progress
+from . import metrics
+from . import statement_templates
 
 from distutils.util import strtobool
 
@@ -36,12 +55,13 @@ from dataclasses import dataclass
 import numpy as np
 import pandas as pd
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 debug_p = False
 
 smtpserver = "smtp.example.com"
-rate = Decimal(0.0123)  # $ per SU
+rate = job_charges.RATE  # $ per SU
 penny = Decimal("0.01")
 decimal.getcontext().rounding = decimal.ROUND_HALF_UP
 all_groups = {}
@@ -218,58 +238,74 @@ class ProjectUsage:
             user_usage_list={self.user_usage_list})"""
 
 
-def write_html_header(reportfile, project, cluster):
-    reportfile.write('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional/EN"\n')
-    reportfile.write('  "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">\n')
-    reportfile.write('<html xmlns="http://www.w3.org/1999/xhtml">\n')
-    reportfile.write('  <head>\n')
-    reportfile.write('    <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />\n')
-    reportfile.write('    <style type="text/css">\n')
-    reportfile.write('       @page { size: Letter landscape; }\n')
-    reportfile.write('       body { font-size: 9pt; }\n')
-    # reportfile.write('       h4   { font-size: 10pt; }\n')
-    reportfile.write('       pre { font-size: 9pt; }\n')
-    reportfile.write('       .rates { font-size: 85%; font-style: italic; }\n')
-    reportfile.write('       .code { font-family: Monaco, "Courier New", monospace; }\n')
-    reportfile.write('       .image .caption { font-size: 75%; font-style: italic; text-align: center; }\n')
-    reportfile.write('       #projectmembers {\n')
-    reportfile.write('          border-collapse: collapse;\n')
-    reportfile.write('          width: 100%;\n')
-    reportfile.write('       }')
-    reportfile.write('       #projectmembers td, #projectmembers th {\n')
-    reportfile.write('          border: 1px solid #ddd;\n')
-    reportfile.write('          padding: 2px;\n')
-    reportfile.write('       }\n')
-    reportfile.write('       #projectmembers tr:nth-child(even){background-color: #f2f2f2;}\n')
-    reportfile.write('       #projectmembers th {\n')
-    reportfile.write('          padding-top: 6px;\n')
-    reportfile.write('          padding-bottom: 6px;\n')
-    reportfile.write('          text-align: left;\n')
-    reportfile.write('          background-color: #4CAF50;\n')
-    reportfile.write('          color: white;\n')
-    reportfile.write('       }\n')
-    reportfile.write('       #jobstats {\n')
-    reportfile.write('          border-collapse: collapse;\n')
-    reportfile.write('          width: 100%;\n')
-    reportfile.write('       }')
-    reportfile.write('       #jobstats td, #jobstats th {\n')
-    reportfile.write('          border: 1px solid #ddd;\n')
-    reportfile.write('          padding: 8px;\n')
-    reportfile.write('       }\n')
-    reportfile.write('       #jobstats tr:nth-child(even){background-color: #f2f2f2;}\n')
-    reportfile.write('       #jobstats th {\n')
-    reportfile.write('          padding-top: 12px;\n')
-    reportfile.write('          padding-bottom: 12px;\n')
-    reportfile.write('          text-align: left;\n')
-    reportfile.write('          background-color: #4CAF50;\n')
-    reportfile.write('          color: white;\n')
-    reportfile.write('       }\n')
-    reportfile.write('    </style>\n')
-    reportfile.write(f'    <title>{cluster} Usage Report for {project}</title>\n')
-    reportfile.write('  </head>\n')
+# Statement styles. Parsed once per process by get_statement_style() and
+# passed to every render, rather than inlined into each statement where
+# WeasyPrint would re-parse it for every PDF.
+STATEMENT_CSS = """
+       @page { size: Letter landscape; }
+       body { font-size: 9pt; }
+       pre { font-size: 9pt; }
+       .rates { font-size: 85%; font-style: italic; }
+       .code { font-family: Monaco, "Courier New", monospace; }
+       .image .caption { font-size: 75%; font-style: italic; text-align: center; }
+       #projectmembers {
+          border-collapse: collapse;
+          width: 100%;
+       }
+       #projectmembers td, #projectmembers th {
+          border: 1px solid #ddd;
+          padding: 2px;
+       }
+       #projectmembers tr:nth-child(even){background-color: #f2f2f2;}
+       #projectmembers th {
+          padding-top: 6px;
+          padding-bottom: 6px;
+          text-align: left;
+          background-color: #4CAF50;
+          color: white;
+       }
+       #jobstats {
+          border-collapse: collapse;
+          width: 100%;
+       }
+       #jobstats td, #jobstats th {
+          border: 1px solid #ddd;
+          padding: 8px;
+       }
+       #jobstats tr:nth-child(even){background-color: #f2f2f2;}
+       #jobstats th {
+          padding-top: 12px;
+          padding-bottom: 12px;
+          text-align: left;
+          background-color: #4CAF50;
+          color: white;
+       }
+"""
+
+statement_stylesheet = None
+statement_font_config = None
+
+
+def get_statement_style():
+    """Return (stylesheet, font_config) for statements, creating them on first use in this process"""
+    global debug_p
+    global statement_stylesheet
+    global statement_font_config
+
+    if statement_stylesheet is None:
+        tic = time.perf_counter()
+        statement_font_config = FontConfiguration()
+        statement_stylesheet = weasyprint.CSS(string=STATEMENT_CSS, font_config=statement_font_config)
+        toc = time.perf_counter()
+
+        if debug_p:
+            print(f'DEBUG: get_statement_style(): pid {os.getpid()} parsed statement stylesheet in {toc - tic:.3f} s')
+
+    return statement_stylesheet, statement_font_config
 
 
 def make_statement_header(project:str, usage, cur_period, cluster="MYCLUSTER", debug_p=False):
+    """Return dict of statement header fields"""
     global rate
     global penny
 
@@ -291,25 +327,18 @@ def make_statement_header(project:str, usage, cur_period, cluster="MYCLUSTER", d
         print(f'DEBUG: make_statement_header(): cur_period = {cur_period}')
         print(f'DEBUG: make_statement_header(): cluster = {cluster}')
 
-    report_str = f'<h4>{cluster} usage charges for period {cur_period.strftime("%B %Y")}</h4>\n'
-    report_str += '<p>&nbsp;</p>\n'
-    report_str += f'<table><tr><td>PI:</td>      <td>{pi_lastname}, {pi_firstname} <tt>&lt;{pi_email}&gt;</tt></td></tr>\n'
-    report_str += f'<tr><td>Project:</td>        <td>{project}</td></tr>\n'
-    report_str += f'<tr><td>Coursework?</td>     <td>{is_class}</td></tr>\n'
-    report_str += f'<tr><td>MRI?</td>            <td>{is_mri}</td></tr>\n'
-    report_str += f'<tr><td>Startup/Grant?</td>  <td>{is_startup}</td></tr>\n'
-    report_str += f'<tr><td>Share (MRI/Startup/Grant) expiration:</td> <td>{share_expiration}</td></tr>\n'
-    report_str += f'<tr><td>Fund-Org code:</td> <td><tt>{fundorg_code}</tt></td></tr></table>\n\n'
-
-    report_str += '<p><br/></p>'
-    report_str += f'<span class="rates"><table><tr><td colspan="2">Rate: ${float(rate):.4f} per SU</td></tr>'
-    report_str += '<tr><td>&nbsp;</td><td>Standard compute: 1 SU per core-hour</td></tr>'
-    report_str += '<tr><td>&nbsp;</td><td>Big memory compute: 68 SU per RAM TiB-hour</td></tr>'
-    report_str += '<tr><td>&nbsp;</td><td>GPU compute: 43 SU per GPU device-hour</td></tr>'
-    report_str += '<tr><td>&nbsp;</td><td>Storage: 1081 SU per TiB-month</td></tr>'
-    report_str += '</table></span>\n\n'
-
-    return report_str
+    return {'cluster': cluster,
+            'project': project,
+            'period': cur_period.strftime("%B %Y"),
+            'rate': rate,
+            'pi_lastname': pi_lastname,
+            'pi_firstname': pi_firstname,
+            'pi_email': pi_email,
+            'is_class': is_class,
+            'is_mri': is_mri,
+            'is_startup': is_startup,
+            'share_expiration': share_expiration,
+            'fundorg_code': fundorg_code}
 
 
 def read_courses(courses_filename):
@@ -443,22 +472,13 @@ def read_sreport(sreport_file):
     global rate
     global penny
 
-    sreport = []
     with open(sreport_file, 'r') as f:
-        with StringIO() as csvio:
-            count = 0
-            for line in f:
-                if count < 4:
-                    # skip first 4 lines
-                    count += 1
-                    continue
-                else:
-                    csvio.write(line)
+        # skip first 4 lines; the 5th is the field names line
+        for _ in range(4):
+            f.readline()
 
-            csvio.seek(0)
-            reader = csv.DictReader(csvio, delimiter='|')
-            for line in reader:
-                sreport.append(line)
+        reader = csv.DictReader(f, delimiter='|')
+        sreport = list(reader)
 
     return sreport
 
@@ -526,7 +546,8 @@ def get_storage_usage(year, month, reports_dir, pis, courses):
                 if debug_p:
                     print(f'DEBUG: get_storage_usage - day of month = {day}')
 
-                du_list = read_dufile(entry)
+                with profiling.stage('du', entry.name):
+                    du_list = read_dufile(entry)
 
                 if day in full_weeks:
                     factor = Decimal(7.0)
@@ -596,7 +617,8 @@ def get_compute_usage(year, month, reports_dir, pis, courses):
                 if debug_p:
                     print('DEBUG: reading sreport file {entry.path}')
 
-                sreport = read_sreport(entry.path)
+                with profiling.stage('sreport', entry.name):
+                    sreport = read_sreport(entry.path)
 
                 if debug_p:
                     print('DEBUG: sreport ...')
@@ -633,101 +655,64 @@ def make_charge_summary(project_usage):
 
 
 def make_charge_details(compute_su, compute_charge, disk_su, disk_charge, total_su, total_charge):
-    global debug_p
-    global rate
-    global penny
-
-    report_str  = f'<pre><b>             {"Usage (SU)":>12}            {"Charge":>9}</b>\n'
-    report_str += f'Compute      {float(compute_su):>12.6e}           ${compute_charge.quantize(penny):>9,.2f}\n'
-    report_str += f'Storage      {float(disk_su):>12.6e}           ${disk_charge.quantize(penny):>9,.2f}\n'
-    report_str +=  '             ------------           ----------\n'
-    report_str += f'<b>TOTAL        {float(total_su):>12.6e}           ${total_charge.quantize(penny):>9,.2f}</b>\n'
-    report_str +=  '             ============           ==========</pre>\n'
-    report_str += '\n'
-    report_str += '\n'
-
-    return report_str
+    """Return dict of statement charges"""
+    return {'compute_su': compute_su,
+            'compute_charge': compute_charge,
+            'disk_su': disk_su,
+            'disk_charge': disk_charge,
+            'total_su': total_su,
+            'total_charge': total_charge}
 
 
 def make_per_user_usage_maybe(usage):
+    """Return list of dicts of per-user usage; class users are not charged"""
     global debug_p
     global rate
-    global penny
-
-    report_str = '<b>Compute usage by user</b>'
-    if usage.user_usage_list:
-        if debug_p:
-            print(f'user_usage_list = {usage.user_usage_list}')
 
-        report_str += f'<pre><b>{"Name":<20} {"User ID":>12} {"Usage (SU)":>14} {"Charge":>14}</b>\n'
-        for user_usage in usage.user_usage_list:
-            if usage.is_class:
-                report_str += f'{user_usage.fullname:<20} {user_usage.login:>12} {float(user_usage.su):>14.6e}     ${0.:>9,.2f}\n'
-            else:
-                report_str += f'{user_usage.fullname:<20} {user_usage.login:>12} {float(user_usage.su):>14.6e}     ${user_usage.charge.quantize(penny):>9,.2f}\n'
-    else:
-        report_str += '<pre>n/a\n'
+    if debug_p:
+        print(f'user_usage_list = {usage.user_usage_list}')
 
-    report_str += '</pre>\n<br>'
+    users = []
+    for user_usage in usage.user_usage_list:
+        users.append({'fullname': user_usage.fullname,
+                      'login': user_usage.login,
+                      'su': user_usage.su,
+                      'charge': Decimal(0.) if usage.is_class else user_usage.charge})
 
-    return report_str
+    return users
 
 
 def make_user_list(project:str):
+    """Return list of dicts of project members who can log in, sorted by surname"""
     global debug_p
     global all_groups
 
     if debug_p:
         print(f'DEBUG: make_user_list(): project = {project}')
 
-    group = all_groups[re.sub(r'([a-zA-Z0-9][a-zA-Z0-9]*)prj', r'\1grp', project, flags=re.IGNORECASE)]
+    group_name = re.sub(r'([a-zA-Z0-9][a-zA-Z0-9]*)prj', r'\1grp', project, flags=re.IGNORECASE)
+    if directory.snapshot is not None:
+        group_members = directory.snapshot.group_members(group_name)
+        user_source = directory.snapshot
+    else:
+        group_members = all_groups[group_name.casefold()].gr_mem
+        user_source = directory.directory
 
     unix_epoch = epoch(0)
 
     users_info = []
 
-    # read username and password from file
-    username = None
-    password = None
-    upat = re.compile(r'username')
-    ppat = re.compile(r'password')
-    with open('/secrets/ldap_readonly_account.txt', 'r') as pwfile:
-        lines = pwfile.readlines()
-
-        for l in lines:
-            if upat.match(l):
-                username = l.split(':')[1].strip()
-
-            if ppat.match(l):
-                password = l.split(':')[1].strip()
-
-
-    server = ldap3.Server('myclusterhead.cm.cluster', port=636, use_ssl=True, get_info=ldap3.ALL)
     try:
-        conn = ldap3.Connection(server, username, password, auto_bind=True)
-        base_dn = "dc=cm,dc=cluster"
-        search_scope = ldap3.SUBTREE
-
-        for u in group.gr_mem:
-            search_filter = f"(uid={u})"
-            conn.search(search_base=base_dn,
-                        search_scope=search_scope,
-                        search_filter=search_filter,
-                        attributes=['*']
-                        )
-            if debug_p:
-                print(f'DEBUG: make_user_list(): found {len(conn.entries)} entries.')
-
-            entry_dict = conn.entries[0].entry_attributes_as_dict
-            dt = datetime.timedelta(days=entry_dict['shadowExpire'][0])
+        for u in user_source.get_users(group_members).values():
+            dt = datetime.timedelta(days=u['shadowExpire'])
             exp_datestamp = unix_epoch + dt
             exp_date = exp_datestamp.datetime.strftime('%b %d, %Y')
-            users_info.append({'SN': entry_dict['sn'][0],
-                               'CN': entry_dict['cn'][0],
+            users_info.append({'SN': u['sn'],
+                               'CN': u['cn'],
                                'Expiration date': exp_date,
-                               'Inactive?': bool(int(entry_dict['shadowInactive'][0])),
-                               'Login shell': entry_dict['loginShell'][0],
-                               'Email': entry_dict['mail'][0]})
+                               'Inactive?': bool(u['shadowInactive']),
+                               'Login shell': u['loginShell'],
+                               'Email': u['mail']})
     except Exception as e:
         print(f'EXCEPTION: ldap error {e}')
         sys.exit(1)
@@ -735,18 +720,9 @@ def make_user_list(project:str):
     users_info_sorted = sorted(users_info, key=itemgetter('SN'))
 
     if debug_p:
-        print(f'DEBUG: make_user_list(): group = {group}')
-
-    report_str = '<h3>Project Members</h3>\n'
-    report_str += '<table id="projectmembers">\n'
-    report_str += '<tr>\n'
-    report_str += '<th>&nbsp;</th>\n'
-    report_str += '<th>Name</th>\n'
-    report_str += '<th>Email</th>\n'
-    # report_str += '<th>Status</th>\n'
-    # report_str += '<th>Acct. expiration date</th>\n'
-    report_str += '</tr>'
-    counter = 1
+        print(f'DEBUG: make_user_list(): group = {group_name}, members = {group_members}')
+
+    members = []
     for u in users_info_sorted:
         ### XXX Both "Inactive?"" and "Expiration date" do not prevent logins
         if not u['Login shell'] == '/bin/false':
@@ -754,189 +730,20 @@ def make_user_list(project:str):
             fullname = u["CN"].strip()
             if surname in fullname:
                 givenname = fullname.replace(surname, '').strip()
-            report_str += '<tr>\n'
-            report_str += f'<td>{counter}</td>\n'
-            report_str += f'<td>{surname}, {givenname}</td>\n'
-            report_str += f'<td>{u["Email"]}</td>\n'
-
-            report_str += '</tr>'
-            counter += 1
-    report_str += '</table>\n'
-
-    return report_str
-
-
-def kib_to_gib(kibstr:str):
-    global debug_p
-
-    if debug_p:
-        print(f'DEBUG: kib_to_gib(): type(kibstr) = {type(kibstr)} ; kibstr = {kibstr}')
-
-    kib = 0.
-    if isinstance(kibstr, str):
-        if not kibstr.strip() == "" and not kibstr.strip().casefold() == "nan":
-            kib = float(kibstr[:-1])
-
-    return kib / 1048576.
+            members.append({'surname': surname, 'givenname': givenname, 'email': u['Email']})
 
-
-def sacct_dt_to_timedelta(sacct_dt:str):
-    # sacct time duration strings look like: 1-23:15:48 (day-hh:mm:ss)
-    d = 0
-    split_dt = sacct_dt.split('-')
-    if len(split_dt) > 1:
-        d = int(split_dt[0])
-
-    h, m, s = (int(x) for x in split_dt[-1].split(':'))
-
-    return datetime.timedelta(days=d, hours=h, minutes=m, seconds=s)
-
-
-def wait_time(submit:str, start:str):
-    global debug_p
-
-    submit_time = parse(submit)
-    start_time = parse(start)
-
-    return start_time - submit_time
+    return members
 
 
 def make_job_stats(year: int, month: int, project: str):
-    global debug_p
-
-    # compute reporting period
-    dt_oneday = datetime.timedelta(days=1)
-    last_day = Delorean(datetime.datetime(year, month,
-                                 calendar.monthrange(year, month)[1]),
-                        timezone='UTC')
-
-    period_start = f'{year}-{month:02d}-01-00:00:00'
-    period_end = f'{year}-{month:02d}-{last_day.datetime.day}-23:59:59'
-
-    if debug_p:
-        print(f'DEBUG: make_job_stats(): dt_oneday = {dt_oneday}')
-        print(f'DEBUG: make_job_stats(): last_day = {last_day}')
-
-    csv.register_dialect('sacct', delimiter='|')
-
-    #sacct_cmdline = f'sacct -P -o JobID%20,State,Submit,Start,Elapsed,TotalCPU,MaxVMSize,MaxDiskRead,MaxDiskWrite -T -S{period_start} -E{period_end} -A {project} -a'.split()
-    sacct_cmdline = f'sacct -P -o JobID%20,State,Submit,Start,Elapsed,MaxVMSize -T -S{period_start} -E{period_end} -A {project} -a'.split()
-
-    if debug_p:
-        print(f'DEBUG: make_job_stats(): sacct_cmdline = {sacct_cmdline}', flush=True)
-
-    report_str = '<h3>Job Statistics</h3>'
-
-    try:
-        sacct_results = subprocess.run(sacct_cmdline, capture_output=True)
-
-        if sacct_results.returncode != 0:
-            print(f'WARNING: sacct return code = {sacct_results.returncode}')
-            print(f'    {sacct_results.stderr}')
-
-        if debug_p:
-            print(f'DEBUG: len(sacct_results.stdout) = {len(sacct_results.stdout)}')
-
-        sacct_output = sacct_results.stdout
-
-        jobs_df = pd.read_csv(StringIO(sacct_output.decode('utf-8')), dialect='sacct')
+    """Return dict of job counts and min/max/mean of wait time, wallclock and
+    virtual memory, for completed and for incomplete jobs
 
-        # fix units
-        jobs_df['Submit'] = pd.to_datetime(jobs_df['Submit'], format='%Y-%m-%dT%H:%M:%S')
-        jobs_df['Start'] = pd.to_datetime(jobs_df['Start'], format='%Y-%m-%dT%H:%M:%S')
-        jobs_df['Elapsed'] = jobs_df['Elapsed'].apply(sacct_dt_to_timedelta)
-        jobs_df['MaxVMSize'] = jobs_df['MaxVMSize'].apply(kib_to_gib)
-
-        # add wait time
-        jobs_df['Wait time'] = jobs_df['Start'] - jobs_df['Submit']
-
-        # rename columns
-        jobs_df = jobs_df.rename(columns={'Elapsed': 'Wallclock', 'MaxVMSize': 'Virtual memory (GiB)'})
-
-
-        n_jobs = len(jobs_df.index)
-        report_str += f'<p>Number of jobs = {n_jobs:,}<br/>'
-
-        if n_jobs > 0:
-            # XXX must only take rows where the JobID ends in ".batch"
-            batch_jobs_df = jobs_df[jobs_df['JobID'].str.endswith('.batch', na=False)]
-
-            # Want stats based only on completed jobs
-            completed_jobs_df = batch_jobs_df[(batch_jobs_df['State'] == 'COMPLETED')]
-
-            # Also want stats on incomplete jobs
-            incomplete_jobs_df = batch_jobs_df[(batch_jobs_df['State'] != 'COMPLETED')]
-
-            n_completed = 0
-            if not completed_jobs_df.empty:
-                n_completed = len(completed_jobs_df.index)
-
-            report_str += f'% of jobs completed successfully = {100. * float(n_completed) / float(n_jobs):.2f}%\n'
-            report_str += '</p>'
-
-            report_str += '<h4>Completed Jobs</h4>'
-            report_str += f'<p>Number of completed jobs = {n_completed:,}</p>'
-
-            if n_completed > 0:
-
-                report_str += '<p><table id="jobstats">\n'
-                report_str += '<tr>\n'
-                report_str += ' <th>&nbsp;</th>\n'
-                report_str += ' <th>Min.</th>\n'
-                report_str += ' <th>Max.</th>\n'
-                report_str += ' <th>Mean</th>\n'
-                report_str += '</tr>\n'
-
-                wanted_fields = ['Wait time', 'Wallclock', 'Virtual memory (GiB)']
-
-                for field in wanted_fields:
-                    report_str += f'<tr><td>{field}</td>'
-                    if field == 'Virtual memory (GiB)':
-                        report_str += f'<td>{completed_jobs_df[field].min():.2f}</td>'
-                        report_str += f'<td>{completed_jobs_df[field].max():.2f}</td>'
-                        report_str += f'<td>{completed_jobs_df[field].mean():.2f}</td></tr>'
-                    else:
-                        report_str += f'<td>{completed_jobs_df[field].min()}</td>'
-                        report_str += f'<td>{completed_jobs_df[field].max()}</td>'
-                        report_str += f'<td>{completed_jobs_df[field].mean()}</td></tr>'
-                report_str += '</table></p>\n'
-
-            n_incomplete = len(incomplete_jobs_df.index)
-            report_str += '<h4>Incomplete Jobs</h4>'
-            report_str += '<p><i>Jobs which may not have completed due to a variety of reasons: https://slurm.schedmd.com/sacct.html#SECTION_JOB-STATE-CODES</i></p>'
-            report_str += '<p><i>Jobs which may not have completed due to <a href="https://slurm.schedmd.com/sacct.html#SECTION_JOB-STATE-CODES">a variety of reasons</a>.</i></p>'
-
-            if n_incomplete > 0:
-
-                report_str += f'<p>Number of incomplete jobs = {n_incomplete:,}</p>'
-
-                report_str += '<p><table id="jobstats">\n'
-                report_str += '<tr>\n'
-                report_str += ' <th>&nbsp;</th>\n'
-                report_str += ' <th>Min.</th>\n'
-                report_str += ' <th>Max.</th>\n'
-                report_str += ' <th>Mean</th>\n'
-                report_str += '</tr>\n'
-
-                wanted_fields = ['Wait time', 'Wallclock', 'Virtual memory (GiB)']
-
-                for field in wanted_fields:
-                    report_str += f'<tr><td>{field}</td>'
-                    if field == 'Virtual memory (GiB)':
-                        report_str += f'<td>{incomplete_jobs_df[field].min():.2f}</td>'
-                        report_str += f'<td>{incomplete_jobs_df[field].max():.2f}</td>'
-                        report_str += f'<td>{incomplete_jobs_df[field].mean():.2f}</td></tr>'
-                    else:
-                        report_str += f'<td>{incomplete_jobs_df[field].min()}</td>'
-                        report_str += f'<td>{incomplete_jobs_df[field].max()}</td>'
-                        report_str += f'<td>{incomplete_jobs_df[field].mean()}</td></tr>'
-                report_str += '</table></p>\n'
-
-    except Exception as e:
-        print(f'EXCEPTION: make_job_stats(): {type(e)} - {e}')
-        sys.exit(2)
+    For many projects, build one job_stats.JobStatsTable for all of them instead.
+    """
+    global debug_p
 
-    return report_str
+    return job_stats.JobStatsTable.from_sacct(year, month, accounts=[project]).job_stats(project)
 
 
 def fy_months(year, month):
@@ -963,81 +770,56 @@ def fy_months(year, month):
     return retlist
 
 
-def make_ytd_report_maybe(year:int, month:int, usage:ProjectUsage, project:str, cluster:str):
+def monthly_charges_reports(year:int, month:int):
+    """Return dict YYYYMM: path of charges CSV for the months of the current FY before (year, month)"""
     global debug_p
-    global rate
-    global penny
-
-    decimal.getcontext().rounding = decimal.ROUND_HALF_UP
 
-    # monthly reports for months not including month for which statement is being generated
-    monthly_reports = []
+    monthly_reports = {}
     for yyyymm in fy_months(year, month):
         if debug_p:
-            print(f'DEBUG: make_ytd_report_maybe(): yyyymm = {yyyymm}')
-            monthly_reports.append(Path(f'./RCM/{yyyymm}/mycluster_charges_{yyyymm}.csv'))
+            monthly_reports[yyyymm] = Path(f'./RCM/{yyyymm}/mycluster_charges_{yyyymm}.csv')
         else:
-            monthly_reports.append(Path(f'/ifs/sysadmin/RCM/{yyyymm}/mycluster_charges_{yyyymm}.csv'))
+            monthly_reports[yyyymm] = Path(f'/ifs/sysadmin/RCM/{yyyymm}/mycluster_charges_{yyyymm}.csv')
 
-    if debug_p:
-        for m in monthly_reports:
-            print(f'DEBUG: make_ytd_report_maybe(): {m}')
+    return monthly_reports
 
-    # NB there would not be a monthly report for last month (i.e the month for which
-    # this statement is being generated)
-    compute_ytd = usage.compute_charge
-    storage_ytd = usage.disk_charge
 
-    for mr in monthly_reports:
-        if debug_p:
-            print(f'DEBUG: make_ytd_report_maybe(): mr.exists == {mr.exists()}')
+def make_ytd_report_maybe(year:int, month:int, usage:ProjectUsage, project:str, cluster:str, fy_ledger=None):
+    """Return dict of compute and storage charges for the fiscal year to date
 
-        if mr.exists():
-            charges_df = pd.read_csv(mr, engine='python', encoding='ISO-8859-1')
-            mask = (charges_df['Project'] == project)
-            all_charges_df = charges_df[mask][['Project', 'CPU charge ($)', 'Storage charge ($)']]
+    fy_ledger is a ledger.FiscalYearLedger of the earlier months of the FY;
+    if not given, one is loaded from the monthly charges CSVs.
+    """
+    global debug_p
+    global rate
+    global penny
 
-            if debug_p:
-                print(f'DEBUG: make_ytd_report_maybe(): all_charges_df.shape == {all_charges_df.shape}')
+    decimal.getcontext().rounding = decimal.ROUND_HALF_UP
 
-            if all_charges_df.shape[0]:
-                if debug_p:
-                    print(f'DEBUG: make_ytd_report_maybe(): CPU charge ($) = {all_charges_df["CPU charge ($)"].iloc[0]:9.2f}')
-                    print(f'DEBUG: make_ytd_report_maybe(): Storage charge ($) = {all_charges_df["Storage charge ($)"].iloc[0]:9.2f}')
+    if fy_ledger is None:
+        fy_ledger = ledger.FiscalYearLedger.load(monthly_charges_reports(year, month))
+
+    # NB there would not be a monthly report for last month (i.e the month for which
+    # this statement is being generated)
+    compute_prev, storage_prev = fy_ledger.ytd(project)
+    compute_ytd = usage.compute_charge + compute_prev
+    storage_ytd = usage.disk_charge + storage_prev
 
-                compute_ytd += Decimal(all_charges_df['CPU charge ($)'].iloc[0]).quantize(penny)
-                storage_ytd += Decimal(all_charges_df['Storage charge ($)'].iloc[0]).quantize(penny)
+    if debug_p:
+        print(f'DEBUG: make_ytd_report_maybe(): {project} earlier months {fy_ledger.months}: compute ${compute_prev:9.2f}, storage ${storage_prev:9.2f}')
 
     compute_ytd = Decimal(compute_ytd).quantize(penny)
     storage_ytd = Decimal(storage_ytd).quantize(penny)
 
-    report_str = '<b>Cumulative charges for current fiscal year</b>\n'
-    report_str += f'<pre>Compute usage:                      ${compute_ytd:9.2f}\n'
-    report_str += f'Storage usage:                      ${storage_ytd:9.2f}\n'
-    report_str +=  '                                    ----------\n'
-    report_str += f'<b>TOTAL CUMULATIVE CHARGE:            ${compute_ytd + storage_ytd:9.2f}</b>\n'
-    report_str +=  '                                    ==========</pre>\n'
+    return {'compute': compute_ytd, 'storage': storage_ytd}
 
-    return report_str
 
-
-def make_project_statement_and_send_maybe(year:int, month:int, statements_dir:Path, project:str, usage:ProjectUsage, cluster:str, send_email_p:bool):
+def make_statement_data(year:int, month:int, project:str, usage:ProjectUsage, cluster:str, fy_ledger=None, job_table=None, account_efficiency=None):
+    """Return dict of everything on a project's statement; see statement_templates"""
     global debug_p
-    global rate
-    global penny
-
-    if debug_p:
-        print(f'DEBUG: make_project_statement_and_send_maybe(): year={year}, month={month}, statements_dir={statements_dir}, project={project}, usage={usage}, cluster={cluster}')
 
     cur_period = datetime.datetime(year=year, month=month, day=1)
 
-    compute_su = usage.compute_su
-    compute_charge = None
-    disk_su = usage.disk_su
-    disk_charge = None
-    total_su = usage.su
-    total_charge = None
-
     if usage.is_class:
         fake_charge = Decimal(0.0)
         compute_charge = fake_charge
@@ -1048,46 +830,157 @@ def make_project_statement_and_send_maybe(year:int, month:int, statements_dir:Pa
         disk_charge = usage.disk_charge
         total_charge = usage.charge
 
+    statement = make_statement_header(project, usage, cur_period, cluster, debug_p)
+
+    statement['charges'] = make_charge_details(usage.compute_su, compute_charge,
+                                               usage.disk_su, disk_charge,
+                                               usage.su, total_charge)
+
+    statement['users'] = make_per_user_usage_maybe(usage)
+
+    if job_table is not None:
+        statement['job_stats'] = job_table.job_stats(project)
+
+    if account_efficiency is not None:
+        statement['efficiency'] = account_efficiency.get(project.casefold())
+
+    with profiling.stage('ytd', project):
+        statement['ytd'] = make_ytd_report_maybe(year=year, month=month, usage=usage, project=project, cluster='MYCLUSTER', fy_ledger=fy_ledger)
+
+    with profiling.stage('ldap_members', project):
+        statement['members'] = make_user_list(project)
+
+    return statement
+
+
+def write_project_statement_html(year:int, month:int, statements_dir:Path, project:str, statement_html:str):
+    """Write a copy of the HTML statement for project; return its path
+
+    The statement's stylesheet is only handed to WeasyPrint, so the copy
+    gets it inline, to look the same in a browser.
+    """
     statement_fn = f'{project}_{year}{month:02d}.html'
-    statement_pdf_fn = f'{project}_{year}{month:02d}.pdf'
 
+    style = f'<style type="text/css">{STATEMENT_CSS}</style>\n  </head>'
     with open(statements_dir / statement_fn, 'w') as statement_file:
-        write_html_header(statement_file, project, cluster)
+        statement_file.write(statement_html.replace('</head>', style, 1))
 
-        statement_header = make_statement_header(project, usage,
-                                                 cur_period,
-                                                 cluster,
-                                                 debug_p)
+    return statements_dir / statement_fn
 
-        statement_file.write('<body>\n')
-        statement_file.write(statement_header)
 
-        charge_details = make_charge_details(compute_su, compute_charge,
-                                             disk_su, disk_charge,
-                                             total_su, total_charge)
-        statement_file.write(charge_details)
+def statement_fingerprint(statement):
+    """Return a hash of everything that goes into a statement's PDF: the
+    statement data, the template version and the stylesheet"""
+    h = hashlib.sha256()
+    h.update(f'{statement_templates.TEMPLATE_VERSION}\n'.encode('utf-8'))
+    h.update(STATEMENT_CSS.encode('utf-8'))
+    h.update(json.dumps(statement, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
 
-        per_user_usage = make_per_user_usage_maybe(usage)
-        statement_file.write(per_user_usage)
 
-        #job_stats = make_job_stats(year=year, month=month, project=project)
-        #statement_file.write(job_stats)
+# Each PDF statement has a JSON record next to it:
+#   {'fingerprint': ..., 'template_version': ..., 'rendered': ..., 'emailed': ...}
+# A rerun for the same month skips statements whose fingerprint is
+# unchanged, and does not email them again if they were already emailed.
+def statement_record_path(pdf_path:Path):
+    return pdf_path.with_suffix('.json')
 
-        ytd_charges = make_ytd_report_maybe(year=year, month=month, usage=usage, project=project, cluster='MYCLUSTER')
-        statement_file.write(ytd_charges)
 
-        user_list = make_user_list(project)
-        statement_file.write(user_list)
+def read_statement_record(pdf_path:Path):
+    try:
+        with open(statement_record_path(pdf_path), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_statement_record(pdf_path:Path, record):
+    # write-then-rename so an interrupted run cannot leave a truncated record
+    record_path = statement_record_path(pdf_path)
+    tmp_path = record_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, record_path)
 
-        statement_file.write('</body>\n')
-        statement_file.write('</html>')
 
-    # generate PDF statement
-    weasyprint.HTML(statements_dir / statement_fn).write_pdf(statements_dir / statement_pdf_fn)
+def render_statement_pdf(statement_html:str, pdf_path:Path, base_url:str):
+    """Render one PDF statement from its HTML; return (wall, CPU) time in seconds
+
+    Relative URLs in the HTML are resolved against base_url. Runs in a
+    worker process of render_statements().
+    """
+    stylesheet, font_config = get_statement_style()
+
+    tic = time.perf_counter()
+    cpu_tic = time.process_time()
+    weasyprint.HTML(string=statement_html, base_url=base_url).write_pdf(pdf_path, stylesheets=[stylesheet], font_config=font_config)
+    return time.perf_counter() - tic, time.process_time() - cpu_tic
+
+
+def render_statements(statements, base_url, max_workers=None, on_rendered=None):
+    """Render PDF statements across a process pool
+
+    statements is a dict project: (statement_html, pdf_path)
+    on_rendered(project, pdf_path) is called for each statement as soon as
+    it has been rendered.
+    Returns dict project: pdf_path of the successfully rendered statements.
+    """
+    global debug_p
+
+    rendered = {}
+    render_times = {}
+    tic = time.perf_counter()
+    tracker = progress.Progress('pdf', total=len(statements), unit='statements')
+
+    # WeasyPrint layout is CPU-bound, so use processes rather than threads;
+    # each worker parses the statement stylesheet once, up front
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=get_statement_style) as executor:
+        futures = {executor.submit(render_statement_pdf, statement_html, pdf_path, base_url): project
+                   for project, (statement_html, pdf_path) in statements.items()}
+
+        for future in as_completed(futures):
+            project = futures[future]
+            pdf_path = statements[project][1]
+            try:
+                render_times[project], render_cpu = future.result()
+                rendered[project] = pdf_path
+                profiling.record('pdf', project, render_times[project], child_cpu=render_cpu)
+                print(f'Rendered {basename(pdf_path)} in {render_times[project]:.2f} s')
+            except Exception as e:
+                print(f'ERROR: render_statements(): {project} - {type(e)} - {e}')
+                continue
+            finally:
+                tracker.update()
+
+            if on_rendered is not None:
+                on_rendered(project, pdf_path)
+
+    toc = time.perf_counter()
+    tracker.done()
+
+    if render_times:
+        total_render = sum(render_times.values())
+        print(f'Rendered {len(rendered)} of {len(statements)} statements in {toc - tic:.1f} s wall time; {total_render:.1f} s total, {total_render / len(render_times):.2f} s mean per statement')
+
+    return rendered
+
+
+def mark_statement_emailed(statement_pdf:Path):
+    record = read_statement_record(statement_pdf)
+    if record:
+        record['emailed'] = datetime.datetime.now().isoformat(timespec='seconds')
+        write_statement_record(statement_pdf, record)
+
+
+def send_statement_maybe(statement_pdf:Path, project:str, usage:ProjectUsage, cluster:str, year:int, month:int, send_email_p:bool, outbox):
+    """Email statement to PI through outbox, which the mail queue sends at its own rate"""
+    global debug_p
 
     if send_email_p:
-        send_email_statement(statements_dir / statement_pdf_fn, project, usage.pi, cluster, year, month)
-        time.sleep(15)
+        send_email_statement(statement_pdf, project, usage.pi, cluster, year, month,
+                             outbox=outbox,
+                             fingerprint=read_statement_record(statement_pdf).get('fingerprint'),
+                             on_sent=lambda result: mark_statement_emailed(statement_pdf))
     else:
         if debug_p:
             print(f'DEBUG: Not sending email statement to sysadmin in place of {usage.pi.email}')
@@ -1095,7 +988,8 @@ def make_project_statement_and_send_maybe(year:int, month:int, statements_dir:Pa
             print(f'Not sending email statement to {usage.pi.email}')
 
 
-def make_statements(year, month, reports_dir, project_usage, project_du, pis, cluster, send_email_p=False):
+def make_statements(year, month, reports_dir, project_usage, project_du, pis, cluster, send_email_p=False, render_workers=None, keep_html=False, force_render=False, outbox=None, with_job_stats=True, account_efficiency=None):
+    """Make, render and maybe email all statements; return (summary DataFrame, statements directory)"""
     global debug_p
     global rate
     global penny
@@ -1188,12 +1082,43 @@ def make_statements(year, month, reports_dir, project_usage, project_du, pis, cl
                 project_usage[project].gets_credit = fundorg_codes[project.strip().lower()]['Monthly credit?']
                 project_usage[project].share_expiration = fundorg_codes[project.strip().lower()]['Share expiration']
 
+    # HTML for all statements first, then all PDFs in parallel, then email.
+    # The HTML is handed to the renderer in memory; the .html copy on disk
+    # is only written if asked for. Statements whose inputs are unchanged
+    # since they were last rendered are not rendered again.
+    statements = {}
+    fingerprints = {}
+    unchanged = {}
+
+    # earlier months of the FY, loaded once for all statements
+    fy_ledger = ledger.FiscalYearLedger.load(monthly_charges_reports(year, month),
+                                             reports_dir.parent / ledger.LEDGER_FILENAME)
+
+    # job statistics of all projects from one pass over the month's jobs
+    job_table = None
+    if with_job_stats:
+        with profiling.stage('job_stats'):
+            job_table = job_stats.JobStatsTable.from_sacct(year, month)
+
+    tracker = progress.Progress('statements', total=len(project_usage), unit='projects')
     for project, usage in project_usage.items():
         if debug_p:
             print(f'DEBUG: make_statements() - making statement for {project}')
             print(f'DEBUG:    {project}, {usage}')
 
-        make_project_statement_and_send_maybe(year, month, statements_dir, project, usage, cluster, send_email_p)
+        statement = make_statement_data(year, month, project, usage, cluster, fy_ledger, job_table, account_efficiency)
+        statement_pdf = statements_dir / f'{project}_{year}{month:02d}.pdf'
+        fingerprints[project] = statement_fingerprint(statement)
+
+        if (not force_render and statement_pdf.exists()
+                and read_statement_record(statement_pdf).get('fingerprint') == fingerprints[project]):
+            unchanged[project] = statement_pdf
+        else:
+            with profiling.stage('html', project):
+                statement_html = statement_templates.render_html(statement)
+            if keep_html:
+                write_project_statement_html(year, month, statements_dir, project, statement_html)
+            statements[project] = (statement_html, statement_pdf)
 
         row = {
                 'Year': year,
@@ -1222,6 +1147,38 @@ def make_statements(year, month, reports_dir, project_usage, project_du, pis, cl
             row['Total charge ($)'] = float(usage.charge.quantize(penny))
 
         summary_csv_rows.append(row)
+        tracker.update()
+
+    tracker.done()
+
+    # base URL is only used to resolve relative links, e.g. images, in the HTML
+    base_url = statements_dir.resolve().as_uri() + '/'
+    # only email statements which were rendered, or unchanged ones which
+    # were not emailed before
+    if unchanged:
+        print(f'Skipped {len(unchanged)} unchanged statements (use --force-render to render them anyway)')
+
+    for project, statement_pdf in unchanged.items():
+        if read_statement_record(statement_pdf).get('emailed'):
+            if debug_p:
+                print(f'DEBUG: make_statements() - {project} unchanged and already emailed')
+        else:
+            send_statement_maybe(statement_pdf, project, project_usage[project], cluster, year, month, send_email_p, outbox)
+
+    # with an outbox, each statement is being emailed while the rest are rendered
+    def statement_rendered(project, statement_pdf):
+        write_statement_record(statement_pdf, {'fingerprint': fingerprints[project],
+                                               'template_version': statement_templates.TEMPLATE_VERSION,
+                                               'rendered': datetime.datetime.now().isoformat(timespec='seconds'),
+                                               'emailed': None})
+        send_statement_maybe(statement_pdf, project, project_usage[project], cluster, year, month, send_email_p, outbox)
+
+    rendered = {}
+    if statements:
+        rendered = render_statements(statements, base_url, max_workers=render_workers, on_rendered=statement_rendered)
+
+    for project in statements.keys() - rendered.keys():
+        print(f'WARNING: statement for {project} was not rendered; not emailed')
 
     summary_df = pd.DataFrame(summary_csv_rows, columns=summary_csv_fields)
 
@@ -1414,7 +1371,13 @@ def read_email_addresses(email_file_path=None):
     return email_addrs
 
 
-def send_email_statement(statement, project: str, pi, cluster: str, year: int, month: int):
+def send_email_statement(statement, project: str, pi, cluster: str, year: int, month: int, outbox=None, fingerprint=None, on_sent=None):
+    """Email PDF statement to PI
+
+    With an outbox, the message is spooled under statement_{project}_{YYYYMM}
+    and sent unless the same statement (by fingerprint) was already sent;
+    on_sent is called once it has been sent.
+    """
     global debug_p
     global smtpserver
 
@@ -1477,17 +1440,23 @@ def send_email_statement(statement, project: str, pi, cluster: str, year: int, m
     part['Content-Disposition'] = f'attachment; filename="{basename(statement)}"'
     msg.attach(part)
 
-    print(f'Sending email to {COMMASPACE.join([send_to] + send_cc)}')
     if debug_p:
         print('DEBUG: send_email_statement(): NOT SENDING EMAIL')
         print(f'DEBUG: send_email_statement(): send_from={send_from}, send_to={send_to}, send_cc={send_cc}')
         print(f'DEBUG: send_email_statement(): msg.as_string() = {msg.as_string()}')
 
-    with smtplib.SMTP(smtpserver) as mailserver:
-        mailserver.send_message(msg)
+    if outbox is not None:
+        status = outbox.post(f'statement_{project}_{year}{month:02d}', msg,
+                             description=f'{send_to} ({project})',
+                             fingerprint=fingerprint, on_sent=on_sent)
+        print(f'Email to {COMMASPACE.join([send_to] + send_cc)}: {status}')
+    else:
+        print(f'Sending email to {COMMASPACE.join([send_to] + send_cc)}')
+        with smtplib.SMTP(smtpserver) as mailserver:
+            mailserver.send_message(msg)
 
 
-def send_summaries_to_research_office(summary_csv_filename, banner_csv_filename, cluster, year, month, send_email_p=False):
+def send_summaries_to_research_office(summary_csv_filename, banner_csv_filename, cluster, year, month, send_email_p=False, outbox=None):
     global debug_p
 
     verbose_p = True
@@ -1545,17 +1514,36 @@ def send_summaries_to_research_office(summary_csv_filename, banner_csv_filename,
         part['Content-Disposition'] = f'attachment; filename="{basename(banner_csv_filename)}"'
         msg.attach(part)
 
-        with smtplib.SMTP(smtpserver) as mailserver:
-            mailserver.send_message(msg)
+        if outbox is not None:
+            # resend only if the summaries changed
+            h = hashlib.sha256()
+            for filename in (summary_csv_filename, banner_csv_filename):
+                with open(filename, 'rb') as f:
+                    h.update(f.read())
+
+            status = outbox.post(f'summary_{year}{month:02d}', msg,
+                                 description=f'{send_to} (charges summary)',
+                                 fingerprint=h.hexdigest())
+            if verbose_p:
+                print(f'Summary CSV email: {status}')
+        else:
+            with smtplib.SMTP(smtpserver) as mailserver:
+                mailserver.send_message(msg)
     else:
         if verbose_p:
             print('Charges summary CSV not emailed')
 
 
+# stages of the month's run, in order; which run depends on the options
+STAGES = ['compute', 'storage', 'job_charges', 'efficiency', 'reconcile', 'ldap',
+          'statements', 'banner', 'summary', 'ledger', 'finance_email']
+
+
 def main():
     global debug_p
     global rate
     global penny
+    global smtpserver
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true',
@@ -1570,14 +1558,74 @@ def main():
                         help='Verbose output')
     parser.add_argument('-V', '--version', action='store_true',
                         help='Show version')
+    parser.add_argument('-j', '--render-workers', type=int, default=None,
+                        help='Number of processes rendering PDF statements (Default: number of CPUs)')
+    parser.add_argument('--keep-html', action='store_true',
+                        help='Also write the HTML of each statement to the statements directory')
+    parser.add_argument('--force-render', action='store_true',
+                        help='Render all statements, even those whose inputs have not changed since the last run')
+    parser.add_argument('--no-job-stats', action='store_true',
+                        help='Leave job statistics out of the statements (skips the sacct query for the month\'s jobs)')
+    parser.add_argument('--job-efficiency', action='store_true',
+                        help='Add CPU and memory efficiency to the statements, from the month\'s job_efficiency_report (run if not there yet)')
+    parser.add_argument('--job-charges', action='store_true',
+                        help='Also charge each job from its sacct record, and write the per-job ledger and totals to the reports directory')
+    parser.add_argument('--job-cache', default=None,
+                        help='Read job records from this job cache directory instead of running sacct (see job_cache)')
+    parser.add_argument('--skip-reconcile', action='store_true',
+                        help='With --email, do not check the sreport totals against job-level sums first')
+    parser.add_argument('--reconcile-threshold', type=float, default=reconcile.DEFAULT_THRESHOLD,
+                        help=f'Largest difference in SU between sreport and job-level totals allowed before emailing (Default: {reconcile.DEFAULT_THRESHOLD:g})')
+    parser.add_argument('--ldap-snapshot', action='store_true',
+                        help='Read all POSIX accounts and groups from LDAP once, up front, and make member lists from that')
+    parser.add_argument('--save-ldap-snapshot', action='store_true',
+                        help='Also save the LDAP snapshot to the reports directory (implies --ldap-snapshot)')
+    parser.add_argument('--load-ldap-snapshot', default=None,
+                        help='Make member lists from a saved LDAP snapshot file; LDAP is not contacted')
+    parser.add_argument('--smtp-server', default=mail_queue.DEFAULT_SMTP_SERVER,
+                        help=f'SMTP server (Default: {mail_queue.DEFAULT_SMTP_SERVER})')
+    parser.add_argument('--smtp-port', type=int, default=mail_queue.DEFAULT_SMTP_PORT,
+                        help=f'SMTP server port (Default: {mail_queue.DEFAULT_SMTP_PORT})')
+    parser.add_argument('--email-rate', type=float, default=mail_queue.DEFAULT_RATE,
+                        help=f'Maximum emails sent per minute (Default: {mail_queue.DEFAULT_RATE:g})')
+    parser.add_argument('--trace', action='store_true',
+                        help='Print latency and output size of each Slurm command')
+    parser.add_argument('--resume', action='store_true',
+                        help='Load the stages done by an earlier run from their checkpoints, and run the rest')
+    profiling.add_arguments(parser)
+    progress.add_arguments(parser)
+    metrics.add_arguments(parser)
+    stage_group = parser.add_mutually_exclusive_group()
+    stage_group.add_argument('--only', default=None, choices=STAGES, metavar='STAGE',
+                             help=f'Run only STAGE, from the checkpoints of the stages it requires ({", ".join(STAGES)})')
+    stage_group.add_argument('--from', dest='start', default=None, choices=STAGES, metavar='STAGE',
+                             help='Run STAGE and the stages after it, from the checkpoints of the stages before it')
     args = parser.parse_args()
 
     if args.version:
         print(f'slurm_accounting_free {__version__}')
         sys.exit(0)
 
+    profiling.start('slurm_accounting_free', args)
+    progress.start(args)
+    metrics.start('slurm_accounting_free', args)
+
     if args.debug:
         debug_p = True
+        slurm_cli.debug_p = True
+        directory.debug_p = True
+        ledger.debug_p = True
+        mail_queue.debug_p = True
+        outbox.debug_p = True
+        job_stats.debug_p = True
+        job_efficiency.debug_p = True
+        job_charges.debug_p = True
+        job_cache.debug_p = True
+        reconcile.debug_p = True
+        pipeline.debug_p = True
+        profiling.debug_p = True
+        progress.debug_p = True
+        metrics.debug_p = True
         print(f'DEBUG: args = {args}')
 
     period_str = None
@@ -1613,38 +1661,170 @@ def main():
             print(f'    {p}')
         print('')
 
-    pi_usage, project_usage, user_usage = get_compute_usage(year, month, reports_dir, pis, courses)
-    project_du = get_storage_usage(year, month, reports_dir, pis, courses)
-
-    if debug_p:
-        print('DEBUG: pi_usage -')
-        for k, v in pi_usage.items():
-            print(f'DEBUG: "{k}", {v}')
-        print('')
-        print('DEBUG: project_usage -')
-        for k, v in project_usage.items():
-            print(f'DEBUG: "{k}", {v}')
-        print('')
-        print('DEBUG: user_usage -')
-        for k, v in user_usage.items():
-            print(f'DEBUG: "{k}", {v}')
-        print('')
-        print('DEBUG: project_du -')
-        for k, v in project_du.items():
-            print(f'DEBUG: "{k}", {v}')
+    if args.job_cache:
+        job_cache.cache = job_cache.JobCache(args.job_cache)
 
+    smtpserver = args.smtp_server
     cluster = 'MYCLUSTER'
-    summary_df, statements_dir = make_statements(year, month, reports_dir,
-                                                 project_usage, project_du,
-                                                 pis, cluster, args.email)
-
-    banner_csv_filename = make_summary_for_banner(year, month, reports_dir,
-                                                  summary_df)
-
-    summary_csv_filename = write_summary(year, month, reports_dir, summary_df)
 
-    send_summaries_to_research_office(summary_csv_filename, banner_csv_filename,
-                                      cluster, year, month, args.email)
+    # the month's run as stages; see pipeline.py
+    def compute_stage(results):
+        pi_usage, project_usage, user_usage = get_compute_usage(year, month, reports_dir, pis, courses)
+        if debug_p:
+            print('DEBUG: pi_usage -')
+            for k, v in pi_usage.items():
+                print(f'DEBUG: "{k}", {v}')
+            print('')
+            print('DEBUG: project_usage -')
+            for k, v in project_usage.items():
+                print(f'DEBUG: "{k}", {v}')
+            print('')
+            print('DEBUG: user_usage -')
+            for k, v in user_usage.items():
+                print(f'DEBUG: "{k}", {v}')
+            print('')
+        return pi_usage, project_usage, user_usage
+
+    def storage_stage(results):
+        project_du = get_storage_usage(year, month, reports_dir, pis, courses)
+        if debug_p:
+            print('DEBUG: project_du -')
+            for k, v in project_du.items():
+                print(f'DEBUG: "{k}", {v}')
+        return project_du
+
+    def job_charges_stage(results):
+        charges = job_charges.JobCharges.from_sacct(year, month, rate=rate,
+                                                    ledger_file=job_charges.ledger_filename(reports_dir, year, month))
+        totals_file = charges.write_totals(job_charges.totals_filename(reports_dir, year, month))
+        if args.verbose:
+            print(f'slurm_accounting_free: per-job charges of {charges.n_jobs:,} jobs: {totals_file}')
+        return totals_file
+
+    def efficiency_stage(results):
+        account_efficiency = job_efficiency.read_account_efficiency(reports_dir, year, month)
+        if account_efficiency is None:
+            efficiency = job_efficiency.JobEfficiency.from_sacct(year, month)
+            written = job_efficiency.write_report(efficiency, reports_dir, year, month)
+            if args.verbose:
+                for filename in written:
+                    print(f'slurm_accounting_free: job efficiency report: {filename}')
+            account_efficiency = job_efficiency.read_account_efficiency(reports_dir, year, month)
+        return account_efficiency
+
+    def reconcile_stage(results):
+        # pre-flight: do not email statements whose charges job records do not bear out;
+        # job charges are made afresh unless the job_charges stage has made them
+        comparison_df, reconcile_jobs_df = reconcile.reconcile(year, month, reports_dir, threshold=args.reconcile_threshold,
+                                                               reuse_job_charges=args.job_charges)
+        reconcile.print_unmatched(comparison_df)
+        if comparison_df['Flagged'].any():
+            reconcile.print_flagged(comparison_df, reconcile_jobs_df)
+            print(f'ERROR: sreport totals differ from job-level sums; see {reconcile.comparison_filename(reports_dir, year, month)}')
+            print('    Statements were not made or emailed. Rerun with --skip-reconcile to email them anyway.')
+            sys.exit(1)
+        elif args.verbose:
+            print(f'slurm_accounting_free: sreport totals agree with job-level sums of {comparison_df.loc[(comparison_df["User"] == "") & ~comparison_df["Unmatched"], "Jobs"].sum():,} jobs')
+        return reconcile.comparison_filename(reports_dir, year, month)
+
+    def ldap_stage(results):
+        if args.load_ldap_snapshot:
+            directory.snapshot = directory.DirectorySnapshot.load(args.load_ldap_snapshot)
+            print(f'slurm_accounting_free: using LDAP snapshot {args.load_ldap_snapshot} taken {directory.snapshot.taken}')
+        elif args.ldap_snapshot or args.save_ldap_snapshot:
+            directory.snapshot = directory.DirectorySnapshot.from_ldap(directory.directory)
+            print(f'slurm_accounting_free: LDAP snapshot has {len(directory.snapshot.users)} users, {len(directory.snapshot.groups)} groups')
+            if args.save_ldap_snapshot:
+                snapshot_file = directory.snapshot.save(reports_dir)
+                print(f'slurm_accounting_free: LDAP snapshot saved to {snapshot_file}')
+
+    def statements_stage(results):
+        pi_usage, project_usage, user_usage = results['compute']
+        return make_statements(year, month, reports_dir,
+                               project_usage, results['storage'],
+                               pis, cluster, args.email,
+                               render_workers=args.render_workers,
+                               keep_html=args.keep_html,
+                               force_render=args.force_render,
+                               with_job_stats=not args.no_job_stats,
+                               account_efficiency=results.get('efficiency'),
+                               outbox=statement_outbox)
+
+    def banner_stage(results):
+        summary_df, statements_dir = results['statements']
+        return make_summary_for_banner(year, month, reports_dir, summary_df)
+
+    def summary_stage(results):
+        summary_df, statements_dir = results['statements']
+        return write_summary(year, month, reports_dir, summary_df)
+
+    def ledger_stage(results):
+        summary_df, statements_dir = results['statements']
+        ledger_file = ledger.update_ledger_file(reports_dir.parent / ledger.LEDGER_FILENAME,
+                                                f'{year}{month:02d}', summary_df)
+        if args.verbose:
+            print(f'slurm_accounting_free: charges ledger updated: {ledger_file}')
+        return ledger_file
+
+    def finance_email_stage(results):
+        send_summaries_to_research_office(results['summary'], results['banner'],
+                                          cluster, year, month, args.email, outbox=statement_outbox)
+        return args.email
+
+    stages = [pipeline.Stage('compute', compute_stage),
+              pipeline.Stage('storage', storage_stage)]
+    statements_requires = ['compute', 'storage', 'ldap']
+    if args.job_charges:
+        stages.append(pipeline.Stage('job_charges', job_charges_stage))
+    if args.job_efficiency:
+        stages.append(pipeline.Stage('efficiency', efficiency_stage))
+        statements_requires.append('efficiency')
+    if args.email and not args.skip_reconcile:
+        stages.append(pipeline.Stage('reconcile', reconcile_stage,
+                                     requires=['job_charges'] if args.job_charges else []))
+        statements_requires.append('reconcile')
+    stages += [pipeline.Stage('ldap', ldap_stage, checkpoint=False),
+               pipeline.Stage('statements', statements_stage, requires=statements_requires),
+               pipeline.Stage('banner', banner_stage, requires=['statements']),
+               pipeline.Stage('summary', summary_stage, requires=['statements']),
+               pipeline.Stage('ledger', ledger_stage, requires=['statements']),
+               pipeline.Stage('finance_email', finance_email_stage, requires=['banner', 'summary'])]
+
+    # statements are spooled to the outbox and emailed while the rest are
+    # being rendered
+    mq = None
+    statement_outbox = None
+    if args.email:
+        mq = mail_queue.MailQueue(server=args.smtp_server, port=args.smtp_port, rate=args.email_rate)
+        mq.start()
+        statement_outbox = outbox.Outbox(reports_dir / 'outbox', queue=mq)
+
+    # checkpoints made with other values of these are not used
+    checkpoint_options = {name: getattr(args, name)
+                          for name in ('email', 'no_job_stats', 'job_efficiency', 'job_charges', 'force_render')}
+    month_pipeline = pipeline.Pipeline(stages, reports_dir / 'checkpoints', verbose=args.verbose,
+                                       options=checkpoint_options)
+    month_pipeline.run(resume=args.resume, only=args.only, start=args.start)
+
+    if mq is not None:
+        # anything left unsent by an earlier run
+        n_left = statement_outbox.drain()
+        if n_left:
+            print(f'slurm_accounting_free: sending {n_left} messages left in the outbox by an earlier run')
+
+        # the rest of the statements are sent before the run ends
+        with profiling.stage('email_wait'):
+            mq.close()
+        mq.print_summary()
+
+    directory.directory.close()
+    directory.directory.print_summary()
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(reports_dir)
+    metrics.finish()
 
 if __name__ == '__main__':
     main()
@@ -5,49 +5,48 @@ import argparse
 import calendar
 import delorean
 import datetime
-import subprocess
 from decimal import Decimal
 
+from . import slurm_cli
+from . import statement_templates
+from . import profiling
+from . import job_charges
+
 debug_p = False
 
 def print_report(account, year, month, sreport):
+    """sreport is an iterable of lines of "sreport -n -P" output"""
     global debug_p
 
-    # total usage for account
-    total_billing_tre = Decimal(sreport.strip().split('\n')[0].split('|')[5])
+    lines = (line for line in sreport if line.strip())
 
-    rate = Decimal('0.0123')
-    penny = Decimal('0.01')
+    rate = job_charges.RATE
     cluster = os.getenv('CMD_WLM_CLUSTER_NAME')
 
     period = datetime.datetime(year=year, month=month, day=1)
 
-    print(f'USAGE REPORT FOR {account} ON CLUSTER {cluster} - {period.strftime("%B %Y")}')
-    print(f'Rate = $ {rate} per SU')
-    print('')
-
-    total_su = total_billing_tre
-    print(f'Compute usage: {float(total_su):>8.6e} SU')
-    charge = total_su * rate
-    print(f'Charge: $ {charge.quantize(penny):,}')
-    print('')
-    print('')
+    # total usage for account
+    total_su = Decimal(next(lines).split('|')[5])
 
     # per user usage for account
-    print('    Per-user usage and charge')
-    print(f'    {"Name":<20} {"User ID":>12} {"Usage (SU)":>14} {"Charge":>14}')
-    per_user_billing_tres = sreport.strip().split('\n')[1:]
-    for item in per_user_billing_tres:
-        login = item.split('|')[2]
-        name = item.split('|')[3]
-        su = Decimal(item.split('|')[5])
-        charge = su * rate
-        print(f'    {name:<20} {login:>12} {su:>14.6e}     ${charge.quantize(penny):>9,}')
+    users = []
+    for item in lines:
+        fields = item.rstrip('\n').split('|')
+        su = Decimal(fields[5])
+        users.append({'fullname': fields[3], 'login': fields[2], 'su': su, 'charge': su * rate})
+
+    statement = {'cluster': cluster,
+                 'project': account,
+                 'period': period.strftime("%B %Y"),
+                 'rate': rate,
+                 'charges': {'compute_su': total_su, 'compute_charge': total_su * rate},
+                 'users': users}
+
+    print(statement_templates.render_text(statement), end='')
 
 
 def main():
     global debug_p
-    global rate
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true',
@@ -56,9 +55,14 @@ def main():
                         help='Period for reporting in format YYYY-MM. Default: current month.')
     parser.add_argument('-a', '--account', required=True,
                         help='Account/Project for which to generate report (something like "xxxxxPrj")')
+    parser.add_argument('--trace', action='store_true',
+                        help='Print latency and output size of the sreport call')
+    profiling.add_arguments(parser)
     args = parser.parse_args()
 
     debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    profiling.start('billing_report', args)
 
     # compute reporting period
     period_str = None
@@ -88,11 +92,28 @@ def main():
     command_template = f'sreport -n -P cluster AccountUtilizationByUser Account={{}} Tree Start={year}-{month:02}-01 End={date_period_end.year}-{date_period_end.month:02}-01 -T billing -t hours'
 
     command = command_template.format(args.account).split(' ')
-    sreport = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    # the report is small; it is read whole, so that nothing is printed
+    # unless sreport succeeded
+    try:
+        with profiling.stage('sreport', args.account):
+            sreport = slurm_cli.runner.run_sync(command)
+    except slurm_cli.SlurmCommandError as e:
+        print(f'ERROR: billing_report: {e}')
+        sys.exit(1)
 
-    if sreport:
-        print_report(args.account, year, month, sreport)
-    else:
+    sreport_lines = sreport.stdout.splitlines(keepends=True)
+    # an empty report has no lines, or only blank ones
+    first_line = sreport_lines[0] if sreport_lines else ''
+    if first_line.strip():
+        print_report(args.account, year, month, sreport_lines)
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    # no files are written; the profile goes to the current directory
+    profiling.finish('.')
+
+    if not first_line.strip():
         # empty report
         period = datetime.datetime(year=year, month=month, day=1)
         print(f'billing_report: no usage accounting data for {period.strftime("%B %Y")}')
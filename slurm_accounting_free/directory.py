@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import re
+import sys
+import json
+import math
+import datetime
+from pathlib import Path
+import ldap3
+from ldap3.utils.conv import escape_filter_chars
+
+# Read-only lookups of cluster users in LDAP.
+#
+# One authenticated connection is opened on first use and kept for the
+# whole run. Users are fetched with OR-filter searches of up to batch_size
+# uids each, asking only for the attributes the statements use. Results
+# are cached per uid, since users are members of several projects.
+#
+# Alternatively, DirectorySnapshot pulls every POSIX account and group
+# from LDAP once, with a paged search, and answers all lookups from memory.
+# A snapshot can be saved to a timestamped JSON file and loaded later, so
+# that statements can be made without LDAP at all.
+
+debug_p = False
+
+LDAP_SERVER = 'myclusterhead.cm.cluster'
+LDAP_PORT = 636
+BASE_DN = 'dc=cm,dc=cluster'
+SECRETS_FILE = '/secrets/ldap_readonly_account.txt'
+
+USER_ATTRIBUTES = ['uid', 'sn', 'cn', 'mail', 'loginShell', 'shadowExpire', 'shadowInactive']
+
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_PAGE_SIZE = 500
+
+
+def read_credentials(secrets_file):
+    """Return (username, password) from a file with "username: ..." and "password: ..." lines"""
+    username = None
+    password = None
+    upat = re.compile(r'username')
+    ppat = re.compile(r'password')
+    with open(secrets_file, 'r') as pwfile:
+        for l in pwfile:
+            if upat.match(l):
+                username = l.split(':')[1].strip()
+
+            if ppat.match(l):
+                password = l.split(':')[1].strip()
+
+    return username, password
+
+
+def entry_to_user(entry_dict):
+    """Return dict of the user attributes from an LDAP entry's attributes dict
+
+    The server schema is not read, so numeric attributes may arrive as strings.
+    With a schema, single-valued attributes arrive as plain values rather
+    than lists; either is accepted.
+    """
+    def first(attr, default=None):
+        values = entry_dict.get(attr)
+        if not isinstance(values, list):
+            return values if values not in (None, '') else default
+        return values[0] if values else default
+
+    return {'uid': first('uid'),
+            'sn': first('sn', ''),
+            'cn': first('cn', ''),
+            'mail': first('mail', ''),
+            'loginShell': first('loginShell', ''),
+            'shadowExpire': int(first('shadowExpire', 0)),
+            'shadowInactive': int(first('shadowInactive', 0))}
+
+
+class Directory:
+    """LDAP user lookups over one connection, batched and cached"""
+
+    def __init__(self, server=LDAP_SERVER, port=LDAP_PORT, base_dn=BASE_DN,
+                 secrets_file=SECRETS_FILE, batch_size=DEFAULT_BATCH_SIZE):
+        self.server = server
+        self.port = port
+        self.base_dn = base_dn
+        self.secrets_file = secrets_file
+        self.batch_size = batch_size
+        self.conn = None
+        self.users = {}       # uid: user dict, or None if not in LDAP
+        self.round_trips = 0
+
+    def connect(self):
+        if self.conn is None:
+            username, password = read_credentials(self.secrets_file)
+            # the schema is not read; it is large, and nothing here needs it
+            server = ldap3.Server(self.server, port=self.port, use_ssl=True, get_info=ldap3.NONE)
+            self.conn = ldap3.Connection(server, username, password, auto_bind=True)
+            self.round_trips += 1
+
+        return self.conn
+
+    def get_users(self, uids):
+        """Return dict uid: user dict for those of uids found in LDAP"""
+        uids = list(dict.fromkeys(uids))
+        missing = [u for u in uids if u not in self.users]
+
+        if missing:
+            conn = self.connect()
+            for i in range(0, len(missing), self.batch_size):
+                batch = missing[i:i + self.batch_size]
+                search_filter = '(|' + ''.join(f'(uid={escape_filter_chars(u)})' for u in batch) + ')'
+                conn.search(search_base=self.base_dn,
+                            search_scope=ldap3.SUBTREE,
+                            search_filter=search_filter,
+                            attributes=USER_ATTRIBUTES)
+                self.round_trips += 1
+
+                if debug_p:
+                    print(f'DEBUG: Directory.get_users(): {len(batch)} uids, found {len(conn.entries)} entries')
+
+                for entry in conn.entries:
+                    user = entry_to_user(entry.entry_attributes_as_dict)
+                    self.users[user['uid']] = user
+
+                for u in batch:
+                    if u not in self.users:
+                        print(f'WARNING: Directory.get_users(): {u} not found in LDAP')
+                        self.users[u] = None
+
+        return {u: self.users[u] for u in uids if self.users[u] is not None}
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.unbind()
+            self.conn = None
+
+    def print_summary(self, file=sys.stdout):
+        print(f'LDAP: {self.round_trips} round trips, {len(self.users)} users looked up', file=file)
+
+
+class DirectorySnapshot:
+    """All POSIX accounts and groups, indexed by uid and by group name"""
+
+    def __init__(self, users, groups, taken):
+        self.users = users        # uid: user dict
+        self.groups = groups      # casefolded group name: list of member uids
+        self.taken = taken        # ISO 8601 timestamp
+
+    @classmethod
+    def from_ldap(cls, directory, page_size=DEFAULT_PAGE_SIZE):
+        """Take a snapshot over directory's connection with paged searches"""
+        conn = directory.connect()
+        taken = datetime.datetime.now().isoformat(timespec='seconds')
+
+        users = {}
+        for entry in conn.extend.standard.paged_search(search_base=directory.base_dn,
+                                                       search_filter='(objectClass=posixAccount)',
+                                                       search_scope=ldap3.SUBTREE,
+                                                       attributes=USER_ATTRIBUTES,
+                                                       paged_size=page_size,
+                                                       generator=True):
+            if entry['type'] == 'searchResEntry':
+                user = entry_to_user(entry['attributes'])
+                users[user['uid']] = user
+
+        groups = {}
+        for entry in conn.extend.standard.paged_search(search_base=directory.base_dn,
+                                                       search_filter='(objectClass=posixGroup)',
+                                                       search_scope=ldap3.SUBTREE,
+                                                       attributes=['cn', 'memberUid'],
+                                                       paged_size=page_size,
+                                                       generator=True):
+            if entry['type'] == 'searchResEntry':
+                cn = entry['attributes']['cn']
+                cn = cn[0] if isinstance(cn, list) else cn
+                members = entry['attributes'].get('memberUid', [])
+                groups[cn.casefold()] = members if isinstance(members, list) else [members]
+
+        # one round trip per page of each search
+        directory.round_trips += max(1, math.ceil(len(users) / page_size)) + max(1, math.ceil(len(groups) / page_size))
+
+        if debug_p:
+            print(f'DEBUG: DirectorySnapshot.from_ldap(): {len(users)} users, {len(groups)} groups')
+
+        return cls(users, groups, taken)
+
+    @classmethod
+    def load(cls, snapshot_file):
+        with open(snapshot_file, 'r') as f:
+            snapshot = json.load(f)
+
+        return cls(snapshot['users'], snapshot['groups'], snapshot['taken'])
+
+    def save(self, snapshot_dir):
+        """Save snapshot to snapshot_dir/ldap_snapshot_{timestamp}.json; return its path"""
+        stamp = self.taken.replace('-', '').replace(':', '')
+        snapshot_file = Path(snapshot_dir) / f'ldap_snapshot_{stamp}.json'
+        with open(snapshot_file, 'w') as f:
+            json.dump({'taken': self.taken, 'users': self.users, 'groups': self.groups}, f, indent=1, sort_keys=True)
+
+        return snapshot_file
+
+    def group_members(self, group_name):
+        """Return list of member uids of group; raises KeyError if there is no such group"""
+        return self.groups[group_name.casefold()]
+
+    def get_users(self, uids):
+        """Return dict uid: user dict for those of uids in the snapshot"""
+        users = {}
+        for u in dict.fromkeys(uids):
+            if u in self.users:
+                users[u] = self.users[u]
+            else:
+                print(f'WARNING: DirectorySnapshot.get_users(): {u} not in snapshot taken {self.taken}')
+
+        return users
+
+
+# directory shared by all statements in a process
+directory = Directory()
+
+# if set, statements look up group members and users here instead of in
+# the local group database and LDAP
+snapshot = None
@@ -3,12 +3,16 @@ import sys
 import os
 import csv
 from pathlib import Path
-import subprocess
 import delorean
 import datetime
 import calendar
 import argparse
 
+from . import slurm_cli
+from . import profiling
+from . import progress
+from . import metrics
+
 debug_p = False
 
 def read_pis(pis_file):
@@ -57,9 +61,21 @@ def main():
                         help='Reports prefix directory')
     parser.add_argument('-w', '--when', default=None,
                         help='Date for reporting in format YYYY-MM')
+    parser.add_argument('-j', '--max-concurrency', type=int, default=slurm_cli.DEFAULT_MAX_CONCURRENCY,
+                        help=f'Maximum number of concurrent sreport queries (Default: {slurm_cli.DEFAULT_MAX_CONCURRENCY})')
+    parser.add_argument('--trace', action='store_true',
+                        help='Print latency and output size of each sreport call')
+    profiling.add_arguments(parser)
+    progress.add_arguments(parser)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    slurm_cli.runner.max_concurrency = args.max_concurrency
+    profiling.start('generate_monthly_sreports', args)
+    progress.start(args)
+    metrics.start('generate_monthly_sreports', args)
 
     if debug_p:
         print(f'DEBUG: args = {args}')
@@ -105,11 +121,12 @@ def main():
     if not reports_dir.exists():
         now = delorean.Delorean(timezone='US/Eastern')
         print(f'{now.datetime.strftime("%Y-%m-%d %H:%M:%S %Z")} - INFO: reports_dir does not exist; creating …')
-        os.mkdir(reports_dir)
+        os.makedirs(reports_dir)
 
     if debug_p:
         print(f'DEBUG: main(): there are {len(pis_lastnames)} PIs')
 
+    commands = []
     for pi in pis_lastnames:
         if debug_p:
             print(f'DEBUG: Generating report for {pi} ...')
@@ -121,11 +138,34 @@ def main():
         if debug_p:
             print(f'DEBUG: Command: {command}')
 
-        report_file = reports_dir / f'{pi}.txt'
-        with open(report_file, 'w') as outfile:
-            outfile.write(subprocess.run(command, check=True,
-                          capture_output=True, text=True).stdout)
+        commands.append(command)
+
+    # all PIs are queried concurrently
+    tracker = progress.Progress('sreport', total=len(commands), unit='PIs')
+    with profiling.stage('sreport'):
+        results = slurm_cli.runner.run_many_sync(commands, on_done=lambda cmdline: tracker.update())
+    tracker.done()
+
+    n_failed = 0
+    with profiling.stage('write'):
+        for pi, result in zip(pis_lastnames, results):
+            if isinstance(result, Exception):
+                print(f'ERROR: sreport for {pi} failed: {result}')
+                n_failed += 1
+                continue
+
+            report_file = reports_dir / f'{pi}.txt'
+            with open(report_file, 'w') as outfile:
+                outfile.write(result.stdout)
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(reports_dir.parent)
+    metrics.finish(success=not n_failed)
 
+    if n_failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+import sys
+import os
+import csv
+import datetime
+import argparse
+from pathlib import Path
+import smtplib
+from email.mime.text import MIMEText
+from email.utils import formatdate
+import numpy as np
+import pandas as pd
+
+from . import slurm_cli
+from . import update_grptresmins
+from . import profiling
+
+# Forecast when GrpTRESMins-limited accounts (unfunded, class, expired
+# shares) will run out of budget.
+#
+# Remaining budget = GrpTRESMins (sacctmgr, already reduced nightly for
+# storage by update_grptresmins) - GrpTRESRaw billing (sshare).
+# Daily burn = mean over the window of daily compute billing minutes
+# (sreport, one query per day, run concurrently) + daily storage debit
+# (Isilon quota reports, same computation as update_grptresmins).
+
+debug_p = False
+
+smtpserver = "smtp.example.com"
+SSHARE = os.path.join(os.environ.get('SLURM_BINDIR', '/cm/shared/apps/slurm/current/bin'), 'sshare')
+SREPORT = os.path.join(os.environ.get('SLURM_BINDIR', '/cm/shared/apps/slurm/current/bin'), 'sreport')
+
+
+def get_grptres_raw():
+    """Return dict account: billing minutes counted against GrpTRESMins"""
+    usage = {}
+    with slurm_cli.runner.stream([SSHARE, '-P', '-a', '-o', 'Account,User,GrpTRESRaw']) as sshare:
+        reader = csv.DictReader(sshare.stdout, delimiter='|')
+        for row in reader:
+            if row['User']:
+                continue
+
+            for tres in row['GrpTRESRaw'].split(','):
+                if tres.startswith('billing='):
+                    usage[row['Account'].strip()] = int(tres.split('=')[1])
+
+    return usage
+
+
+def get_daily_compute_usage(days):
+    """Return DataFrame with columns Account, Date, Compute (billing minutes)"""
+    commands = []
+    for day in days:
+        next_day = day + datetime.timedelta(days=1)
+        commands.append([SREPORT, '-n', '-P', 'cluster', 'AccountUtilizationByUser',
+                         f'Start={day}', f'End={next_day}', '-T', 'billing', '-t', 'Minutes'])
+
+    # one sreport per day, all run concurrently
+    results = slurm_cli.runner.run_many_sync(commands)
+
+    rows = []
+    for day, result in zip(days, results):
+        if isinstance(result, Exception):
+            print(f'WARNING: grptresmins_forecast: no compute usage for {day}: {result}')
+            continue
+
+        for line in result.stdout.splitlines():
+            fields = line.split('|')
+            # account totals have an empty Login
+            if len(fields) >= 6 and not fields[2]:
+                rows.append((fields[1].strip(), day, float(fields[5])))
+
+    return pd.DataFrame(rows, columns=['Account', 'Date', 'Compute'])
+
+
+def get_daily_storage_debits(days):
+    """Return DataFrame with columns Account, Date, Storage (billing minutes)"""
+    rows = []
+    for day in days:
+        for acct, su in update_grptresmins.get_disk_usage(day, debug_p).items():
+            rows.append((acct, day, float(su)))
+
+    return pd.DataFrame(rows, columns=['Account', 'Date', 'Storage'])
+
+
+def forecast(associations, grptres_raw, compute_df, storage_df, days, today):
+    """Return DataFrame of limited accounts ranked by days to exhaustion"""
+    limits = pd.DataFrame(list(associations.items()), columns=['Account', 'GrpTRESMins']).set_index('Account')
+    limits['Used'] = pd.Series(grptres_raw, dtype='float64').reindex(limits.index).fillna(0.)
+    limits['Remaining'] = (limits['GrpTRESMins'] - limits['Used']).clip(lower=0.)
+
+    # account x day matrices; days without usage count as zero burn
+    day_index = pd.Index(days, name='Date')
+    compute = (compute_df.pivot_table(index='Account', columns='Date', values='Compute', aggfunc='sum')
+               .reindex(index=limits.index, columns=day_index).fillna(0.))
+    storage = (storage_df.pivot_table(index='Account', columns='Date', values='Storage', aggfunc='sum')
+               .reindex(index=limits.index, columns=day_index).fillna(0.))
+
+    limits['Compute burn/day'] = compute.mean(axis=1)
+    limits['Storage burn/day'] = storage.mean(axis=1)
+    limits['Burn/day'] = limits['Compute burn/day'] + limits['Storage burn/day']
+
+    # float even when there are no limited accounts, and the columns are empty
+    burn = limits['Burn/day'].to_numpy(dtype=float)
+    remaining = limits['Remaining'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_left = np.where(burn > 0., remaining / burn, np.inf)
+    limits['Days left'] = days_left
+
+    finite = np.isfinite(days_left)
+    exhaustion = pd.Series(pd.NaT, index=limits.index, dtype='datetime64[ns]')
+    exhaustion[finite] = pd.Timestamp(today) + pd.to_timedelta(np.floor(days_left[finite]), unit='D')
+    limits['Exhaustion date'] = exhaustion.dt.date
+
+    limits = limits.sort_values(by=['Days left', 'Burn/day'], ascending=[True, False])
+    limits.reset_index(inplace=True)
+
+    return limits
+
+
+def read_project_pis(rcm_prefix: Path):
+    """Return dict project: (PI last name, PI email)"""
+    names = {}
+    with open(rcm_prefix / 'myorg_pis.csv', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            if row['Email']:
+                names[row['Email']] = row['Last Name']
+
+    project_pis = {}
+    with open(rcm_prefix / 'fundorg_codes.csv', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            if row['Project']:
+                project_pis[row['Project'].strip().lower()] = (names.get(row['Email'], ''), row['Email'])
+
+    return project_pis
+
+
+def read_email_addresses(rcm_prefix: Path):
+    email_addrs = {}
+    with open(rcm_prefix / 'email_addressees.csv') as ef:
+        for row in csv.DictReader(ef):
+            email_addrs[row['Description']] = {'Name': row['Name'], 'Email': row['Email']}
+
+    return email_addrs
+
+
+def send_warnings(at_risk_df, rcm_prefix: Path, send_email_p=False):
+    """Send one email per PI listing all their at-risk accounts, over a single SMTP connection"""
+    project_pis = read_project_pis(rcm_prefix)
+    email_addrs = read_email_addresses(rcm_prefix)
+    send_from = f'{email_addrs["orgnamesupport"]["Name"]} <{email_addrs["orgnamesupport"]["Email"]}>'
+
+    by_pi = {}
+    for row in at_risk_df.to_dict('records'):
+        lastname, email = project_pis.get(row['Account'], ('', None))
+        if not email:
+            print(f'WARNING: grptresmins_forecast: no PI for {row["Account"]}')
+            continue
+        by_pi.setdefault((lastname, email), []).append(row)
+
+    messages = []
+    for (lastname, email), rows in by_pi.items():
+        body = f'Dear Dr. {lastname}:\n\n'
+        body += 'At the current rate of usage, the following accounts will soon exhaust their allocation:\n\n'
+        body += f'    {"Account":<20} {"Remaining (SU-min)":>18} {"Burn/day":>12} {"Exhaustion date":>16}\n'
+        for r in rows:
+            body += f'    {r["Account"]:<20} {r["Remaining"]:>18,.0f} {r["Burn/day"]:>12,.0f} {str(r["Exhaustion date"]):>16}\n'
+        body += '\nThank you.\n'
+
+        msg = MIMEText(body)
+        msg['From'] = send_from
+        if debug_p:
+            msg['To'] = f'{email_addrs["debug"]["Name"]} <{email_addrs["debug"]["Email"]}>'
+        else:
+            msg['To'] = f'{lastname} <{email}>'
+        msg['Date'] = formatdate(localtime=True)
+        msg['Subject'] = f'ORGNAME - {len(rows)} account(s) nearing allocation limit'
+        messages.append(msg)
+
+    if not send_email_p:
+        for msg in messages:
+            print(f'Not sending warning to {msg["To"]}')
+        return 0
+
+    with smtplib.SMTP(smtpserver) as mailserver:
+        for msg in messages:
+            print(f'Sending warning to {msg["To"]}')
+            mailserver.send_message(msg)
+
+    return len(messages)
+
+
+def main():
+    global debug_p
+
+    today = datetime.date.today()
+
+    parser = argparse.ArgumentParser(description='Forecast exhaustion of GrpTRESMins-limited accounts')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debugging output')
+    parser.add_argument('-r', '--reports-prefix', default='/ifs/sysadmin/RCM', help='Reports prefix directory')
+    parser.add_argument('-w', '--when', default=f'{today}', help='Forecast date in format YYYY-MM-DD (default today)')
+    parser.add_argument('--window', type=int, default=14, help='Number of days of usage to average (default 14)')
+    parser.add_argument('--warn-days', type=int, default=14,
+                        help='Warn PIs whose accounts are forecast to run out within this many days (default 14)')
+    parser.add_argument('-e', '--email', action='store_true', help='Actually send warning emails (Default: DOES NOT send email)')
+    parser.add_argument('--trace', action='store_true', help='Print latency and output size of each Slurm command')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    profiling.start('grptresmins_forecast', args)
+
+    if debug_p:
+        rcm_prefix = Path(args.reports_prefix) / 'DEBUG'
+    else:
+        rcm_prefix = Path(args.reports_prefix)
+
+    update_grptresmins.RCM_PREFIX = rcm_prefix
+
+    try:
+        when = datetime.date.fromisoformat(args.when)
+    except ValueError as e:
+        print(f'ERROR: {e}')
+        sys.exit(1)
+
+    # window ends yesterday: today's usage is incomplete
+    days = [when - datetime.timedelta(days=n) for n in range(args.window, 0, -1)]
+
+    with profiling.stage('associations'):
+        grantees = update_grptresmins.get_myorg_grants(debug_p=debug_p)
+        associations = update_grptresmins.get_associations(grantees)
+        grptres_raw = get_grptres_raw()
+    with profiling.stage('compute_usage'):
+        compute_df = get_daily_compute_usage(days)
+    with profiling.stage('storage_debits'):
+        storage_df = get_daily_storage_debits(days)
+
+    with profiling.stage('forecast'):
+        forecast_df = forecast(associations, grptres_raw, compute_df, storage_df, days, when)
+
+    forecast_dir = rcm_prefix / 'forecast'
+    os.makedirs(forecast_dir, exist_ok=True)
+    forecast_csv = forecast_dir / f'grptresmins_forecast_{when}.csv'
+    forecast_df.to_csv(forecast_csv, float_format='%.1f', index=False)
+
+    at_risk_df = forecast_df[forecast_df['Days left'] <= args.warn_days]
+
+    print(f'grptresmins_forecast: {len(forecast_df)} limited accounts; {len(at_risk_df)} forecast to run out within {args.warn_days} days')
+    print(f'grptresmins_forecast: report written to {forecast_csv}')
+    if not at_risk_df.empty:
+        print(at_risk_df[['Account', 'Remaining', 'Burn/day', 'Days left', 'Exhaustion date']].to_string(index=False))
+        with profiling.stage('email'):
+            send_warnings(at_risk_df, rcm_prefix, args.email)
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(forecast_dir)
+
+
+if __name__ == '__main__':
+    main()
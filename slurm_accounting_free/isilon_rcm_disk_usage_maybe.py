@@ -15,6 +15,10 @@ from pathlib import Path
 import xml.etree.ElementTree as ET
 import grp
 
+from . import profiling
+from . import progress
+from . import metrics
+
 ### cron example
 # ISILON quota reports generated at 23:30 every night
 # Example of job definition:
@@ -94,43 +98,49 @@ def isilon_disk_usage_maybe(when, debug_p=False, verbose_p=False, force_p=False)
 
     # this is a list of tuples (Delorean, string)
     reports = get_list_of_reports(QUOTA_REPORTS_DIR, debug_p)
+    tracker = progress.Progress('quota_report', total=sum(1 for r in reports if r[0].date == when), unit='reports')
 
     for report in reports:
         debug_print_maybe(f'report[0].date = {report[0].date}; when = {when}', debug_p)
         if report[0].date == when:
-            tree = ET.parse(report[1])
-            root = tree.getroot()
-
-            debug_print_maybe(f'report = {report}; type(report_fn) = {type(report)}', debug_p)
-            debug_print_maybe(f"Report time: {delorean.epoch(int(root.attrib['time'])).shift('US/Eastern').datetime.strftime('%Y-%m-%d %X %Z')}", debug_p)
-
-            for domain in root.iter('domain'):
-                if domain.attrib['type'] == 'group':
-                    gid = int(domain.attrib['id'])
-                    debug_print_maybe(f'gid = {gid}', debug_p)
-                    # research groups have GIDs starting at 10001
-                    if gid > MINGID:
-                        gr_name = grp.getgrgid(gid).gr_name
-                        # FIXME this results in two lines for the valid group;
-                        #       real fix is to chgrp all the affected files;
-                        #       currently kludge below to add obsolete group's
-                        #       usage into replacement group
-                        if gr_name in obsolete_groups:
-                            gr_name = obsolete_groups[gr_name]
-
-                        for usage in domain.findall('usage'):
-                            # NOTE: du(1) reports physical storage
-                            if usage.attrib['resource'] == 'physical':
-                                # quota reports show usage in bytes
-                                # want output in kiB to be in same units as "du -sk" before
-                                usage_kiB = round(float(usage.text)/KIBI)
-
-                                debug_print_maybe(f'gr_name = {gr_name}')
-                                # check if group already has du entry
-                                if gr_name not in du_by_group.keys():
-                                    du_by_group[gr_name] = usage_kiB
-                                else:
-                                    du_by_group[gr_name] += usage_kiB
+            with profiling.stage('quota_report', os.path.basename(report[1])):
+                tree = ET.parse(report[1])
+                root = tree.getroot()
+
+                debug_print_maybe(f'report = {report}; type(report_fn) = {type(report)}', debug_p)
+                debug_print_maybe(f"Report time: {delorean.epoch(int(root.attrib['time'])).shift('US/Eastern').datetime.strftime('%Y-%m-%d %X %Z')}", debug_p)
+
+                for domain in root.iter('domain'):
+                    if domain.attrib['type'] == 'group':
+                        gid = int(domain.attrib['id'])
+                        debug_print_maybe(f'gid = {gid}', debug_p)
+                        # research groups have GIDs starting at 10001
+                        if gid > MINGID:
+                            gr_name = grp.getgrgid(gid).gr_name
+                            # FIXME this results in two lines for the valid group;
+                            #       real fix is to chgrp all the affected files;
+                            #       currently kludge below to add obsolete group's
+                            #       usage into replacement group
+                            if gr_name in obsolete_groups:
+                                gr_name = obsolete_groups[gr_name]
+
+                            for usage in domain.findall('usage'):
+                                # NOTE: du(1) reports physical storage
+                                if usage.attrib['resource'] == 'physical':
+                                    # quota reports show usage in bytes
+                                    # want output in kiB to be in same units as "du -sk" before
+                                    usage_kiB = round(float(usage.text)/KIBI)
+
+                                    debug_print_maybe(f'gr_name = {gr_name}')
+                                    # check if group already has du entry
+                                    if gr_name not in du_by_group.keys():
+                                        du_by_group[gr_name] = usage_kiB
+                                    else:
+                                        du_by_group[gr_name] += usage_kiB
+
+            tracker.update()
+
+    tracker.done()
 
     # build du_output
     du_output = []
@@ -182,12 +192,19 @@ def main():
     parser.add_argument('-d', '--debug', action='store_true', help='debugging output')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
     parser.add_argument('-f', '--force', action='store_true', help='run du even if not an appropriate date')
+    profiling.add_arguments(parser)
+    progress.add_arguments(parser)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     debug_p   = args.debug
     verbose_p = args.verbose
     force_p   = args.force
 
+    profiling.start('isilon_rcm_disk_usage_maybe', args)
+    progress.start(args)
+    metrics.start('isilon_rcm_disk_usage_maybe', args)
+
     debug_print_maybe(f'main(): debug_p = {debug_p}', debug_p)
     debug_print_maybe(f'main(): today = {today}', debug_p)
     debug_print_maybe(f'main(): args.when = {args.when}', debug_p)
@@ -234,6 +251,10 @@ def main():
         else:
             debug_print_maybe(f'{when} - isilon_rcm_disk_usage_maybe.py - day-of-month not in list', debug_p)
 
+    # next to the month's du files
+    profiling.finish(RCM_PREFIX / f'{when.year}-{when.month:02d}')
+    metrics.finish()
+
     return
 
 
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+import sys
+import os
+import csv
+import json
+import sqlite3
+import calendar
+import datetime
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from . import slurm_cli
+from . import sacct_fields
+from . import profiling
+
+# Local cache of ended jobs' sacct records, so that per-job reports do not
+# have to query slurmdbd for the whole month each time.
+#
+# The cache is a directory of SQLite files, one per month, jobs_YYYYMM.sqlite,
+# each holding the records (allocation and steps, as the strings sacct
+# printed, untruncated) of the jobs which ended in that month. Steps are
+# filed with their job. Each file is indexed by account, user and the job's
+# end time.
+#
+# update() (daily, from cron: job_cache --update) fetches only the jobs which
+# ended since the end of the last update's window, with one sacct query
+# streamed in chunks. That time is recorded in job_cache.json only once an
+# update has finished, since sacct does not list jobs in order of end time:
+# an interrupted update is fetched again in full by the next one. Each
+# update's window starts UPDATE_OVERLAP before the end of the last one, for
+# jobs which ended just before it but reached slurmdbd only after that
+# update's query. Records are keyed by JobID, so fetching a job twice
+# replaces it.
+#
+# With job_cache.cache set to a JobCache, job_stats.iter_sacct_chunks(), and
+# so job statistics, efficiency reports and per-job charges, read the
+# month's records from the cache instead of running sacct: the jobs which
+# ended in the month, and the jobs which ended later but started before the
+# month's end, in the same form sacct prints them (truncated to the month
+# like sacct -T if asked). Jobs still running when the cache was last
+# updated are not in it, so a month should be reported on after the update
+# following the month's end; reading a month the cache has not been updated
+# to the end of prints a warning.
+
+debug_p = False
+
+# the cache used instead of sacct; see job_stats.iter_sacct_chunks()
+cache = None
+
+CACHE_FIELDS = ['JobID', 'Account', 'User', 'Partition', 'State', 'Submit', 'Start', 'End',
+                'Elapsed', 'ElapsedRaw', 'TotalCPU', 'AllocCPUS', 'NNodes', 'ReqMem', 'AllocTRES',
+                'MaxRSS', 'MaxVMSize']
+
+# states of jobs which have ended (sacct -s)
+ENDED_STATES = ['BF', 'CA', 'CD', 'DL', 'F', 'NF', 'OOM', 'PR', 'TO']
+
+FETCH_CHUNK_SIZE = 100000
+
+STATE_FILENAME = 'job_cache.json'
+
+# jobs which ended this long before the last update's window ended are fetched again
+UPDATE_OVERLAP = datetime.timedelta(hours=1)
+
+
+def partition_filename(cache_dir, yyyymm):
+    return Path(cache_dir) / f'jobs_{yyyymm}.sqlite'
+
+
+def month_bounds(year, month):
+    """Return (start, end) of the month as sacct timestamps, end inclusive"""
+    last_day = calendar.monthrange(year, month)[1]
+    return f'{year}-{month:02d}-01T00:00:00', f'{year}-{month:02d}-{last_day:02d}T23:59:59'
+
+
+def format_duration(seconds):
+    """Return Series of [D-]HH:MM:SS strings of int seconds, as sacct prints Elapsed"""
+    d, rem = np.divmod(seconds.to_numpy(dtype=np.int64), 86400)
+    h, rem = np.divmod(rem, 3600)
+    m, s = np.divmod(rem, 60)
+    hms = pd.Series([f'{a:02d}:{b:02d}:{c:02d}' for a, b, c in zip(h.tolist(), m.tolist(), s.tolist())], index=seconds.index)
+    return hms.where(d == 0, pd.Series(d, index=seconds.index).astype(str) + '-' + hms)
+
+
+def truncate_records(chunk, year, month):
+    """Return chunk with Start, End, Elapsed and ElapsedRaw cut off at the month's boundaries, like sacct -T"""
+    period_start, period_end = (pd.Timestamp(t) for t in month_bounds(year, month))
+    start = sacct_fields.decode_timestamp(chunk['Start'])
+    end = sacct_fields.decode_timestamp(chunk['End'])
+    started = start.notna() & end.notna()
+    if not started.any():
+        return chunk
+
+    chunk = chunk.copy()
+    # sacct's inclusive 23:59:59 end is the month's end
+    start = start[started].clip(lower=period_start)
+    end = end[started].clip(upper=period_end + pd.Timedelta(seconds=1))
+    seconds = (end - start).dt.total_seconds().clip(lower=0).astype('int64')
+
+    if 'Start' in chunk:
+        chunk.loc[started, 'Start'] = start.dt.strftime(sacct_fields.SACCT_TIME_FORMAT)
+    if 'End' in chunk:
+        chunk.loc[started, 'End'] = end.clip(upper=period_end).dt.strftime(sacct_fields.SACCT_TIME_FORMAT)
+    if 'Elapsed' in chunk:
+        chunk.loc[started, 'Elapsed'] = format_duration(seconds)
+    if 'ElapsedRaw' in chunk:
+        chunk.loc[started, 'ElapsedRaw'] = seconds.astype(str)
+
+    return chunk
+
+
+class JobCache:
+    """Monthly SQLite files of ended jobs' sacct records"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self.warned = set()     # months read before the cache was updated to their end
+
+    def partitions(self):
+        """Return sorted list of YYYYMM of the months in the cache"""
+        return sorted(p.stem.split('_', 1)[1] for p in self.cache_dir.glob('jobs_[0-9]*.sqlite'))
+
+    def connect(self, yyyymm):
+        con = sqlite3.connect(partition_filename(self.cache_dir, yyyymm))
+        columns = ', '.join(f'"{f}" TEXT' for f in CACHE_FIELDS if f != 'JobID')
+        con.execute(f'CREATE TABLE IF NOT EXISTS jobs (JobID TEXT PRIMARY KEY, JobStart TEXT, JobEnd TEXT, {columns})')
+        con.execute('CREATE INDEX IF NOT EXISTS jobs_account ON jobs (Account COLLATE NOCASE)')
+        con.execute('CREATE INDEX IF NOT EXISTS jobs_user ON jobs (User)')
+        con.execute('CREATE INDEX IF NOT EXISTS jobs_end ON jobs (JobEnd)')
+        return con
+
+    def last_end(self):
+        """Return the end of the last complete update's window, as a sacct timestamp; None if there has been none"""
+        try:
+            with open(self.cache_dir / STATE_FILENAME, 'r') as f:
+                return json.load(f)['fetched_until']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def set_last_end(self, fetched_until):
+        state_file = self.cache_dir / STATE_FILENAME
+        tmp_file = state_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump({'fetched_until': fetched_until}, f)
+        os.replace(tmp_file, state_file)
+
+    def add_records(self, records):
+        """Add DataFrame of CACHE_FIELDS records with JobStart and JobEnd columns
+        (the times of the record's job) to the months their jobs ended in"""
+        columns = ['JobID', 'JobStart', 'JobEnd'] + [f for f in CACHE_FIELDS if f != 'JobID']
+        placeholders = ', '.join('?' * len(columns))
+        quoted = ', '.join(f'"{c}"' for c in columns)
+
+        for yyyymm, month_df in records.groupby(records['JobEnd'].str[:7].str.replace('-', ''), sort=True):
+            con = self.connect(yyyymm)
+            with con:
+                con.executemany(f'INSERT OR REPLACE INTO jobs ({quoted}) VALUES ({placeholders})',
+                                month_df[columns].itertuples(index=False, name=None))
+            con.close()
+
+    def update(self, since=None, until=None, chunksize=FETCH_CHUNK_SIZE):
+        """Fetch the jobs which ended after the last update's window (or since, a
+        sacct timestamp, for an empty cache) and up to until (default now); return
+        the number of records added"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        last = self.last_end()
+        if last is not None:
+            # records reach slurmdbd some time after their jobs end
+            last = (datetime.datetime.strptime(last, sacct_fields.SACCT_TIME_FORMAT)
+                    - UPDATE_OVERLAP).strftime(sacct_fields.SACCT_TIME_FORMAT)
+        else:
+            last = since
+        if last is None:
+            print('ERROR: JobCache.update(): the cache has never been updated; give the time to fetch jobs since')
+            sys.exit(1)
+        if until is None:
+            until = datetime.datetime.now().strftime(sacct_fields.SACCT_TIME_FORMAT)
+
+        sacct_cmdline = ['sacct', '-P', '-o', ','.join(CACHE_FIELDS), '-a',
+                         '-s', ','.join(ENDED_STATES), f'-S{last}', f'-E{until}']
+
+        if debug_p:
+            print(f'DEBUG: JobCache.update(): sacct_cmdline = {sacct_cmdline}', flush=True)
+
+        csv.register_dialect('sacct', delimiter='|')
+
+        n_added = 0
+        carried = {}    # job ID: (start, end) of the previous chunk's last job
+        try:
+            with slurm_cli.runner.stream(sacct_cmdline, check=False) as sacct_output:
+                for chunk in pd.read_csv(sacct_output.stdout, dialect='sacct', dtype=str,
+                                         keep_default_na=False, chunksize=chunksize):
+                    # steps follow their job; file them under the job's times
+                    job_id = chunk['JobID'].str.partition('.')[0]
+                    is_job = ~chunk['JobID'].str.contains('.', regex=False)
+                    job_start = dict(zip(job_id[is_job], chunk['Start'][is_job]))
+                    job_end = dict(zip(job_id[is_job], chunk['End'][is_job]))
+                    for k, (start, end) in carried.items():
+                        job_start.setdefault(k, start)
+                        job_end.setdefault(k, end)
+
+                    records = chunk.assign(JobStart=job_id.map(job_start).fillna(chunk['Start']),
+                                           JobEnd=job_id.map(job_end).fillna(chunk['End']))
+                    carried = {job_id.iloc[-1]: (records['JobStart'].iloc[-1], records['JobEnd'].iloc[-1])}
+
+                    # only jobs which have ended in the window; Unknown end times sort after digits
+                    ended = (records['JobEnd'] >= last) & (records['JobEnd'] <= until) & records['JobEnd'].str[:1].str.isdigit()
+                    self.add_records(records[ended])
+                    n_added += int(ended.sum())
+        except Exception as e:
+            print(f'EXCEPTION: JobCache.update(): {type(e)} - {e}')
+            sys.exit(2)
+
+        if sacct_output.returncode != 0:
+            print(f'WARNING: sacct return code = {sacct_output.returncode}')
+            print(f'    {sacct_output.stderr}')
+        else:
+            self.set_last_end(until)
+
+        if debug_p:
+            print(f'DEBUG: JobCache.update(): {n_added} records of jobs ended {last} - {until}')
+
+        return n_added
+
+    def iter_chunks(self, year, month, accounts=None, chunksize=FETCH_CHUNK_SIZE, fields=CACHE_FIELDS,
+                    truncate=True, allocations=False):
+        """Yield DataFrames of chunksize records (all columns str) of the jobs which
+        ran in the month, as job_stats.iter_sacct_chunks() does from sacct"""
+        missing = [f for f in fields if f not in CACHE_FIELDS]
+        if missing:
+            raise ValueError(f'JobCache.iter_chunks(): fields not in the cache: {missing}')
+
+        yyyymm = f'{year}{month:02d}'
+        period_end = month_bounds(year, month)[1]
+
+        fetched_until = self.last_end()
+        if (fetched_until is None or fetched_until < period_end) and yyyymm not in self.warned:
+            print(f'WARNING: JobCache: jobs are only cached up to {fetched_until}; records of {year}-{month:02d} are incomplete')
+            self.warned.add(yyyymm)
+
+        conditions = []
+        params = []
+        if accounts:
+            conditions.append(f'Account COLLATE NOCASE IN ({", ".join("?" * len(accounts))})')
+            params += list(accounts)
+        if allocations:
+            conditions.append("instr(JobID, '.') = 0")
+
+        # truncation needs the times whether or not they were asked for
+        selected = list(fields) + ([f for f in ('Start', 'End') if f not in fields] if truncate else [])
+        quoted = ', '.join(f'"{f}"' for f in selected)
+        for partition in self.partitions():
+            if partition < yyyymm:
+                continue
+
+            # jobs which ended later ran in the month if they started before its end
+            where = conditions + ([] if partition == yyyymm else ['JobStart <= ?'])
+            where_params = params + ([] if partition == yyyymm else [period_end])
+            sql = f'SELECT {quoted} FROM jobs'
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            sql += ' ORDER BY rowid'
+
+            with sqlite3.connect(partition_filename(self.cache_dir, partition)) as con:
+                for chunk in pd.read_sql_query(sql, con, params=where_params, chunksize=chunksize, dtype=str):
+                    if truncate:
+                        chunk = truncate_records(chunk, year, month)[list(fields)]
+                    yield chunk
+
+    def print_status(self, file=sys.stdout):
+        for yyyymm in self.partitions():
+            with sqlite3.connect(partition_filename(self.cache_dir, yyyymm)) as con:
+                n_records, n_jobs, first, last = con.execute(
+                    "SELECT count(*), sum(instr(JobID, '.') = 0), min(JobEnd), max(JobEnd) FROM jobs").fetchone()
+            print(f'{yyyymm}: {n_jobs or 0:>10,} jobs {n_records:>12,} records   ended {first} - {last}', file=file)
+
+
+def main():
+    global debug_p
+
+    parser = argparse.ArgumentParser(description='Local cache of ended jobs\' sacct records, by month')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debugging output')
+    parser.add_argument('-c', '--cache-dir', default='/ifs/sysadmin/RCM/job_cache', help='Cache directory')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help='Fetch the jobs which ended since the last end time in the cache')
+    parser.add_argument('--since', default=None,
+                        help='For an empty cache, fetch jobs which ended since this time (YYYY-MM-DD[THH:MM:SS])')
+    parser.add_argument('--until', default=None, help='Fetch jobs which ended up to this time (Default: now)')
+    parser.add_argument('-l', '--list', action='store_true', help='List the months in the cache')
+    parser.add_argument('--trace', action='store_true', help='Print latency and output size of each Slurm command')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    profiling.start('job_cache', args)
+
+    job_cache = JobCache(args.cache_dir)
+
+    if args.update:
+        since, until = args.since, args.until
+        if since is not None and 'T' not in since:
+            since = f'{since}T00:00:00'
+        if until is not None and 'T' not in until:
+            until = f'{until}T23:59:59'
+        with profiling.stage('update'):
+            n_added = job_cache.update(since=since, until=until)
+        print(f'job_cache: added {n_added:,} records; jobs which ended up to {job_cache.last_end()} are cached')
+
+    if args.list or not args.update:
+        job_cache.print_status()
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
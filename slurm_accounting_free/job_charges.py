@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import sys
+import os
+import gzip
+import decimal
+import datetime
+import argparse
+from decimal import Decimal
+from pathlib import Path
+import pandas as pd
+
+from . import slurm_cli
+from . import job_stats
+from . import sacct_fields
+from . import job_cache
+from . import profiling
+
+# Per-job compute charges from the month's sacct records.
+#
+# Each job allocation record (sacct -X, truncated to the month with -T,
+# as sreport counts usage within the period) is charged
+#
+#   SU = billing TRES x ElapsedRaw / 3600      i.e. billing TRES-hours
+#   charge = SU x rate
+#
+# which is what sreport cluster AccountUtilizationByUser -T billing -t Hours
+# sums per account and user for the statements (see get_compute_usage() in
+# __main__).
+#
+# The records are streamed in chunks of chunksize rows. Each chunk's jobs
+# are appended to the month's ledger, a gzipped CSV with one row per job,
+# and added to running totals per (account, user); only one chunk is in
+# memory at a time. The ledger is written to a temporary file and renamed
+# when complete, so a ledger on disk is always a whole month.
+
+debug_p = False
+
+SACCT_FIELDS = ['JobID', 'Account', 'User', 'Partition', 'AllocTRES', 'ElapsedRaw']
+
+LEDGER_FIELDS = ['JobID', 'Account', 'User', 'Partition', 'Billing', 'ElapsedRaw', 'SU', 'Charge ($)']
+
+RATE = Decimal('0.0123')  # $ per SU; the one rate of statements, reports and ledgers
+
+decimal.getcontext().rounding = decimal.ROUND_HALF_UP
+
+
+def ledger_filename(reports_dir, year, month):
+    return Path(reports_dir) / f'job_charges_{year}{month:02d}.csv.gz'
+
+
+def totals_filename(reports_dir, year, month):
+    return Path(reports_dir) / f'job_charges_{year}{month:02d}_totals.csv'
+
+
+def chunk_charges(chunk, rate=RATE):
+    """Return DataFrame of LEDGER_FIELDS for the job allocation records in chunk"""
+    # a job without a billing TRES (e.g. still pending) is not charged
+    billing = sacct_fields.decode_tres(chunk['AllocTRES'], 'billing').fillna(0).round().astype('int64')
+    elapsed = pd.to_numeric(chunk['ElapsedRaw'], errors='coerce').fillna(0).astype('int64')
+    su = billing * elapsed / 3600.
+
+    return pd.DataFrame({'JobID': chunk['JobID'],
+                         'Account': chunk['Account'].str.casefold(),
+                         'User': chunk['User'],
+                         'Partition': chunk['Partition'],
+                         'Billing': billing,
+                         'ElapsedRaw': elapsed,
+                         'SU': su,
+                         'Charge ($)': su * float(rate)})
+
+
+class JobCharges:
+    """Per-job charges of a month and their totals per account and user, built chunk by chunk"""
+
+    def __init__(self, year, month, rate=RATE):
+        self.year = year
+        self.month = month
+        self.rate = rate
+        self.totals = None    # DataFrame indexed by (Account, User): Jobs, SU
+        self.n_jobs = 0
+
+    def add_chunk(self, chunk):
+        """Add the job allocation records in chunk; return their DataFrame of LEDGER_FIELDS"""
+        charges_df = chunk_charges(chunk, self.rate)
+        self.n_jobs += len(charges_df)
+
+        totals = charges_df.assign(Jobs=1).groupby(['Account', 'User'])[['Jobs', 'SU']].sum()
+        self.totals = totals if self.totals is None else self.totals.add(totals, fill_value=0)
+
+        return charges_df
+
+    @classmethod
+    def from_sacct(cls, year, month, ledger_file=None, rate=RATE, chunksize=job_stats.CHUNK_SIZE):
+        """Return JobCharges of the month's jobs; also write them to ledger_file if given"""
+        charges = cls(year, month, rate)
+
+        tmp_file = None
+        ledger = None
+        if ledger_file is not None:
+            tmp_file = Path(f'{ledger_file}.tmp')
+            ledger = gzip.open(tmp_file, 'wt', newline='')
+
+        try:
+            header = True
+            for chunk in job_stats.iter_sacct_chunks(year, month, chunksize=chunksize, fields=SACCT_FIELDS,
+                                                     truncate=True, allocations=True):
+                charges_df = charges.add_chunk(chunk)
+                if ledger is not None:
+                    charges_df.to_csv(ledger, header=header, index=False, float_format='%.6f')
+                    header = False
+        except Exception as e:
+            print(f'EXCEPTION: JobCharges.from_sacct(): {type(e)} - {e}')
+            sys.exit(2)
+
+        if ledger is not None:
+            if header:
+                # no jobs; an empty ledger still has its header
+                pd.DataFrame(columns=LEDGER_FIELDS).to_csv(ledger, index=False)
+            ledger.close()
+            os.replace(tmp_file, ledger_file)
+
+        if debug_p:
+            print(f'DEBUG: JobCharges.from_sacct(): {charges.n_jobs} jobs of {len(charges.project_totals())} accounts')
+
+        return charges
+
+    def user_totals(self):
+        """Return DataFrame of Account, User, Jobs, SU, Charge ($) per account and user"""
+        if self.totals is None:
+            return pd.DataFrame(columns=['Account', 'User', 'Jobs', 'SU', 'Charge ($)'])
+
+        totals_df = self.totals.reset_index()
+        totals_df['Jobs'] = totals_df['Jobs'].astype(int)
+        totals_df['Charge ($)'] = totals_df['SU'] * float(self.rate)
+        return totals_df
+
+    def project_totals(self):
+        """Return DataFrame of Account, Jobs, SU, Charge ($) per account"""
+        totals_df = self.user_totals()
+        return totals_df.groupby('Account', as_index=False)[['Jobs', 'SU', 'Charge ($)']].sum()
+
+    def project_usage(self):
+        """Return dict project: compute SU, as Decimal whole SU like sreport's Used"""
+        return {row.Account: Decimal(row.SU).quantize(Decimal(1))
+                for row in self.project_totals().itertuples(index=False)}
+
+    def user_usage(self):
+        """Return dict (project, login): compute SU, as Decimal whole SU like sreport's Used"""
+        return {(row.Account, row.User): Decimal(row.SU).quantize(Decimal(1))
+                for row in self.user_totals().itertuples(index=False)}
+
+    def write_totals(self, totals_file):
+        """Write per-user totals, and per-account totals (with an empty User), to totals_file"""
+        totals_df = pd.concat([self.project_totals().assign(User=''), self.user_totals()])
+        totals_df = totals_df.sort_values(by=['Account', 'User'], kind='stable')
+
+        tmp_file = Path(f'{totals_file}.tmp')
+        totals_df[['Account', 'User', 'Jobs', 'SU', 'Charge ($)']].to_csv(tmp_file, float_format='%.6f', index=False)
+        os.replace(tmp_file, totals_file)
+
+        return totals_file
+
+
+def read_ledger(ledger_file, chunksize=job_stats.CHUNK_SIZE):
+    """Yield DataFrames of chunksize rows of a job charges ledger"""
+    yield from pd.read_csv(ledger_file, dtype={'JobID': str, 'Account': str, 'User': str, 'Partition': str},
+                           keep_default_na=False, chunksize=chunksize)
+
+
+def main():
+    global debug_p
+
+    parser = argparse.ArgumentParser(description='Charge each job of a month from its sacct record, and write the per-job ledger and totals')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debugging output')
+    parser.add_argument('-w', '--when', default=None,
+                        help='Month in format YYYY-MM (Default: last month)')
+    parser.add_argument('-r', '--reports-prefix', default='/ifs/sysadmin/RCM', help='Reports prefix directory')
+    parser.add_argument('--chunk-size', type=int, default=job_stats.CHUNK_SIZE,
+                        help=f'sacct records held in memory at a time (Default: {job_stats.CHUNK_SIZE})')
+    parser.add_argument('--job-cache', default=None,
+                        help='Read job records from this job cache directory instead of running sacct (see job_cache)')
+    parser.add_argument('--trace', action='store_true', help='Print latency and output size of each Slurm command')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    job_stats.debug_p = debug_p
+    job_cache.debug_p = debug_p
+    profiling.start('job_charges', args)
+
+    if args.when:
+        try:
+            year, month = (int(x) for x in args.when.split('-'))
+        except ValueError:
+            print(f'ERROR: job_charges: bad month {args.when}; expected YYYY-MM')
+            sys.exit(1)
+    else:
+        last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+        year, month = last_month.year, last_month.month
+
+    if debug_p:
+        reports_dir = Path(f'RCM/{year}-{month:02d}')
+    else:
+        reports_dir = Path(f'{args.reports_prefix}/{year}-{month:02d}')
+    os.makedirs(reports_dir, exist_ok=True)
+
+    if args.job_cache:
+        job_cache.cache = job_cache.JobCache(args.job_cache)
+
+    ledger_file = ledger_filename(reports_dir, year, month)
+    with profiling.stage('sacct'):
+        charges = JobCharges.from_sacct(year, month, ledger_file=ledger_file, chunksize=args.chunk_size)
+    with profiling.stage('write'):
+        totals_file = charges.write_totals(totals_filename(reports_dir, year, month))
+
+    project_totals = charges.project_totals()
+    print(f'job_charges: {charges.n_jobs:,} jobs of {len(project_totals)} accounts in {year}-{month:02d}: '
+          f'{project_totals["SU"].sum():,.2f} SU, $ {project_totals["Charge ($)"].sum():,.2f}')
+    print(f'job_charges: wrote {ledger_file}')
+    print(f'job_charges: wrote {totals_file}')
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(reports_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+import sys
+import os
+import datetime
+import argparse
+from pathlib import Path
+import pandas as pd
+
+from . import slurm_cli
+from . import job_stats
+from . import sacct_fields
+from . import job_cache
+from . import profiling
+
+# CPU and memory efficiency of the jobs which ended in a month.
+#
+#   CPU efficiency     TotalCPU / (Elapsed x AllocCPUS)
+#   Memory efficiency  peak MaxRSS of the job's steps / ReqMem
+#
+# Rolled up by account, by user and by partition as time-weighted ratios:
+# CPU-hours used over core-hours allocated, and GiB-hours used (peak RSS x
+# Elapsed) over GiB-hours requested. Wasted core-hours and GiB-hours are
+# the differences. The jobs wasting the most are listed too.
+#
+# The month's job records are streamed from one sacct query in chunks of
+# chunksize rows (see job_stats.iter_sacct_chunks()). A chunk is reduced to
+# one row per job, and then to running sums per rollup group and the top_n
+# worst jobs, before the next is read. The rows of a job whose steps run
+# on into the next chunk are carried over. Memory use is therefore bounded
+# by the chunk size, top_n, and the number of accounts, users and
+# partitions, not by the number of jobs.
+
+debug_p = False
+
+SACCT_FIELDS = ['JobID', 'Account', 'User', 'Partition', 'State', 'End', 'Elapsed', 'TotalCPU',
+                'AllocCPUS', 'NNodes', 'ReqMem', 'MaxRSS']
+
+ROLLUPS = {'account': ['Account'],
+           'user': ['Account', 'User'],
+           'partition': ['Partition']}
+
+SUM_COLUMNS = ['Jobs', 'Core-hours', 'CPU-hours used', 'Wasted core-hours',
+               'GiB-hours requested', 'GiB-hours used', 'Wasted GiB-hours']
+
+WORST_COLUMNS = ['JobID', 'Account', 'User', 'Partition', 'State', 'Elapsed (h)', 'AllocCPUS',
+                 'CPU efficiency (%)', 'ReqMem (GiB)', 'MaxRSS (GiB)', 'Memory efficiency (%)',
+                 'Wasted core-hours', 'Wasted GiB-hours']
+
+DEFAULT_TOP_N = 20
+
+# states of jobs which have not ended
+UNFINISHED_STATES = ['PENDING', 'RUNNING', 'SUSPENDED', 'REQUEUED', 'RESIZING']
+
+
+def efficiency_pct(used, total):
+    return (100. * used / total.where(total > 0)).round(1)
+
+
+class JobEfficiency:
+    """Efficiency rollups and worst jobs of a month, built chunk by chunk"""
+
+    def __init__(self, year, month, top_n=DEFAULT_TOP_N):
+        period_start, period_end = job_stats.billing_period(year, month)
+        self.period_start = pd.Timestamp(datetime.datetime.strptime(period_start, '%Y-%m-%d-%H:%M:%S'))
+        self.period_end = pd.Timestamp(datetime.datetime.strptime(period_end, '%Y-%m-%d-%H:%M:%S'))
+        self.top_n = top_n
+        self.sums = {name: None for name in ROLLUPS}
+        self.worst = {'Wasted core-hours': None, 'Wasted GiB-hours': None}
+        self.n_jobs = 0
+        self.carried = None
+
+    def add_chunk(self, chunk):
+        if self.carried is not None:
+            chunk = pd.concat([self.carried, chunk], ignore_index=True)
+
+        jobids = sacct_fields.decode_jobid(chunk['JobID'])
+        job_key = jobids.groupby(['JobIDBase', 'ArrayTaskID', 'HetJobOffset'], dropna=False, observed=True, sort=False).ngroup()
+
+        # a job's steps follow it, so only the last job may go on in the next chunk
+        last = job_key == job_key.iloc[-1]
+        self.carried = chunk[last]
+        self._add_jobs(chunk[~last], jobids[~last], job_key[~last])
+
+    def finish(self):
+        if self.carried is not None and not self.carried.empty:
+            chunk, self.carried = self.carried, None
+            jobids = sacct_fields.decode_jobid(chunk['JobID'])
+            self._add_jobs(chunk, jobids, pd.Series(0, index=chunk.index))
+
+    def _add_jobs(self, rows, jobids, job_key):
+        if rows.empty:
+            return
+
+        is_step = jobids['Step'].notna()
+        peak_rss = sacct_fields.decode_size(rows['MaxRSS'][is_step], unit='G').groupby(job_key[is_step]).max()
+
+        alloc = rows[~is_step]
+        end = sacct_fields.decode_timestamp(alloc['End'])
+        state = sacct_fields.decode_state(alloc['State'])
+        elapsed_h = sacct_fields.decode_duration(alloc['Elapsed']).dt.total_seconds() / 3600.
+
+        ended = (end >= self.period_start) & (end <= self.period_end) & ~state.isin(UNFINISHED_STATES) & (elapsed_h > 0)
+        if not ended.any():
+            return
+
+        alloc_cpus = pd.to_numeric(alloc['AllocCPUS'], errors='coerce')
+        req_gib = sacct_fields.decode_reqmem(alloc['ReqMem'], alloc['AllocCPUS'], alloc['NNodes'], unit='G')
+        max_rss_gib = job_key[~is_step].map(peak_rss)
+
+        jobs = pd.DataFrame({'JobID': alloc['JobID'],
+                             'Account': alloc['Account'],
+                             'User': alloc['User'],
+                             'Partition': alloc['Partition'],
+                             'State': state.astype(str),
+                             'Elapsed (h)': elapsed_h,
+                             'AllocCPUS': alloc_cpus,
+                             'ReqMem (GiB)': req_gib,
+                             'MaxRSS (GiB)': max_rss_gib})[ended]
+
+        jobs['Jobs'] = 1
+        jobs['Core-hours'] = jobs['Elapsed (h)'] * jobs['AllocCPUS']
+        jobs['CPU-hours used'] = sacct_fields.decode_duration(alloc['TotalCPU'][ended]).dt.total_seconds() / 3600.
+        jobs['Wasted core-hours'] = (jobs['Core-hours'] - jobs['CPU-hours used']).clip(lower=0.)
+
+        # jobs without a known peak RSS are left out of the memory figures
+        known = jobs['MaxRSS (GiB)'].notna() & jobs['ReqMem (GiB)'].notna()
+        jobs['GiB-hours requested'] = (jobs['ReqMem (GiB)'] * jobs['Elapsed (h)']).where(known, 0.)
+        jobs['GiB-hours used'] = (jobs['MaxRSS (GiB)'] * jobs['Elapsed (h)']).where(known, 0.)
+        jobs['Wasted GiB-hours'] = (jobs['GiB-hours requested'] - jobs['GiB-hours used']).clip(lower=0.)
+
+        jobs['CPU efficiency (%)'] = efficiency_pct(jobs['CPU-hours used'], jobs['Core-hours'])
+        jobs['Memory efficiency (%)'] = efficiency_pct(jobs['MaxRSS (GiB)'], jobs['ReqMem (GiB)'])
+
+        self.n_jobs += len(jobs)
+
+        for name, keys in ROLLUPS.items():
+            sums = jobs.groupby(keys)[SUM_COLUMNS].sum()
+            self.sums[name] = sums if self.sums[name] is None else self.sums[name].add(sums, fill_value=0.)
+
+        for column, worst in self.worst.items():
+            candidates = jobs[WORST_COLUMNS] if worst is None else pd.concat([worst, jobs[WORST_COLUMNS]])
+            self.worst[column] = candidates.nlargest(self.top_n, column)
+
+        if debug_p:
+            print(f'DEBUG: JobEfficiency._add_jobs(): {len(jobs)} jobs; {self.n_jobs} so far')
+
+    @classmethod
+    def from_sacct(cls, year, month, top_n=DEFAULT_TOP_N, chunksize=job_stats.CHUNK_SIZE):
+        efficiency = cls(year, month, top_n)
+        try:
+            # untruncated, so that Elapsed goes with TotalCPU
+            for chunk in job_stats.iter_sacct_chunks(year, month, chunksize=chunksize,
+                                                     fields=SACCT_FIELDS, truncate=False):
+                efficiency.add_chunk(chunk)
+            efficiency.finish()
+        except Exception as e:
+            print(f'EXCEPTION: JobEfficiency.from_sacct(): {type(e)} - {e}')
+            sys.exit(2)
+
+        return efficiency
+
+    def rollup(self, name):
+        """Return DataFrame of the rollup by name (account, user or partition), most wasteful first"""
+        keys = ROLLUPS[name]
+        if self.sums[name] is None:
+            return pd.DataFrame(columns=keys + SUM_COLUMNS + ['CPU efficiency (%)', 'Memory efficiency (%)'])
+
+        rollup_df = self.sums[name].reset_index()
+        rollup_df['Jobs'] = rollup_df['Jobs'].astype(int)
+        rollup_df['CPU efficiency (%)'] = efficiency_pct(rollup_df['CPU-hours used'], rollup_df['Core-hours'])
+        rollup_df['Memory efficiency (%)'] = efficiency_pct(rollup_df['GiB-hours used'], rollup_df['GiB-hours requested'])
+
+        return rollup_df.sort_values(by='Wasted core-hours', ascending=False, kind='stable')
+
+    def worst_jobs(self, column='Wasted core-hours'):
+        if self.worst[column] is None:
+            return pd.DataFrame(columns=WORST_COLUMNS)
+        return self.worst[column].reset_index(drop=True)
+
+
+def report_filename(reports_dir, year, month, what):
+    return Path(reports_dir) / f'job_efficiency_{year}{month:02d}_{what}.csv'
+
+
+def write_report(efficiency, reports_dir, year, month):
+    """Write rollup and worst-job CSVs to reports_dir; return list of paths"""
+    written = []
+    for name in ROLLUPS:
+        filename = report_filename(reports_dir, year, month, f'by_{name}')
+        efficiency.rollup(name).to_csv(filename, float_format='%.2f', index=False)
+        written.append(filename)
+
+    for what, column in (('worst_cpu', 'Wasted core-hours'), ('worst_memory', 'Wasted GiB-hours')):
+        filename = report_filename(reports_dir, year, month, what)
+        efficiency.worst_jobs(column).to_csv(filename, float_format='%.2f', index=False)
+        written.append(filename)
+
+    return written
+
+
+def read_account_efficiency(reports_dir, year, month):
+    """Return dict account: dict of efficiency figures for statements, from the
+    by-account report; None if there is no report for the month"""
+    filename = report_filename(reports_dir, year, month, 'by_account')
+    if not filename.exists():
+        return None
+
+    by_account = pd.read_csv(filename, dtype={'Account': str})
+    return {row['Account'].casefold(): {'jobs': int(row['Jobs']),
+                                        'core_hours': row['Core-hours'],
+                                        'cpu_efficiency': row['CPU efficiency (%)'],
+                                        'wasted_core_hours': row['Wasted core-hours'],
+                                        'mem_efficiency': row['Memory efficiency (%)'],
+                                        'wasted_gib_hours': row['Wasted GiB-hours']}
+            for _, row in by_account.iterrows()}
+
+
+def main():
+    global debug_p
+
+    parser = argparse.ArgumentParser(description='CPU and memory efficiency of the jobs of a month, by account, user and partition')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debugging output')
+    parser.add_argument('-w', '--when', default=None,
+                        help='Month in format YYYY-MM (Default: last month)')
+    parser.add_argument('-r', '--reports-prefix', default='/ifs/sysadmin/RCM', help='Reports prefix directory')
+    parser.add_argument('-n', '--top', type=int, default=DEFAULT_TOP_N,
+                        help=f'Number of most wasteful jobs to list (Default: {DEFAULT_TOP_N})')
+    parser.add_argument('--chunk-size', type=int, default=job_stats.CHUNK_SIZE,
+                        help=f'sacct records held in memory at a time (Default: {job_stats.CHUNK_SIZE})')
+    parser.add_argument('--job-cache', default=None,
+                        help='Read job records from this job cache directory instead of running sacct (see job_cache)')
+    parser.add_argument('--trace', action='store_true', help='Print latency and output size of each Slurm command')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    job_stats.debug_p = debug_p
+    job_cache.debug_p = debug_p
+    profiling.start('job_efficiency_report', args)
+
+    if args.when:
+        try:
+            year, month = (int(x) for x in args.when.split('-'))
+        except ValueError:
+            print(f'ERROR: job_efficiency_report: bad month {args.when}; expected YYYY-MM')
+            sys.exit(1)
+    else:
+        last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+        year, month = last_month.year, last_month.month
+
+    if debug_p:
+        reports_dir = Path(f'RCM/{year}-{month:02d}')
+    else:
+        reports_dir = Path(f'{args.reports_prefix}/{year}-{month:02d}')
+    os.makedirs(reports_dir, exist_ok=True)
+
+    if args.job_cache:
+        job_cache.cache = job_cache.JobCache(args.job_cache)
+
+    with profiling.stage('sacct'):
+        efficiency = JobEfficiency.from_sacct(year, month, top_n=args.top, chunksize=args.chunk_size)
+    with profiling.stage('write'):
+        written = write_report(efficiency, reports_dir, year, month)
+
+    print(f'job_efficiency_report: {efficiency.n_jobs:,} jobs ended in {year}-{month:02d}')
+    for name in ROLLUPS:
+        rollup_df = efficiency.rollup(name)
+        print(f'\nBy {name} (most wasted core-hours first):')
+        print(rollup_df.head(args.top).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+    for column in efficiency.worst:
+        print(f'\nJobs with the most {column}:')
+        print(efficiency.worst_jobs(column).to_string(index=False, float_format=lambda x: f'{x:.1f}'))
+
+    print()
+    for filename in written:
+        print(f'job_efficiency_report: wrote {filename}')
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(reports_dir)
+
+
+if __name__ == '__main__':
+    main()
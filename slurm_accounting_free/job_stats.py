@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import sys
+import csv
+import calendar
+import pandas as pd
+
+from . import slurm_cli
+from . import sacct_fields
+from . import quantile_sketch
+from . import job_cache
+from . import progress
+
+# Job statistics for all projects from one sacct query.
+#
+# The month's job records for all accounts are streamed from a single
+# sacct pipe and read in chunks of CHUNK_SIZE rows. Each chunk is reduced
+# to per-account counts, sums, minima and maxima, and added to per-account
+# quantile sketches (see quantile_sketch) for the median and quartiles.
+# These are merged into a JobStatsTable; no more than one chunk is ever in
+# memory, and each sketch has a bounded size. Tables of separate chunks of
+# the month can be merged too. The table then
+# gives every statement its job statistics, in the form make_job_stats()
+# in __main__ used to compute with one sacct query per project:
+#
+#   {'n_jobs': int, 'pct_completed': float,
+#    'completed': {'n': int,
+#                  'rows': [{'field', 'min', 'q1', 'median', 'q3', 'max', 'mean'}, ...]},
+#    'incomplete': {'n': int, 'rows': [...]}}
+#
+# As before, n_jobs counts all job and step records of the project, while
+# the completed/incomplete statistics come from the .batch steps.
+
+debug_p = False
+
+SACCT_FIELDS = ['JobID', 'Account', 'State', 'Submit', 'Start', 'Elapsed', 'MaxVMSize']
+
+STAT_FIELDS = ['Wait time', 'Wallclock', 'Virtual memory (GiB)']
+GROUPS = ['completed', 'incomplete']
+TIME_FIELDS = ['Wait time', 'Wallclock']
+
+QUANTILES = {'q1': 0.25, 'median': 0.5, 'q3': 0.75}
+
+CHUNK_SIZE = 100000
+
+
+def billing_period(year, month):
+    """Return (start, end) of the month in sacct's -S/-E format"""
+    last_day = calendar.monthrange(year, month)[1]
+    return f'{year}-{month:02d}-01-00:00:00', f'{year}-{month:02d}-{last_day:02d}-23:59:59'
+
+
+def iter_sacct_chunks(year, month, accounts=None, chunksize=CHUNK_SIZE, fields=SACCT_FIELDS, truncate=True, allocations=False):
+    """Yield DataFrames of chunksize sacct records (all columns str) for the month
+
+    All accounts are queried unless accounts, a list of account names, is
+    given. With truncate, start/end times and Elapsed are cut off at the
+    month's boundaries (sacct -T). With allocations, only the jobs' own
+    records are listed, not their steps (sacct -X).
+
+    If job_cache.cache is set, the records are read from the cache instead.
+    """
+    tracker = progress.Progress('sacct', unit='records')
+    for chunk in _iter_sacct_chunks(year, month, accounts, chunksize, fields, truncate, allocations):
+        tracker.update(len(chunk))
+        yield chunk
+    tracker.done()
+
+
+def _iter_sacct_chunks(year, month, accounts, chunksize, fields, truncate, allocations):
+    if job_cache.cache is not None:
+        if debug_p:
+            print(f'DEBUG: iter_sacct_chunks(): reading from job cache {job_cache.cache.cache_dir}', flush=True)
+        yield from job_cache.cache.iter_chunks(year, month, accounts=accounts, chunksize=chunksize, fields=fields,
+                                               truncate=truncate, allocations=allocations)
+        return
+
+    period_start, period_end = billing_period(year, month)
+
+    sacct_cmdline = ['sacct', '-P', '-o', ','.join(fields)]
+    if truncate:
+        sacct_cmdline.append('-T')
+    if allocations:
+        sacct_cmdline.append('-X')
+    sacct_cmdline += [f'-S{period_start}', f'-E{period_end}', '-a']
+    if accounts:
+        sacct_cmdline += ['-A', ','.join(accounts)]
+
+    if debug_p:
+        print(f'DEBUG: iter_sacct_chunks(): sacct_cmdline = {sacct_cmdline}', flush=True)
+
+    csv.register_dialect('sacct', delimiter='|')
+
+    with slurm_cli.runner.stream(sacct_cmdline, check=False) as sacct_output:
+        # keep_default_na=False: decoding decides what an empty field means
+        yield from pd.read_csv(sacct_output.stdout, dialect='sacct', dtype=str,
+                               keep_default_na=False, chunksize=chunksize)
+
+    if sacct_output.returncode != 0:
+        print(f'WARNING: sacct return code = {sacct_output.returncode}')
+        print(f'    {sacct_output.stderr}')
+
+    if debug_p:
+        print(f'DEBUG: iter_sacct_chunks(): sacct output = {sacct_output.counter.nbytes} bytes')
+
+
+def chunk_stats_frame(chunk):
+    """Return DataFrame of the statistics fields of the .batch steps in chunk,
+    with Account and Group (completed or incomplete) columns"""
+    batch = chunk[chunk['JobID'].str.endswith('.batch')]
+
+    completed = sacct_fields.decode_state(batch['State']) == 'COMPLETED'
+
+    # a step without MaxVMSize counts as 0 GiB
+    return pd.DataFrame({'Account': batch['Account'].str.casefold(),
+                         'Group': completed.map({True: 'completed', False: 'incomplete'}),
+                         'Wait time': sacct_fields.decode_timestamp(batch['Start']) - sacct_fields.decode_timestamp(batch['Submit']),
+                         'Wallclock': sacct_fields.decode_duration(batch['Elapsed']),
+                         'Virtual memory (GiB)': sacct_fields.decode_size(batch['MaxVMSize'], unit='G').fillna(0.)})
+
+
+class JobStatsTable:
+    """Job counts and min/max/mean statistics per account, built chunk by chunk"""
+
+    def __init__(self):
+        self.n_records = {}   # account: number of job and step records
+        self.n_jobs = {}      # (account, group): number of .batch steps
+        self.stats = {}       # (account, group, field): [count, sum, min, max]
+        self.sketches = {}    # (account, group, field): QuantileSketch, of seconds for times
+        self.n_chunks = 0
+
+    def add_chunk(self, chunk):
+        self.n_chunks += 1
+
+        for account, n in chunk['Account'].str.casefold().value_counts().items():
+            self.n_records[account] = self.n_records.get(account, 0) + n
+
+        stats_df = chunk_stats_frame(chunk)
+        if stats_df.empty:
+            return
+
+        grouped = stats_df.groupby(['Account', 'Group'])
+        for (account, group), n in grouped.size().items():
+            self.n_jobs[(account, group)] = self.n_jobs.get((account, group), 0) + n
+
+        # count, sum, min, max skip missing values, e.g. a step which never started
+        agg_df = grouped[STAT_FIELDS].agg(['count', 'sum', 'min', 'max'])
+        for (account, group), row in agg_df.iterrows():
+            for field in STAT_FIELDS:
+                count, total, lo, hi = (row[(field, s)] for s in ('count', 'sum', 'min', 'max'))
+                if count == 0:
+                    continue
+
+                acc = self.stats.get((account, group, field))
+                if acc is None:
+                    self.stats[(account, group, field)] = [count, total, lo, hi]
+                else:
+                    acc[0] += count
+                    acc[1] += total
+                    acc[2] = min(acc[2], lo)
+                    acc[3] = max(acc[3], hi)
+
+        for (account, group), group_df in grouped:
+            for field in STAT_FIELDS:
+                values = group_df[field]
+                if field in TIME_FIELDS:
+                    values = values.dt.total_seconds()
+                sketch = self.sketches.setdefault((account, group, field), quantile_sketch.QuantileSketch())
+                sketch.add(values.to_numpy(dtype='float64', na_value=float('nan')))
+
+    def merge(self, other):
+        """Add the jobs of other, a JobStatsTable of other records, e.g. another part of the month"""
+        self.n_chunks += other.n_chunks
+
+        for account, n in other.n_records.items():
+            self.n_records[account] = self.n_records.get(account, 0) + n
+
+        for key, n in other.n_jobs.items():
+            self.n_jobs[key] = self.n_jobs.get(key, 0) + n
+
+        for key, (count, total, lo, hi) in other.stats.items():
+            acc = self.stats.get(key)
+            if acc is None:
+                self.stats[key] = [count, total, lo, hi]
+            else:
+                acc[0] += count
+                acc[1] += total
+                acc[2] = min(acc[2], lo)
+                acc[3] = max(acc[3], hi)
+
+        for key, sketch in other.sketches.items():
+            self.sketches.setdefault(key, quantile_sketch.QuantileSketch()).merge(sketch)
+
+    @classmethod
+    def from_sacct(cls, year, month, accounts=None, chunksize=CHUNK_SIZE):
+        table = cls()
+        try:
+            for chunk in iter_sacct_chunks(year, month, accounts=accounts, chunksize=chunksize):
+                table.add_chunk(chunk)
+        except Exception as e:
+            print(f'EXCEPTION: JobStatsTable.from_sacct(): {type(e)} - {e}')
+            sys.exit(2)
+
+        if debug_p:
+            print(f'DEBUG: JobStatsTable.from_sacct(): {sum(table.n_records.values())} records of {len(table.n_records)} accounts in {table.n_chunks} chunks')
+
+        return table
+
+    def job_stats(self, project):
+        """Return job statistics dict of project, for its statement"""
+        account = project.casefold()
+
+        job_stats = {'n_jobs': 0, 'pct_completed': 0.,
+                     'completed': {'n': 0, 'rows': []},
+                     'incomplete': {'n': 0, 'rows': []}}
+
+        n_jobs = self.n_records.get(account, 0)
+        job_stats['n_jobs'] = n_jobs
+        if n_jobs == 0:
+            return job_stats
+
+        job_stats['pct_completed'] = 100. * float(self.n_jobs.get((account, 'completed'), 0)) / float(n_jobs)
+
+        for group in GROUPS:
+            n = self.n_jobs.get((account, group), 0)
+            job_stats[group]['n'] = n
+            if n > 0:
+                rows = []
+                for field in STAT_FIELDS:
+                    count, total, lo, hi = self.stats.get((account, group, field), (0, None, None, None))
+                    mean = total / count if count else None
+                    if isinstance(mean, pd.Timedelta):
+                        # to the microsecond, as on earlier statements
+                        mean = mean.floor('us')
+                    row = {'field': field, 'min': lo, 'max': hi, 'mean': mean}
+
+                    # to within quantile_sketch.DEFAULT_RELATIVE_ACCURACY
+                    sketch = self.sketches.get((account, group, field))
+                    for name, q in QUANTILES.items():
+                        value = sketch.quantile(q) if sketch is not None else None
+                        if value is not None and field in TIME_FIELDS:
+                            value = pd.Timedelta(seconds=value).round('s')
+                        row[name] = value
+
+                    rows.append(row)
+                job_stats[group]['rows'] = rows
+
+        return job_stats
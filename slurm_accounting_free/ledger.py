@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import os
+import decimal
+from decimal import Decimal
+from pathlib import Path
+import pandas as pd
+
+# Fiscal-year-to-date charges per project.
+#
+# FiscalYearLedger holds the compute and storage charges of every project
+# summed over the earlier months of the fiscal year, so that each
+# statement's YTD lookup is a dict lookup.
+#
+# Months come from the persistent ledger file, which has one row per
+# project per month and is updated by update_ledger_file() once a month's
+# charge summary is written. Months missing from it (e.g. before the
+# ledger existed) are read from that month's charges CSV, once per run.
+
+debug_p = False
+
+LEDGER_FILENAME = 'mycluster_charges_ledger.csv'
+LEDGER_FIELDS = ['Month', 'Project', 'CPU charge ($)', 'Storage charge ($)']
+
+penny = Decimal('0.01')
+decimal.getcontext().rounding = decimal.ROUND_HALF_UP
+
+
+class FiscalYearLedger:
+    """Charges per project summed over earlier months of the fiscal year"""
+
+    def __init__(self):
+        self.charges = {}     # project: [compute charge, storage charge]
+        self.months = []      # YYYYMM strings included
+
+    def add_month(self, yyyymm, month_df):
+        """Add one month of charges; month_df has Project, CPU charge ($) and Storage charge ($)"""
+        # only the first row for each project counts, as in the monthly reports
+        month_df = month_df.drop_duplicates(subset='Project', keep='first')
+        for project, cpu, storage in zip(month_df['Project'], month_df['CPU charge ($)'], month_df['Storage charge ($)']):
+            charges = self.charges.setdefault(project, [Decimal(0), Decimal(0)])
+            charges[0] += Decimal(cpu).quantize(penny)
+            charges[1] += Decimal(storage).quantize(penny)
+
+        self.months.append(yyyymm)
+
+    def ytd(self, project):
+        """Return (compute charge, storage charge) of project for the months in the ledger"""
+        compute, storage = self.charges.get(project, (Decimal(0), Decimal(0)))
+        return compute, storage
+
+    @classmethod
+    def load(cls, monthly_reports, ledger_file=None):
+        """monthly_reports is a dict YYYYMM: path of that month's charges CSV"""
+        ledger = cls()
+
+        ledger_df = None
+        if ledger_file is not None and Path(ledger_file).exists():
+            ledger_df = read_ledger_file(ledger_file)
+
+        for yyyymm, report in monthly_reports.items():
+            if ledger_df is not None and (ledger_df['Month'] == yyyymm).any():
+                if debug_p:
+                    print(f'DEBUG: FiscalYearLedger.load(): {yyyymm} from {ledger_file}')
+                ledger.add_month(yyyymm, ledger_df[ledger_df['Month'] == yyyymm])
+            elif Path(report).exists():
+                if debug_p:
+                    print(f'DEBUG: FiscalYearLedger.load(): {yyyymm} from {report}')
+                month_df = pd.read_csv(report, encoding='ISO-8859-1',
+                                       usecols=['Project', 'CPU charge ($)', 'Storage charge ($)'])
+                ledger.add_month(yyyymm, month_df)
+            elif debug_p:
+                print(f'DEBUG: FiscalYearLedger.load(): no charges for {yyyymm}')
+
+        return ledger
+
+
+def read_ledger_file(ledger_file):
+    return pd.read_csv(ledger_file, dtype={'Month': 'string', 'Project': 'string'})
+
+
+def update_ledger_file(ledger_file, yyyymm, summary_df):
+    """Replace the rows for month yyyymm in the ledger with the charges in summary_df"""
+    month_df = summary_df[['Project', 'CPU charge ($)', 'Storage charge ($)']].copy()
+    month_df.insert(0, 'Month', yyyymm)
+
+    if Path(ledger_file).exists():
+        ledger_df = read_ledger_file(ledger_file)
+        ledger_df = pd.concat([ledger_df[ledger_df['Month'] != yyyymm], month_df])
+    else:
+        ledger_df = month_df
+
+    ledger_df = ledger_df.sort_values(by=['Month', 'Project'], kind='stable')
+
+    # write-then-rename so an interrupted run cannot leave a truncated ledger
+    tmp_file = Path(ledger_file).with_suffix('.tmp')
+    ledger_df[LEDGER_FIELDS].to_csv(tmp_file, float_format='%.2f', index=False)
+    os.replace(tmp_file, ledger_file)
+
+    return ledger_file
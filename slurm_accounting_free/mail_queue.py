@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import sys
+import time
+import queue
+import smtplib
+import threading
+from dataclasses import dataclass
+
+from . import profiling
+from . import progress
+
+# Email delivery queue.
+#
+# Messages are submitted from the main thread and sent by worker threads,
+# so sending overlaps with whatever the main thread does next (e.g.
+# rendering more statements). Each worker:
+# * reuses one SMTP connection, reconnecting only when it is lost
+# * paces messages with a token bucket shared by all workers: up to burst
+#   messages at once, then rate messages per minute
+# * retries transient failures (lost connection, 4xx replies) with
+#   exponential backoff
+#
+# To try it without a real mail server, run a local SMTP stand-in, e.g.
+#     python -m aiosmtpd -n -l localhost:8025
+# and point MailQueue at localhost port 8025.
+
+debug_p = False
+
+DEFAULT_SMTP_SERVER = 'smtp.example.com'
+DEFAULT_SMTP_PORT = 25
+DEFAULT_RATE = 30.        # messages per minute
+DEFAULT_BURST = 5         # messages
+DEFAULT_RETRIES = 3       # retries after the first attempt
+DEFAULT_BACKOFF = 5.      # seconds; doubled after every failed attempt
+SMTP_TIMEOUT = 60.        # seconds
+
+
+class TokenBucket:
+    """Allow burst events at once, refilled at rate events per second"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until an event is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+
+                if self.tokens >= 1.:
+                    self.tokens -= 1.
+                    return
+
+                wait = (1. - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def is_transient_smtp_error(e):
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+
+    # lost or refused connection, timeouts
+    return isinstance(e, (smtplib.SMTPServerDisconnected, OSError))
+
+
+@dataclass
+class MailResult:
+    description: str
+    sent: bool
+    attempts: int
+    error: str = ''
+
+
+class MailQueue:
+    """Send email messages from worker threads, each over one SMTP connection"""
+
+    def __init__(self, server=DEFAULT_SMTP_SERVER, port=DEFAULT_SMTP_PORT,
+                 rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, workers=1):
+        self.server = server
+        self.port = port
+        self.bucket = TokenBucket(rate / 60., burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.workers = workers
+        self.results = []
+        self.connections = 0
+        self.progress = progress.Progress('email', total=0, unit='emails')
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name=f'MailQueue-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, msg, description=None, on_sent=None, on_failed=None):
+        """Queue msg for sending
+
+        on_sent(result) or on_failed(result) is called from a worker thread
+        once the message has been sent or has finally failed.
+        """
+        if description is None:
+            description = msg['To']
+        self.progress.add_total()
+        self._queue.put((msg, description, on_sent, on_failed))
+
+    def close(self):
+        """Wait until all queued messages have been sent or have failed; return list of MailResult"""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.progress.done()
+
+        return self.results
+
+    def _connect(self):
+        smtp = smtplib.SMTP(self.server, self.port, timeout=SMTP_TIMEOUT)
+        with self._lock:
+            self.connections += 1
+
+        if debug_p:
+            print(f'DEBUG: MailQueue: {threading.current_thread().name} connected to {self.server}:{self.port}', flush=True)
+
+        return smtp
+
+    def _disconnect(self, smtp):
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    def _send(self, smtp, msg, description):
+        """Send msg, reconnecting and retrying as needed; return (MailResult, connection or None)"""
+        delay = self.backoff
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                if smtp is None:
+                    smtp = self._connect()
+                smtp.send_message(msg)
+                return MailResult(description, True, attempts), smtp
+            except Exception as e:
+                transient = is_transient_smtp_error(e)
+
+                # the connection may be unusable after any failure
+                self._disconnect(smtp)
+                smtp = None
+
+                if not transient or attempts > self.retries:
+                    return MailResult(description, False, attempts, f'{type(e).__name__}: {e}'), smtp
+
+                print(f'WARNING: MailQueue: {description} - transient failure (attempt {attempts}): {e}; retrying in {delay:.1f} s', flush=True)
+                time.sleep(delay)
+                delay *= 2.
+
+    def _worker(self):
+        smtp = None
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+
+                msg, description, on_sent, on_failed = item
+                self.bucket.acquire()
+                with profiling.stage('email', description):
+                    result, smtp = self._send(smtp, msg, description)
+                self.results.append(result)
+                self.progress.update()
+
+                if result.sent:
+                    print(f'Sent email to {description}', flush=True)
+                    callback = on_sent
+                else:
+                    print(f'ERROR: MailQueue: {description} - not sent after {result.attempts} attempts: {result.error}', flush=True)
+                    callback = on_failed
+
+                if callback is not None:
+                    try:
+                        callback(result)
+                    except Exception as e:
+                        print(f'ERROR: MailQueue: {description} - {type(e).__name__}: {e}', flush=True)
+        finally:
+            self._disconnect(smtp)
+
+    def print_summary(self, file=sys.stdout):
+        n_sent = sum(r.sent for r in self.results)
+        n_retried = sum(r.attempts > 1 for r in self.results)
+        print(f'Email: {n_sent} of {len(self.results)} messages sent over {self.connections} SMTP connections; {n_retried} needed retries', file=file)
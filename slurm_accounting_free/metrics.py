@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+import os
+import re
+import time
+import atexit
+import threading
+from pathlib import Path
+
+from . import profiling
+
+# Metrics of a run for Prometheus, in the node exporter's textfile format.
+#
+# With --metrics-dir DIR (the node exporter's --collector.textfile.directory),
+# a run writes DIR/slurm_accounting_{job}.prom when it starts, as its stages
+# make progress (see progress.py), and when it ends. The file is written to
+# a temporary file and renamed, so the exporter never reads half of it.
+#
+# Every metric has a job label, the name of the command:
+#
+#   slurm_accounting_run_in_progress                     1 while the job runs
+#   slurm_accounting_run_start_timestamp_seconds         start of this (or the last) run
+#   slurm_accounting_run_duration_seconds                so far, or of the last run
+#   slurm_accounting_run_success                         1 if the last run succeeded
+#   slurm_accounting_run_end_timestamp_seconds           end of the last run
+#   slurm_accounting_run_last_success_timestamp_seconds  end of the last successful run
+#   slurm_accounting_stage_duration_seconds{stage}       wall time of stages done
+#   slurm_accounting_stage_cpu_seconds{stage}            CPU time of stages done
+#   slurm_accounting_progress_items{stage}               items done (statements, emails, ...)
+#   slurm_accounting_progress_items_expected{stage}      items to do, if known
+#   slurm_accounting_progress_rate_per_minute{stage}     items done per minute
+#
+# Stage times come from the profiling stages (see profiling.py), which are
+# recorded, though not written out, whenever metrics are. The results of the
+# last run are kept in the file while the next one runs, and the time of the
+# last success is kept through failed runs, so that alerts on them hold.
+#
+# A run which exits without calling finish(), e.g. on an exception or after
+# an ERROR, is recorded as failed.
+
+debug_p = False
+
+PREFIX = 'slurm_accounting'
+
+MIN_WRITE_INTERVAL = 5.   # seconds between rewrites of the file while running
+
+# kept from the file of the last run
+KEPT_METRICS = ('run_start_timestamp_seconds', 'run_duration_seconds', 'run_success',
+                'run_end_timestamp_seconds', 'run_last_success_timestamp_seconds')
+
+HELP = {
+    'run_in_progress': 'Whether the job is running',
+    'run_start_timestamp_seconds': 'Start time of the current or last run',
+    'run_duration_seconds': 'Duration of the current run so far, or of the last run',
+    'run_success': 'Whether the last run succeeded',
+    'run_end_timestamp_seconds': 'End time of the last run',
+    'run_last_success_timestamp_seconds': 'End time of the last successful run',
+    'stage_duration_seconds': 'Wall time of the stages of the run done so far',
+    'stage_cpu_seconds': 'CPU time of the stages of the run done so far',
+    'progress_items': 'Items done by a stage so far',
+    'progress_items_expected': 'Items a stage has to do',
+    'progress_rate_per_minute': 'Items done by a stage per minute',
+}
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_value(value):
+    return f'{value:.3f}' if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Metrics of one run of job, written to textfile_dir"""
+
+    def __init__(self, job, textfile_dir):
+        self.job = job
+        self.path = Path(textfile_dir) / f'{PREFIX}_{job}.prom'
+        self.started = time.time()
+        self.tic = time.monotonic()
+        self.progress = {}    # stage: (count, total, rate)
+        self.finished = False
+        self.last_write = 0.
+        self.kept = self.read_kept()
+        self._lock = threading.Lock()
+
+    def read_kept(self):
+        """Return dict of the KEPT_METRICS in the file of the last run"""
+        kept = {}
+        if not self.path.exists():
+            return kept
+
+        pat = re.compile(rf'^{PREFIX}_(\w+)\{{job="{re.escape(escape_label(self.job))}"\}} (\S+)$')
+        with open(self.path) as f:
+            for line in f:
+                m = pat.match(line.strip())
+                if m and m.group(1) in KEPT_METRICS:
+                    try:
+                        kept[m.group(1)] = float(m.group(2))
+                    except ValueError:
+                        pass
+
+        if debug_p:
+            print(f'DEBUG: Metrics.read_kept(): {kept}')
+
+        return kept
+
+    def update_progress(self, stage, count, total, rate):
+        with self._lock:
+            self.progress[stage] = (count, total, rate)
+        self.write()
+
+    def samples(self, success=None):
+        """Return list of (name, labels dict, value)"""
+        job = {'job': self.job}
+        duration = time.monotonic() - self.tic
+
+        if success is None:
+            values = dict(self.kept)
+            values.update({'run_in_progress': 1, 'run_start_timestamp_seconds': self.started,
+                           'run_duration_seconds': duration})
+        else:
+            now = time.time()
+            values = {'run_in_progress': 0, 'run_start_timestamp_seconds': self.started,
+                      'run_duration_seconds': duration, 'run_success': int(success),
+                      'run_end_timestamp_seconds': now}
+            if success:
+                values['run_last_success_timestamp_seconds'] = now
+            elif 'run_last_success_timestamp_seconds' in self.kept:
+                values['run_last_success_timestamp_seconds'] = self.kept['run_last_success_timestamp_seconds']
+
+        samples = [(name, job, value) for name, value in values.items()]
+
+        if profiling.profiler is not None:
+            for stage, total in profiling.profiler.stage_totals().items():
+                samples.append(('stage_duration_seconds', {**job, 'stage': stage}, total['wall']))
+                samples.append(('stage_cpu_seconds', {**job, 'stage': stage}, total['cpu'] + total['child_cpu']))
+
+        with self._lock:
+            progress = dict(self.progress)
+        for stage, (count, total, rate) in progress.items():
+            samples.append(('progress_items', {**job, 'stage': stage}, count))
+            if total is not None:
+                samples.append(('progress_items_expected', {**job, 'stage': stage}, total))
+            samples.append(('progress_rate_per_minute', {**job, 'stage': stage}, rate))
+
+        return samples
+
+    def format(self, success=None):
+        lines = []
+        seen = set()
+        for name, labels, value in sorted(self.samples(success), key=lambda s: list(HELP).index(s[0])):
+            if name not in seen:
+                lines.append(f'# HELP {PREFIX}_{name} {HELP[name]}')
+                lines.append(f'# TYPE {PREFIX}_{name} gauge')
+                seen.add(name)
+            label_str = ','.join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+            lines.append(f'{PREFIX}_{name}{{{label_str}}} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, success=None, force=False):
+        """Write the file; while running, at most every MIN_WRITE_INTERVAL seconds unless forced"""
+        with self._lock:
+            if self.finished:
+                return
+            now = time.monotonic()
+            if success is None and not force and now - self.last_write < MIN_WRITE_INTERVAL:
+                return
+            self.last_write = now
+            if success is not None:
+                self.finished = True
+
+        text = self.format(success)
+
+        try:
+            os.makedirs(self.path.parent, exist_ok=True)
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                f.write(text)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            # metrics are not worth failing a run over
+            print(f'WARNING: Metrics: cannot write {self.path}: {e}')
+
+
+# set by start() with --metrics-dir
+run_metrics = None
+
+
+def add_arguments(parser):
+    """Add --metrics-dir to an entry point's parser"""
+    parser.add_argument('--metrics-dir', default=None,
+                        help='Write Prometheus metrics of the run to this directory, e.g. the node exporter\'s textfile collector directory')
+
+
+def start(job, args):
+    """Start recording metrics of the run of job if args ask for it; return the Metrics or None
+
+    Call after profiling.start(), so that --profile options are kept.
+    """
+    global run_metrics
+
+    if args.metrics_dir is None:
+        return None
+
+    if profiling.profiler is None:
+        profiling.profiler = profiling.Profiler(job, write_files=False)
+
+    run_metrics = Metrics(job, args.metrics_dir)
+    run_metrics.write(force=True)
+    atexit.register(_exit)
+
+    return run_metrics
+
+
+def update_progress(stage, count, total, rate):
+    if run_metrics is not None:
+        run_metrics.update_progress(stage, count, total, rate)
+
+
+def refresh():
+    """Rewrite the file while running, e.g. when a stage is done"""
+    if run_metrics is not None:
+        run_metrics.write()
+
+
+def finish(success=True):
+    """Record the end of the run"""
+    if run_metrics is not None:
+        run_metrics.write(success=success)
+
+
+def _exit():
+    # the run ended without finish()
+    if run_metrics is not None and not run_metrics.finished:
+        run_metrics.write(success=False)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import email
+import datetime
+import argparse
+import threading
+from pathlib import Path
+
+from . import mail_queue
+from . import profiling
+
+# Durable outbox for statement and summary emails.
+#
+# Finished MIME messages are spooled to disk before they are sent, each as
+#     {key}.eml    the message
+#     {key}.json   its state: {'key', 'description', 'fingerprint',
+#                               'status': 'pending' | 'sent' | 'failed',
+#                               'created', 'attempts', 'sent', 'error'}
+# Keys name what the message is for, e.g. statement_smithprj_202312, so a
+# rerun finds the messages of the earlier run. A message is only replaced
+# when its content fingerprint changes (e.g. the statement was
+# re-rendered with different numbers); otherwise, once sent, it is never
+# sent again.
+#
+# slurm_accounting_free sends spooled messages as it goes. If the run dies,
+# "drain_outbox" (or the next run) sends whatever is still pending.
+
+debug_p = False
+
+
+def now_str():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class Outbox:
+    """On-disk spool of email messages with per-message delivery state
+
+    If queue (a mail_queue.MailQueue) is given, posted messages are sent
+    through it right away; otherwise they stay pending until drained.
+    """
+
+    def __init__(self, spool_dir, queue=None):
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.queue = queue
+        self.submitted = set()     # keys submitted for sending in this process
+        self._lock = threading.Lock()
+
+    def message_path(self, key):
+        return self.spool_dir / f'{key}.eml'
+
+    def state_path(self, key):
+        return self.spool_dir / f'{key}.json'
+
+    def read_state(self, key):
+        try:
+            with open(self.state_path(key), 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def write_state(self, key, state):
+        # write-then-rename so an interrupted run cannot leave a truncated state
+        state_path = self.state_path(key)
+        tmp_path = state_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, state_path)
+
+    def keys(self):
+        return sorted(p.stem for p in self.spool_dir.glob('*.json'))
+
+    def add(self, key, msg, description, fingerprint=None):
+        """Spool msg under key; return True if it needs sending
+
+        An existing message under key is kept if it has the same fingerprint,
+        so a message which was already sent is not sent again.
+        """
+        state = self.read_state(key)
+        if state is not None and state.get('fingerprint') == fingerprint and self.message_path(key).exists():
+            if debug_p:
+                print(f'DEBUG: Outbox.add(): {key} already spooled, status {state["status"]}')
+            return state['status'] != 'sent'
+
+        # message first, then state: a state file always has its message
+        message_path = self.message_path(key)
+        tmp_path = message_path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(msg.as_bytes())
+        os.replace(tmp_path, message_path)
+
+        self.write_state(key, {'key': key,
+                               'description': description,
+                               'fingerprint': fingerprint,
+                               'status': 'pending',
+                               'created': now_str(),
+                               'attempts': 0,
+                               'sent': None,
+                               'error': ''})
+        return True
+
+    def load_message(self, key):
+        with open(self.message_path(key), 'rb') as f:
+            return email.message_from_binary_file(f)
+
+    def pending(self, retry_failed=False):
+        """Return keys of messages not yet sent"""
+        statuses = ('pending', 'failed') if retry_failed else ('pending',)
+        return [k for k in self.keys() if (self.read_state(k) or {}).get('status') in statuses]
+
+    def record_result(self, key, result):
+        with self._lock:
+            state = self.read_state(key)
+            state['attempts'] += result.attempts
+            if result.sent:
+                state['status'] = 'sent'
+                state['sent'] = now_str()
+                state['error'] = ''
+            else:
+                state['status'] = 'failed'
+                state['error'] = result.error
+            self.write_state(key, state)
+
+    def post(self, key, msg, description, fingerprint=None, on_sent=None):
+        """Spool msg and send it if there is a queue; return 'queued', 'spooled' or 'already sent'"""
+        if not self.add(key, msg, description, fingerprint):
+            return 'already sent'
+
+        if self.queue is None:
+            return 'spooled'
+
+        self.send(key, on_sent)
+        return 'queued'
+
+    def send(self, key, on_sent=None):
+        """Submit spooled message key to the queue; record the outcome in its state"""
+        state = self.read_state(key)
+
+        def sent(result):
+            self.record_result(key, result)
+            if on_sent is not None:
+                on_sent(result)
+
+        self.submitted.add(key)
+        self.queue.submit(self.load_message(key), description=state['description'],
+                          on_sent=sent, on_failed=lambda result: self.record_result(key, result))
+
+    def drain(self, retry_failed=False):
+        """Submit all unsent messages not already submitted by this process; return their number"""
+        keys = [k for k in self.pending(retry_failed) if k not in self.submitted]
+        for key in keys:
+            self.send(key)
+
+        return len(keys)
+
+    def print_status(self, file=sys.stdout):
+        for key in self.keys():
+            state = self.read_state(key) or {}
+            print(f'    {state.get("status", "?"):<8} {state.get("attempts", 0):>3}  {state.get("sent") or "":<19}  {key}  {state.get("error", "")}', file=file)
+
+
+def main():
+    global debug_p
+
+    parser = argparse.ArgumentParser(description='Send the unsent messages in a statement email outbox')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debugging output')
+    parser.add_argument('-o', '--outbox', required=True,
+                        help='Outbox spool directory, e.g. /ifs/sysadmin/RCM/2023-12/outbox')
+    parser.add_argument('-l', '--list', action='store_true', help='List messages and their status; do not send')
+    parser.add_argument('--retry-failed', action='store_true', help='Also resend messages which failed')
+    parser.add_argument('-j', '--workers', type=int, default=2,
+                        help='Number of concurrent SMTP connections (Default: 2)')
+    parser.add_argument('--smtp-server', default=mail_queue.DEFAULT_SMTP_SERVER,
+                        help=f'SMTP server (Default: {mail_queue.DEFAULT_SMTP_SERVER})')
+    parser.add_argument('--smtp-port', type=int, default=mail_queue.DEFAULT_SMTP_PORT,
+                        help=f'SMTP server port (Default: {mail_queue.DEFAULT_SMTP_PORT})')
+    parser.add_argument('--email-rate', type=float, default=mail_queue.DEFAULT_RATE,
+                        help=f'Maximum emails sent per minute (Default: {mail_queue.DEFAULT_RATE:g})')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    debug_p = args.debug
+    mail_queue.debug_p = debug_p
+    profiling.start('drain_outbox', args)
+
+    if not Path(args.outbox).is_dir():
+        print(f'ERROR: drain_outbox: no such outbox {args.outbox}')
+        sys.exit(1)
+
+    if args.list:
+        Outbox(args.outbox).print_status()
+        sys.exit(0)
+
+    mq = mail_queue.MailQueue(server=args.smtp_server, port=args.smtp_port,
+                              rate=args.email_rate, workers=args.workers)
+    mq.start()
+    outbox = Outbox(args.outbox, queue=mq)
+    n = outbox.drain(retry_failed=args.retry_failed)
+    print(f'drain_outbox: sending {n} messages from {args.outbox}')
+    with profiling.stage('email_wait'):
+        mq.close()
+    mq.print_summary()
+
+    # next to the month's reports
+    profiling.finish(Path(args.outbox).parent)
+
+    if any(not r.sent for r in mq.results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+import sys
+import os
+import json
+import pickle
+import decimal
+import datetime
+import concurrent.futures
+from pathlib import Path
+
+from . import profiling
+from . import metrics
+
+# A month-end run as named stages with checkpoints.
+#
+# Each Stage is a function of the results of the stages it requires,
+# returning its own result. Pipeline.run() starts every stage as soon as
+# the stages it requires are done, in a pool of threads, so that
+# independent stages (e.g. compute and storage usage) run concurrently.
+# Decimal contexts are per thread, so each stage runs in a copy of the
+# context of the thread which called run(), e.g. with the ROUND_HALF_UP
+# rounding the charges are made with, not the pool thread's default.
+#
+# A stage's result is pickled to checkpoint_dir/STAGE.pkl when it is done,
+# with a small STAGE.json record of when. Then:
+#
+#   resume       stages with a checkpoint are loaded, not run, as long as
+#                every stage they require was loaded too
+#   only=STAGE   run STAGE alone, from the checkpoints of the stages it
+#                requires
+#   start=STAGE  run STAGE and everything after it, from the checkpoints
+#                of the stages before it which they require
+#
+# The record also holds the options the run was made with which change
+# stages' results (e.g. whether statements were emailed); a checkpoint made
+# with other options is treated as missing, so that e.g. a dry run's
+# statements are not taken for emailed ones. A checkpoint which cannot be
+# loaded (e.g. one written by an older version) is treated as missing too. Stages with checkpoint=False are never
+# saved, and are run whenever a stage which requires them is run.
+
+debug_p = False
+
+DEFAULT_WORKERS = 4
+
+
+class Stage:
+    def __init__(self, name, func, requires=(), checkpoint=True):
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+        self.checkpoint = checkpoint
+
+    def __repr__(self):
+        return f'Stage(name={self.name}, requires={self.requires}, checkpoint={self.checkpoint})'
+
+
+class Pipeline:
+    """Stages, in an order in which each comes after the stages it requires"""
+
+    def __init__(self, stages, checkpoint_dir, workers=DEFAULT_WORKERS, verbose=False, options=None):
+        self.stages = {s.name: s for s in stages}
+        self.order = [s.name for s in stages]
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.options = dict(options or {})    # recorded with, and required of, checkpoints
+        self.workers = workers
+        self.verbose = verbose
+
+        for stage in stages:
+            for r in stage.requires:
+                if r not in self.stages or self.order.index(r) > self.order.index(stage.name):
+                    raise ValueError(f'Pipeline: stage {stage.name} requires {r}, which does not come before it')
+
+    def checkpoint_path(self, name):
+        return self.checkpoint_dir / f'{name}.pkl'
+
+    def save_checkpoint(self, name, result):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+
+        # write-then-rename, so that a crash cannot leave a partial checkpoint
+        path = self.checkpoint_path(name)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmp_path, path)
+
+        with open(path.with_suffix('.json'), 'w') as f:
+            json.dump({'stage': name, 'completed': datetime.datetime.now().isoformat(timespec='seconds'),
+                       'options': self.options}, f)
+
+    def load_checkpoint(self, name):
+        """Return (True, result) of the stage's checkpoint; (False, None) if there is none usable"""
+        path = self.checkpoint_path(name)
+        if not self.stages[name].checkpoint or not path.exists():
+            return False, None
+
+        try:
+            with open(path.with_suffix('.json'), 'r') as f:
+                options = json.load(f).get('options')
+        except (OSError, ValueError):
+            options = None
+        if options != self.options:
+            print(f'WARNING: Pipeline: checkpoint {path} was made with other options ({options}); not using it')
+            return False, None
+
+        try:
+            with open(path, 'rb') as f:
+                return True, pickle.load(f)
+        except Exception as e:
+            print(f'WARNING: Pipeline: checkpoint {path} cannot be loaded ({type(e).__name__}: {e}); running {name} again')
+            return False, None
+
+    def plan(self, resume=False, only=None, start=None):
+        """Return (names of the stages to run, dict of results loaded from checkpoints)"""
+        for name in (only, start):
+            if name is not None and name not in self.stages:
+                print(f'ERROR: Pipeline: no stage {name}; stages are {", ".join(self.order)}')
+                sys.exit(1)
+
+        if only is not None or start is not None:
+            to_run, loaded = self._plan_from(resume, {only} if only else set(self.order[self.order.index(start):]))
+        else:
+            to_run, loaded = self._plan_all(resume)
+
+        return [n for n in self.order if n in to_run], loaded
+
+    def _plan_all(self, resume):
+        to_run = set()
+        loaded = {}
+        for name in self.order:
+            stage = self.stages[name]
+            # a stage whose inputs are made again is run again
+            stale = any(r in to_run and self.stages[r].checkpoint for r in stage.requires)
+            if resume and not stale:
+                ok, result = self.load_checkpoint(name)
+                if ok:
+                    loaded[name] = result
+                    continue
+            to_run.add(name)
+
+        # a stage without a checkpoint is run only for the stages which need it
+        needed = set()
+        for name in reversed(self.order):
+            if name in to_run and (self.stages[name].checkpoint or name in needed):
+                needed.add(name)
+                needed.update(self.stages[name].requires)
+        return to_run & needed, loaded
+
+    def _plan_from(self, resume, must_run):
+        # the stages which are run need the stages they require, latest first,
+        # so that a stage loaded from its checkpoint needs nothing before it
+        to_run = set(must_run)
+        loaded = {}
+        wanted = set().union(*(self.stages[n].requires for n in to_run)) - to_run
+        while wanted:
+            name = max(wanted, key=self.order.index)
+            wanted.remove(name)
+
+            ok, result = self.load_checkpoint(name)
+            if ok:
+                loaded[name] = result
+                continue
+            if self.stages[name].checkpoint and not resume:
+                print(f'ERROR: Pipeline: stage {name} has no usable checkpoint in {self.checkpoint_dir}; run it first, with the same options')
+                sys.exit(1)
+
+            to_run.add(name)
+            wanted.update(r for r in self.stages[name].requires if r not in to_run and r not in loaded)
+
+        return to_run, loaded
+
+    def _run_stage(self, stage, inputs, context):
+        with decimal.localcontext(context), profiling.stage(stage.name):
+            return stage.func(inputs)
+
+    def run(self, resume=False, only=None, start=None):
+        """Run the stages; return dict of stage name: result"""
+        to_run, results = self.plan(resume=resume, only=only, start=start)
+
+        if self.verbose:
+            if results:
+                print(f'pipeline: loaded from checkpoints: {", ".join(results)}')
+            print(f'pipeline: running: {", ".join(to_run) or "nothing"}')
+
+        context = decimal.getcontext().copy()
+        pending = list(to_run)
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for name in [n for n in pending if all(r in results for r in self.stages[n].requires)]:
+                    stage = self.stages[name]
+                    if debug_p:
+                        print(f'DEBUG: Pipeline.run(): starting {name}')
+                    running[executor.submit(self._run_stage, stage, {r: results[r] for r in stage.requires}, context)] = name
+                    pending.remove(name)
+
+                if not running:
+                    print(f'ERROR: Pipeline: stages {pending} cannot run; what they require was not run')
+                    sys.exit(1)
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    # a failed stage stops the run; stages already running finish first
+                    results[name] = future.result()
+                    if self.stages[name].checkpoint:
+                        self.save_checkpoint(name, results[name])
+                    if self.verbose:
+                        print(f'pipeline: {name} done')
+                    metrics.refresh()
+
+        return results
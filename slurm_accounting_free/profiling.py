@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import datetime
+import platform
+import resource
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+from . import slurm_cli
+
+# Timing of the stages of a run, for --profile.
+#
+# Code marks a stage of work with
+#
+#     with profiling.stage('html', project):
+#         ...
+#
+# which does nothing unless the module global profiler is set, as every
+# entry point does with --profile (see start()). Each stage records
+#
+#   wall       seconds elapsed
+#   cpu        CPU seconds of the thread which ran the stage; stages run
+#              concurrently in other threads are not counted
+#   child_cpu  CPU seconds of child processes (du, sreport, ...) which
+#              finished while the stage ran, in any thread; for a stage
+#              timed in a worker process and passed to record() (e.g.
+#              rendering a PDF), the CPU seconds of that worker
+#
+# A stage may be given a project (or PI, or file), so that the slowest
+# ones stand out; stages of the same name are also summed. Stages may be
+# nested, e.g. the per-project 'html' stages within the 'statements' stage,
+# so the sums of different stages overlap.
+#
+# With --profile-stage STAGE, stages named STAGE also run under cProfile;
+# the statistics of all of them are written together.
+#
+# finish() writes everything to profile_{program}_{started}.json next to
+# the run's outputs (e.g. the month's reports directory), so that runs can
+# be compared from month to month.
+
+debug_p = False
+
+TOP_FUNCTIONS = 40    # functions listed in the text of a cProfile
+
+
+@dataclass
+class StageTiming:
+    stage: str
+    project: str
+    started: float        # seconds since the start of the run
+    wall: float
+    cpu: float
+    child_cpu: float
+
+
+def children_cpu_time():
+    t = os.times()
+    return t.children_user + t.children_system
+
+
+class Profiler:
+    """Wall and CPU time of the stages of one run of program"""
+
+    def __init__(self, program, cprofile_stages=(), output_dir=None, write_files=True):
+        self.program = program
+        self.write_files = write_files    # False when only timing stages for metrics
+        self.cprofile_stages = set(cprofile_stages)
+        self.output_dir = output_dir
+        self.started = datetime.datetime.now()
+        self.tic = time.perf_counter()
+        self.cpu_tic = time.process_time()
+        self.child_cpu_tic = children_cpu_time()
+        self.timings = []
+        self.cprofiles = {}       # stage: cProfile.Profile
+        self._cprofiling = False  # one stage at a time is profiled
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, project=''):
+        cprofile = self._start_cprofile(name)
+
+        started = time.perf_counter()
+        cpu = time.thread_time()
+        child_cpu = children_cpu_time()
+        try:
+            yield
+        finally:
+            timing = StageTiming(name, project, started - self.tic,
+                                 time.perf_counter() - started,
+                                 time.thread_time() - cpu,
+                                 children_cpu_time() - child_cpu)
+            if cprofile is not None:
+                cprofile.disable()
+                with self._lock:
+                    self._cprofiling = False
+
+            with self._lock:
+                self.timings.append(timing)
+
+            if debug_p:
+                print(f'DEBUG: Profiler: {name} {project} {timing.wall:.3f} s wall, {timing.cpu:.3f} s CPU', flush=True)
+
+    def _start_cprofile(self, name):
+        if name not in self.cprofile_stages:
+            return None
+
+        with self._lock:
+            # profiles of stages running at the same time cannot be told apart
+            if self._cprofiling:
+                return None
+            self._cprofiling = True
+            cprofile = self.cprofiles.setdefault(name, cProfile.Profile())
+
+        try:
+            cprofile.enable()
+        except ValueError as e:
+            # another profiler is active
+            print(f'WARNING: Profiler: cannot profile {name}: {e}')
+            with self._lock:
+                self._cprofiling = False
+            return None
+
+        return cprofile
+
+    def record(self, name, project, wall, cpu=0., child_cpu=0.):
+        """Record a stage timed elsewhere, e.g. in a worker process"""
+        with self._lock:
+            self.timings.append(StageTiming(name, project, time.perf_counter() - self.tic - wall,
+                                            wall, cpu, child_cpu))
+
+    def stage_totals(self):
+        """Return dict stage: dict of count, wall, cpu, child_cpu, max_wall; in order of first start"""
+        totals = {}
+        for t in sorted(self.timings, key=lambda t: t.started):
+            total = totals.setdefault(t.stage, {'count': 0, 'wall': 0., 'cpu': 0., 'child_cpu': 0., 'max_wall': 0.})
+            total['count'] += 1
+            total['wall'] += t.wall
+            total['cpu'] += t.cpu
+            total['child_cpu'] += t.child_cpu
+            total['max_wall'] = max(total['max_wall'], t.wall)
+        return totals
+
+    def report(self):
+        """Return dict of the whole run, its stages, and the stages of each project"""
+        traces = slurm_cli.runner.traces
+        return {'program': self.program,
+                'argv': sys.argv[1:],
+                'host': platform.node(),
+                'started': self.started.isoformat(timespec='seconds'),
+                'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+                'wall': time.perf_counter() - self.tic,
+                'cpu': time.process_time() - self.cpu_tic,
+                'child_cpu': children_cpu_time() - self.child_cpu_tic,
+                'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'slurm_commands': {'count': len(traces),
+                                   'latency': sum(t.latency for t in traces),
+                                   'stdout_bytes': sum(t.stdout_bytes for t in traces),
+                                   'commands': [{'command': ' '.join(t.cmdline), 'returncode': t.returncode,
+                                                 'attempts': t.attempts, 'latency': t.latency,
+                                                 'stdout_bytes': t.stdout_bytes} for t in traces]},
+                'stages': self.stage_totals(),
+                'projects': [asdict(t) for t in sorted(self.timings, key=lambda t: t.started) if t.project]}
+
+    def write(self, output_dir):
+        """Write the report, and any cProfile statistics, to output_dir; return list of files written"""
+        output_dir = Path(self.output_dir or output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+        prefix = f'profile_{self.program}_{self.started:%Y%m%dT%H%M%S}'
+
+        written = []
+        report = self.report()
+        report['cprofile'] = {}
+        for name, cprofile in self.cprofiles.items():
+            prof_file = output_dir / f'{prefix}_{name}.prof'
+            cprofile.dump_stats(prof_file)
+            with open(prof_file.with_suffix('.txt'), 'w') as f:
+                pstats.Stats(cprofile, stream=f).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+            report['cprofile'][name] = str(prof_file)
+            written += [prof_file, prof_file.with_suffix('.txt')]
+
+        json_file = output_dir / f'{prefix}.json'
+        tmp_file = json_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp_file, json_file)
+
+        return [json_file] + written
+
+    def print_summary(self, file=sys.stdout):
+        wall = time.perf_counter() - self.tic
+        cpu = time.process_time() - self.cpu_tic
+        print(f'Profile: {self.program} {wall:.2f} s wall, {cpu:.2f} s CPU', file=file)
+        print(f'    {"Stage":<20} {"Count":>6} {"Wall (s)":>10} {"CPU (s)":>10} {"Child CPU (s)":>14} {"Max wall (s)":>13}', file=file)
+        for name, total in self.stage_totals().items():
+            print(f'    {name:<20} {total["count"]:>6} {total["wall"]:>10.2f} {total["cpu"]:>10.2f} {total["child_cpu"]:>14.2f} {total["max_wall"]:>13.3f}', file=file)
+
+
+# set by start() with --profile
+profiler = None
+
+
+@contextmanager
+def stage(name, project=''):
+    """Time the block as stage name (of project) if profiling; otherwise do nothing"""
+    if profiler is None:
+        yield
+        return
+
+    with profiler.stage(name, project):
+        yield
+
+
+def record(name, project, wall, cpu=0., child_cpu=0.):
+    if profiler is not None:
+        profiler.record(name, project, wall, cpu, child_cpu)
+
+
+def add_arguments(parser):
+    """Add --profile, --profile-stage and --profile-dir to an entry point's parser"""
+    parser.add_argument('--profile', action='store_true',
+                        help='Record wall and CPU time of each stage, and write them to a JSON file next to the outputs')
+    parser.add_argument('--profile-stage', action='append', default=[], metavar='STAGE',
+                        help='Also run STAGE under cProfile and write its statistics (implies --profile; may be repeated)')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Write the profile files to this directory instead')
+
+
+def start(program, args):
+    """Start profiling the run of program if args ask for it; return the Profiler or None"""
+    global profiler
+
+    if args.profile or args.profile_stage:
+        profiler = Profiler(program, cprofile_stages=args.profile_stage, output_dir=args.profile_dir)
+
+    return profiler
+
+
+def finish(output_dir):
+    """Write the profile, if any, to output_dir and print its summary"""
+    if profiler is None or not profiler.write_files:
+        return
+
+    written = profiler.write(output_dir)
+    profiler.print_summary()
+    for filename in written:
+        print(f'Profile: wrote {filename}')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import time
+import threading
+
+from . import metrics
+
+# Live progress of the long stages of a run.
+#
+# A stage which works through many items (statements, emails, du groups,
+# sreport queries, sacct records) reports them as it goes:
+#
+#     tracker = progress.Progress('pdf', total=len(statements), unit='statements')
+#     for ...:
+#         ...
+#         tracker.update()
+#     tracker.done()
+#
+# At most every interval seconds (--progress-interval), a line such as
+#
+#     progress: pdf 120/503 statements (24%), 41.3/min, about 9m16s left
+#
+# is printed, and the counts are passed on to the metrics file, if any (see
+# metrics.py), so that a run can be watched from the node exporter too.
+# A stage which finishes within the interval prints nothing.
+#
+# update() may be called from any thread, e.g. the workers of the mail queue.
+
+debug_p = False
+
+DEFAULT_INTERVAL = 30.    # seconds between progress lines
+
+# seconds between progress lines; 0 for none
+interval = DEFAULT_INTERVAL
+
+
+def format_eta(seconds):
+    """Return e.g. '1h02m', '9m16s', '45s'"""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds}s'
+
+
+class Progress:
+    """Count of items done by a stage, with throughput and time left"""
+
+    def __init__(self, stage, total=None, unit='items'):
+        self.stage = stage
+        self.total = total
+        self.unit = unit
+        self.count = 0
+        self.tic = time.monotonic()
+        self.last_report = self.tic
+        self.reported = False
+        self.finished = False
+        self._lock = threading.Lock()
+
+        metrics.update_progress(self.stage, self.count, self.total, 0.)
+
+    def add_total(self, n=1):
+        """Add n items to do, for stages which find their work as they go"""
+        with self._lock:
+            self.total = (self.total or 0) + n
+
+    def rate(self):
+        """Return items per minute so far"""
+        elapsed = time.monotonic() - self.tic
+        return 60. * self.count / elapsed if elapsed > 0. else 0.
+
+    def update(self, n=1):
+        with self._lock:
+            self.count += n
+            now = time.monotonic()
+            due = interval > 0. and now - self.last_report >= interval
+            if due:
+                self.last_report = now
+
+        if due:
+            self.report()
+
+    def done(self):
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+
+        # short stages are not worth a line
+        if self.reported or (interval > 0. and time.monotonic() - self.tic >= interval):
+            self.report()
+        else:
+            metrics.update_progress(self.stage, self.count, self.total, self.rate())
+
+    def report(self):
+        rate = self.rate()
+        elapsed = time.monotonic() - self.tic
+
+        if self.finished:
+            line = f'progress: {self.stage} {self.count:,} {self.unit} in {format_eta(elapsed)}, {rate:,.1f}/min'
+        elif self.total:
+            line = f'progress: {self.stage} {self.count:,}/{self.total:,} {self.unit} ({100. * self.count / self.total:.0f}%), {rate:,.1f}/min'
+            if rate > 0. and self.count < self.total:
+                line += f', about {format_eta(60. * (self.total - self.count) / rate)} left'
+        else:
+            line = f'progress: {self.stage} {self.count:,} {self.unit}, {rate:,.1f}/min'
+
+        print(line, flush=True)
+        self.reported = True
+
+        metrics.update_progress(self.stage, self.count, self.total, rate)
+
+
+def add_arguments(parser):
+    """Add --progress-interval to an entry point's parser"""
+    parser.add_argument('--progress-interval', type=float, default=DEFAULT_INTERVAL, metavar='SECONDS',
+                        help=f'Print the progress of long stages every SECONDS (Default: {DEFAULT_INTERVAL:g}; 0 for none)')
+
+
+def start(args):
+    global interval
+    interval = args.progress_interval
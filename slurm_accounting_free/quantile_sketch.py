@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import math
+import numpy as np
+
+# Mergeable quantile sketches, for medians and quartiles of job statistics
+# without holding every job record.
+#
+# QuantileSketch follows DDSketch (Masson, Rim & Lee, VLDB 2019): a
+# positive value x is counted in bucket ceil(log(x) / log(gamma)), with
+# gamma = (1 + alpha) / (1 - alpha), and a quantile is reported as the
+# middle of its bucket, 2 gamma^k / (gamma + 1).
+#
+# Accuracy: the q-quantile returned is within relative_accuracy (alpha,
+# default 1%) of the true q-quantile of the values added, i.e. of the value
+# of rank floor(q (n - 1)) in sorted order; values at or below MIN_VALUE
+# (including zero waits, and negative values) are kept exactly as 0. This
+# holds as long as no buckets have been collapsed: with the defaults, 2048
+# buckets span values over 17 orders of magnitude, e.g. 1 ms to millions
+# of years, so in practice they never are. Beyond max_buckets the lowest
+# buckets are collapsed into one, which only affects the lowest quantiles.
+#
+# Memory: at most max_buckets counts per sketch, however many values are
+# added. Sketches with the same relative_accuracy can be merged, e.g. from
+# chunks of sacct output or from separate processes, and the result is the
+# same as if all values had been added to one sketch.
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BUCKETS = 2048
+MIN_VALUE = 1e-9
+
+
+class QuantileSketch:
+    """Quantiles of a stream of non-negative values, to a relative accuracy"""
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_buckets=DEFAULT_MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1. + relative_accuracy) / (1. - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}     # bucket index: count
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        """Add an array of values; NaN are skipped"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if values.size == 0:
+            return
+
+        self.count += values.size
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+        positive = values[values > MIN_VALUE]
+        self.zero_count += values.size - positive.size
+
+        keys, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma).astype(np.int64), return_counts=True)
+        for k, n in zip(keys.tolist(), counts.tolist()):
+            self.buckets[k] = self.buckets.get(k, 0) + n
+
+        self._collapse()
+
+    def merge(self, other):
+        """Add the counts of other, a sketch with the same relative accuracy"""
+        if other.gamma != self.gamma:
+            raise ValueError(f'QuantileSketch.merge(): relative accuracy {other.relative_accuracy} != {self.relative_accuracy}')
+
+        self.count += other.count
+        self.zero_count += other.zero_count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for k, n in other.buckets.items():
+            self.buckets[k] = self.buckets.get(k, 0) + n
+
+        self._collapse()
+
+    def _collapse(self):
+        if len(self.buckets) > self.max_buckets:
+            keys = sorted(self.buckets)
+            n_low = len(keys) - self.max_buckets + 1
+            self.buckets[keys[n_low]] = self.buckets.get(keys[n_low], 0) + sum(self.buckets.pop(k) for k in keys[:n_low])
+
+    def quantile(self, q):
+        """Return the q-quantile (0 <= q <= 1) of the values added; None if there are none"""
+        if self.count == 0:
+            return None
+
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return 0.
+
+        seen = self.zero_count
+        for k in sorted(self.buckets):
+            seen += self.buckets[k]
+            if seen > rank:
+                value = 2. * self.gamma ** k / (self.gamma + 1.)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def to_dict(self):
+        """Return the sketch as a JSON-serializable dict; see from_dict()"""
+        return {'relative_accuracy': self.relative_accuracy,
+                'max_buckets': self.max_buckets,
+                'buckets': {str(k): n for k, n in self.buckets.items()},
+                'zero_count': self.zero_count,
+                'count': self.count,
+                'min': self.min if self.count else None,
+                'max': self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative_accuracy'], d['max_buckets'])
+        sketch.buckets = {int(k): n for k, n in d['buckets'].items()}
+        sketch.zero_count = d['zero_count']
+        sketch.count = d['count']
+        if sketch.count:
+            sketch.min = d['min']
+            sketch.max = d['max']
+
+        return sketch
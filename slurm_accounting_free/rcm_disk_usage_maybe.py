@@ -12,6 +12,10 @@ import platform
 import time
 from pathlib import Path
 
+from . import profiling
+from . import progress
+from . import metrics
+
 ### cron example
 # Example of job definition:
 # .---------------- minute (0 - 59)
@@ -65,8 +69,9 @@ def xfs_quota_report_maybe(when, debug_p=False, verbose_p=False, force_p=False):
         if e.errno != errno.EEXIST:
             raise
 
-    quota_report = subprocess.run(['xfs_quota', '-x', '-c', 'report -p', '/mnt/xfs1'],
-            stdout=subprocess.PIPE, check=False).stdout.decode('utf-8')
+    with profiling.stage('xfs_quota'):
+        quota_report = subprocess.run(['xfs_quota', '-x', '-c', 'report -p', '/mnt/xfs1'],
+                stdout=subprocess.PIPE, check=False).stdout.decode('utf-8')
 
     if debug_p:
         print(quota_report.split('\n'))
@@ -111,20 +116,29 @@ def disk_usage_maybe(when, hostname, debug_p=False, verbose_p=False, force_p=Fal
         if e.errno != errno.EEXIST:
             raise
 
+    groupdirs = [dir for dir in Path(groups_prefix).glob('*Grp') if dir.is_dir()]
+    tracker = progress.Progress('du', total=len(groupdirs), unit='groups')
+
     with open(rcm_dir / du_outfn, 'w') as du_file:
         grpdirpat = re.compile(r'.*Grp$')
-        for groupdir in [dir for dir in Path(groups_prefix).glob('*Grp') if dir.is_dir()]:
+        for groupdir in groupdirs:
             fullgroupdir = groups_prefix / groupdir
             if grpdirpat.match(str(groupdir)):
                 if verbose_p:
                     print(f'INFO: Running du on {fullgroupdir}')
                 try:
-                    subprocess.run(['du', '-sk', fullgroupdir], stdout=du_file, check=False)
+                    with profiling.stage('du', groupdir.name):
+                        subprocess.run(['du', '-sk', fullgroupdir], stdout=du_file, check=False)
                 except OSError as err:
                     print(f'ERROR: OS error: {err}')
                     continue
+                finally:
+                    tracker.update()
             else:
                 print(f'non-group directory: {groupdir} ... skipping')
+                tracker.update()
+
+    tracker.done()
 
     return
 
@@ -137,12 +151,19 @@ def main():
     parser.add_argument('-d', '--debug', action='store_true', help='debugging output')
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output')
     parser.add_argument('-f', '--force', action='store_true', help='run du even if not an appropriate date')
+    profiling.add_arguments(parser)
+    progress.add_arguments(parser)
+    metrics.add_arguments(parser)
     args = parser.parse_args()
 
     debug_p   = args.debug
     verbose_p = args.verbose
     force_p   = args.force
 
+    profiling.start('rcm_disk_usage_maybe', args)
+    progress.start(args)
+    metrics.start('rcm_disk_usage_maybe', args)
+
     # current date-time
     now = delorean.Delorean()
 
@@ -195,6 +216,11 @@ def main():
         else:
             print(f'{now.datetime.strftime("%Y-%m-%d %H:%M:%S UTC")} - rcm_disk_usage_maybe.py - day-of-month not in list')
 
+    # next to the month's du files
+    if rcm_prefix is not None:
+        profiling.finish(Path(rcm_prefix) / '{}-{:02d}'.format(now.date.year, now.date.month))
+    metrics.finish()
+
     return
 
 
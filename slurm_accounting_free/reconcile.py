@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import sys
+import datetime
+import argparse
+from pathlib import Path
+import pandas as pd
+
+from . import slurm_cli
+from . import job_stats
+from . import job_cache
+from . import job_charges
+from . import profiling
+
+# Reconciliation of the month's sreport totals against job-level sums.
+#
+# The statements charge the billing SU in the month's sreport files (see
+# generate_monthly_sreports and get_compute_usage() in __main__). Here
+# each account's and each user's sreport SU is compared with the SU summed
+# from the month's job records by job_charges. Both sides are DataFrames
+# keyed by (Account, User), with User '' for an account's total, and are
+# compared in one outer join.
+#
+# The job totals and ledger are made afresh, from sacct or the job cache,
+# since files already in the month's directory may be from a run before the
+# month was over. They are reused only when the caller has just made them
+# (slurm_accounting_free --job-charges, or reconcile --reuse-job-charges
+# straight after job_charges).
+#
+# sacct lists the jobs of every account, but the sreport files only cover
+# the accounts of the PIs in myorg_pis.csv. Job totals of accounts not in
+# any sreport file (root, admin and test accounts, ...) are marked
+# Unmatched and listed separately; they are never flagged.
+#
+# A difference of more than threshold SU is flagged. sreport rounds each
+# total to a whole SU, so the default threshold allows for that. For each
+# flagged account the jobs with the most SU (of its flagged users, or of
+# all its users if only the account total is off) are listed from the
+# per-job ledger.
+#
+# slurm_accounting_free runs this before emailing statements, and stops if
+# anything is flagged, unless --skip-reconcile is given.
+
+debug_p = False
+
+DEFAULT_THRESHOLD = 1.0  # SU
+DEFAULT_TOP_N = 10
+
+
+def comparison_filename(reports_dir, year, month):
+    return Path(reports_dir) / f'reconcile_{year}{month:02d}.csv'
+
+
+def jobs_filename(reports_dir, year, month):
+    return Path(reports_dir) / f'reconcile_{year}{month:02d}_jobs.csv'
+
+
+def read_sreport_usage(sreport_dir):
+    """Return DataFrame of Account, User, SU from the sreport files in sreport_dir;
+    User is '' for an account's total, and PI (parent account) rows are left out"""
+    frames = []
+    for sreport_file in sorted(Path(sreport_dir).iterdir()):
+        if sreport_file.is_file():
+            # 4 lines of banner, then the field names line; see read_sreport() in __main__
+            frames.append(pd.read_csv(sreport_file, sep='|', skiprows=4, dtype=str, keep_default_na=False))
+
+    if not frames:
+        return pd.DataFrame(columns=['Account', 'User', 'SU'])
+
+    sreport_df = pd.concat(frames, ignore_index=True)
+
+    # tree output indents projects under their PI, and users under projects
+    is_user = sreport_df['Login'] != ''
+    is_project = ~is_user & sreport_df['Account'].str.startswith(' ')
+    usage_df = pd.DataFrame({'Account': sreport_df['Account'].str.strip().str.casefold(),
+                             'User': sreport_df['Login'],
+                             'SU': pd.to_numeric(sreport_df['Used'], errors='coerce')})[is_user | is_project]
+
+    # a project under several PIs' files is the same project
+    return usage_df.drop_duplicates(subset=['Account', 'User'])
+
+
+def read_job_usage(reports_dir, year, month, reuse=False):
+    """Return DataFrame of Account, User, SU, Jobs summed from the month's job records
+
+    The job_charges totals and ledger are written afresh unless reuse is true and both exist.
+    """
+    totals_file = job_charges.totals_filename(reports_dir, year, month)
+    if not (reuse and totals_file.exists() and job_charges.ledger_filename(reports_dir, year, month).exists()):
+        charges = job_charges.JobCharges.from_sacct(year, month,
+                                                    ledger_file=job_charges.ledger_filename(reports_dir, year, month))
+        charges.write_totals(totals_file)
+
+    totals_df = pd.read_csv(totals_file, dtype={'Account': str, 'User': str}, keep_default_na=False)
+    return totals_df[['Account', 'User', 'SU', 'Jobs']]
+
+
+def compare_usage(sreport_df, jobs_df, threshold=DEFAULT_THRESHOLD):
+    """Return DataFrame of Account, User, sreport SU, Job SU, Jobs, Difference, Flagged, Unmatched
+
+    Unmatched rows are of accounts with jobs but in no sreport file; they are not flagged.
+    """
+    comparison_df = sreport_df.rename(columns={'SU': 'sreport SU'}).merge(
+        jobs_df.rename(columns={'SU': 'Job SU'}), on=['Account', 'User'], how='outer')
+
+    comparison_df[['sreport SU', 'Job SU', 'Jobs']] = comparison_df[['sreport SU', 'Job SU', 'Jobs']].fillna(0)
+    comparison_df['Jobs'] = comparison_df['Jobs'].astype(int)
+    comparison_df['Difference'] = comparison_df['Job SU'] - comparison_df['sreport SU']
+    comparison_df['Unmatched'] = ~comparison_df['Account'].str.casefold().isin(set(sreport_df['Account']))
+    comparison_df['Flagged'] = (comparison_df['Difference'].abs() > threshold) & ~comparison_df['Unmatched']
+
+    return comparison_df.sort_values(by=['Account', 'User'], kind='stable').reset_index(drop=True)
+
+
+def responsible_jobs(ledger_file, flagged_df, top_n=DEFAULT_TOP_N):
+    """Return DataFrame of the top_n jobs by SU of each flagged account, from the per-job ledger
+
+    The jobs are those of the account's flagged users, or of all its users
+    if only the account's total is flagged.
+    """
+    flagged_users = flagged_df[flagged_df['User'] != '']
+    pairs = pd.MultiIndex.from_frame(flagged_users[['Account', 'User']])
+    whole_accounts = set(flagged_df['Account']) - set(flagged_users['Account'])
+
+    jobs_df = None
+    for chunk in job_charges.read_ledger(ledger_file):
+        chunk_pairs = pd.MultiIndex.from_frame(chunk[['Account', 'User']])
+        wanted = chunk[chunk_pairs.isin(pairs) | chunk['Account'].isin(whole_accounts)]
+        if wanted.empty:
+            continue
+
+        # keep no more than top_n per account between chunks
+        jobs_df = wanted if jobs_df is None else pd.concat([jobs_df, wanted])
+        jobs_df = jobs_df.sort_values(by='SU', ascending=False, kind='stable').groupby('Account').head(top_n)
+
+    if jobs_df is None:
+        return pd.DataFrame(columns=job_charges.LEDGER_FIELDS)
+
+    return jobs_df.sort_values(by=['Account', 'SU'], ascending=[True, False], kind='stable').reset_index(drop=True)
+
+
+def reconcile(year, month, reports_dir, threshold=DEFAULT_THRESHOLD, top_n=DEFAULT_TOP_N, reuse_job_charges=False):
+    """Compare the month's sreport totals with job-level sums and write the comparison and
+    the flagged accounts' jobs to reports_dir; return (comparison DataFrame, jobs DataFrame)
+
+    reuse_job_charges: use the job_charges files in reports_dir, which the caller has just written
+    """
+    reports_dir = Path(reports_dir)
+
+    sreport_df = read_sreport_usage(reports_dir / 'sreport')
+    jobs_usage_df = read_job_usage(reports_dir, year, month, reuse=reuse_job_charges)
+    comparison_df = compare_usage(sreport_df, jobs_usage_df, threshold)
+
+    flagged_df = comparison_df[comparison_df['Flagged']]
+    jobs_df = responsible_jobs(job_charges.ledger_filename(reports_dir, year, month), flagged_df, top_n)
+
+    comparison_df.to_csv(comparison_filename(reports_dir, year, month), float_format='%.2f', index=False)
+    jobs_df.to_csv(jobs_filename(reports_dir, year, month), float_format='%.6f', index=False)
+
+    if debug_p:
+        print(f'DEBUG: reconcile(): {len(sreport_df)} sreport totals, {len(jobs_usage_df)} job totals, {len(flagged_df)} flagged')
+
+    return comparison_df, jobs_df
+
+
+def print_flagged(comparison_df, jobs_df, file=sys.stdout):
+    flagged_df = comparison_df[comparison_df['Flagged']]
+    n_matched = int((~comparison_df['Unmatched']).sum())
+    print(f'reconcile: {len(flagged_df)} of {n_matched} account and user totals differ', file=file)
+
+    for account, account_df in flagged_df.groupby('Account', sort=True):
+        print(f'    {account}', file=file)
+        for _, row in account_df.iterrows():
+            who = row['User'] or '(account total)'
+            print(f'        {who:<16} sreport {row["sreport SU"]:>14,.2f} SU   jobs {row["Job SU"]:>14,.2f} SU'
+                  f'   difference {row["Difference"]:>+12,.2f}', file=file)
+
+        account_jobs = jobs_df[jobs_df['Account'] == account]
+        if not account_jobs.empty:
+            print('        jobs with the most SU:', file=file)
+            table = account_jobs[['JobID', 'User', 'Partition', 'Billing', 'ElapsedRaw', 'SU']].to_string(
+                index=False, float_format=lambda x: f'{x:,.2f}')
+            for line in table.splitlines():
+                print(f'            {line}', file=file)
+
+
+def print_unmatched(comparison_df, file=sys.stdout):
+    """List the accounts with jobs which are in no sreport file; they are not checked"""
+    unmatched_df = comparison_df[comparison_df['Unmatched'] & (comparison_df['User'] == '')]
+    if unmatched_df.empty:
+        return
+
+    print(f'reconcile: {len(unmatched_df)} accounts with jobs are not in the sreport files; not checked', file=file)
+    for _, row in unmatched_df.iterrows():
+        print(f'    {row["Account"]:<20} jobs {row["Job SU"]:>14,.2f} SU in {row["Jobs"]:,} jobs', file=file)
+
+
+def main():
+    global debug_p
+
+    parser = argparse.ArgumentParser(description='Compare the month\'s sreport totals per account and user with the SU summed from job records')
+    parser.add_argument('-d', '--debug', action='store_true', help='Debugging output')
+    parser.add_argument('-w', '--when', default=None,
+                        help='Month in format YYYY-MM (Default: last month)')
+    parser.add_argument('-r', '--reports-prefix', default='/ifs/sysadmin/RCM', help='Reports prefix directory')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'Flag differences of more than this many SU (Default: {DEFAULT_THRESHOLD:g})')
+    parser.add_argument('-n', '--top', type=int, default=DEFAULT_TOP_N,
+                        help=f'Number of jobs to list for each flagged account (Default: {DEFAULT_TOP_N})')
+    parser.add_argument('--job-cache', default=None,
+                        help='Read job records from this job cache directory instead of running sacct (see job_cache)')
+    parser.add_argument('--reuse-job-charges', action='store_true',
+                        help='Use the month\'s job_charges totals and ledger as they are, e.g. straight after job_charges (Default: make them afresh)')
+    parser.add_argument('--trace', action='store_true', help='Print latency and output size of each Slurm command')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+
+    debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    job_stats.debug_p = debug_p
+    job_cache.debug_p = debug_p
+    job_charges.debug_p = debug_p
+    profiling.start('reconcile', args)
+
+    if args.when:
+        try:
+            year, month = (int(x) for x in args.when.split('-'))
+        except ValueError:
+            print(f'ERROR: reconcile: bad month {args.when}; expected YYYY-MM')
+            sys.exit(1)
+    else:
+        last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+        year, month = last_month.year, last_month.month
+
+    if debug_p:
+        reports_dir = Path(f'RCM/{year}-{month:02d}')
+    else:
+        reports_dir = Path(f'{args.reports_prefix}/{year}-{month:02d}')
+
+    if not (reports_dir / 'sreport').is_dir():
+        print(f'ERROR: reconcile: no sreport files in {reports_dir / "sreport"}; run generate_monthly_sreports first')
+        sys.exit(1)
+
+    if args.job_cache:
+        job_cache.cache = job_cache.JobCache(args.job_cache)
+
+    with profiling.stage('reconcile'):
+        comparison_df, jobs_df = reconcile(year, month, reports_dir, threshold=args.threshold, top_n=args.top,
+                                            reuse_job_charges=args.reuse_job_charges)
+    print_flagged(comparison_df, jobs_df)
+    print_unmatched(comparison_df)
+    print(f'reconcile: wrote {comparison_filename(reports_dir, year, month)}')
+    print(f'reconcile: wrote {jobs_filename(reports_dir, year, month)}')
+
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(reports_dir)
+
+    # non-zero if anything is flagged, for use as a pre-flight check
+    sys.exit(1 if comparison_df['Flagged'].any() else 0)
+
+
+if __name__ == '__main__':
+    main()
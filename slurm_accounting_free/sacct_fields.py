@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+import re
+import numpy as np
+import pandas as pd
+
+# Vectorized decoding of sacct output fields.
+#
+# Each decoder takes a whole column (a pandas Series of the strings sacct
+# printed, e.g. read with dtype=str, keep_default_na=False) and returns a
+# decoded Series or DataFrame with the same index. Fields sacct leaves
+# empty, or fills with a placeholder such as Unknown, decode to NaT/NaN/NA.
+#
+# Formats, as documented in sacct(1) and printed by Slurm:
+#
+#   durations   [DD-][HH:]MM:SS[.mmm]    e.g. Elapsed 1-02:03:04,
+#                                        TotalCPU 12:34.567, 00:00:01
+#               UNLIMITED, Partition_Limit, INVALID (Timelimit)
+#   sizes       N[K|M|G|T|P|E]           1024-based; no suffix is bytes
+#                                        (or use default_unit, e.g. for
+#                                        --noconvert output); ReqMem may
+#                                        end in c (per CPU) or n (per node),
+#                                        see decode_reqmem()
+#   timestamps  YYYY-MM-DDTHH:MM:SS      Unknown, None for unset times
+#   TRES        name=count,...           e.g. AllocTRES
+#                                        billing=4,cpu=4,mem=16000M,node=1
+#   states      COMPLETED, CANCELLED by 1234, FAILED, ...; truncated
+#               names end in +
+#   job IDs     JobID[_ArrayTask][+HetOffset][.Step], e.g. 1234,
+#               1234.batch, 1234_7.0, 1234_[1-100%5], 1234+1.extern
+#
+# pandas string methods loop over the rows in Python, so the decoders
+# avoid them. Durations, sizes and job ID numbers are parsed from a
+# fixed-width byte matrix of the column (one row per value) with numpy;
+# rows which do not fit the usual layout go through a regex instead.
+# Low-cardinality fields (states, job step names) are decoded once per
+# distinct value.
+
+SACCT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4, 'P': 1024**5, 'E': 1024**6}
+
+JOB_STATES = ('BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE', 'FAILED', 'NODE_FAIL',
+              'OUT_OF_MEMORY', 'PENDING', 'PREEMPTED', 'RUNNING', 'REQUEUED', 'RESIZING',
+              'REVOKED', 'SUSPENDED', 'TIMEOUT')
+
+DURATION_PAT = r'^(?:(?P<d>\d+)-)?(?:(?P<h>\d+):)?(?P<m>\d+):(?P<s>\d+)(?:\.(?P<frac>\d{1,9}))?$'
+JOBID_SUFFIX_RE = re.compile(r'^(?:_(?P<ArrayTaskID>\d+|\[[^\]]*\]))?(?:\+(?P<HetJobOffset>\d+))?(?:\.(?P<Step>.+))?$')
+
+# rows at a time when gathering substrings, to bound the index arrays' size
+BLOCK_ROWS = 65536
+
+ZERO = ord('0')
+
+
+def _as_str(column):
+    if not isinstance(column, pd.Series):
+        column = pd.Series(column, dtype=object)
+    return column.fillna('').astype(str)
+
+
+def _byte_matrix(column):
+    """Return (n x width uint8 matrix of the strings, left-aligned and NUL-padded, lengths)
+
+    Non-ASCII characters become ?, which no decoder accepts.
+    """
+    try:
+        arr = column.to_numpy(dtype=object).astype('S')
+    except UnicodeEncodeError:
+        arr = column.str.encode('ascii', 'replace').to_numpy(dtype=object).astype('S')
+
+    width = arr.dtype.itemsize
+    m = np.ascontiguousarray(arr).view(np.uint8).reshape(len(arr), width)
+    lengths = (m != 0).sum(axis=1)
+    return m, lengths
+
+
+def _char_at(m, pos):
+    """Return the byte at column pos of each row; 0 where pos is out of range"""
+    inside = (pos >= 0) & (pos < m.shape[1])
+    return np.where(inside, m[np.arange(len(m)), np.clip(pos, 0, m.shape[1] - 1)], 0)
+
+
+def _is_digit(c):
+    return (c >= ZERO) & (c <= ZERO + 9)
+
+
+def _parse_uint(m, start, stop):
+    """Return (int64 value of the digits in columns [start, stop) of each row,
+    True where they are all digits and there is at least one)"""
+    n_digits = stop - start
+    value = np.zeros(len(m), dtype=np.int64)
+    ok = n_digits > 0
+    for j in range(int(n_digits.max(initial=0))):
+        active = j < n_digits
+        c = _char_at(m, start + j)
+        value = np.where(active, value * 10 + (c.astype(np.int64) - ZERO), value)
+        ok &= ~active | _is_digit(c)
+
+    return value, ok
+
+
+def _first(m, lengths, byte, start):
+    """Return column of the first byte at or after start in each row; lengths where there is none"""
+    cols = np.arange(m.shape[1])
+    found = (m == byte) & (cols >= start[:, None])
+    return np.where(found.any(axis=1), found.argmax(axis=1), lengths)
+
+
+def _substrings(m, start, stop):
+    """Return object array of bytes of columns [start, stop) of each row"""
+    n, width = m.shape
+    out = np.empty(n, dtype=f'S{max(width, 1)}')
+    cols = np.arange(width)
+    for i in range(0, n, BLOCK_ROWS):
+        s, e = start[i:i + BLOCK_ROWS, None], stop[i:i + BLOCK_ROWS, None]
+        idx = cols + s
+        block = m[np.arange(i, i + len(s))[:, None], np.clip(idx, 0, width - 1)]
+        block[idx >= e] = 0
+        out[i:i + len(s)] = np.ascontiguousarray(block).view(out.dtype).ravel()
+
+    return out.astype(object)
+
+
+def _by_distinct(column, decode):
+    """Return object array of decode, a function of one str, applied to each distinct value of column"""
+    codes, uniques = pd.factorize(column)
+    decoded = np.empty(len(uniques), dtype=object)
+    decoded[:] = [decode(u) for u in uniques]
+    return decoded[codes]
+
+
+def _decode_duration_regex(column):
+    parts = _as_str(column).str.strip().str.extract(DURATION_PAT)
+
+    p = {n: pd.to_numeric(parts[n], errors='coerce').fillna(0).astype(np.int64) for n in ('d', 'h', 'm', 's')}
+    seconds = ((p['d'] * 24 + p['h']) * 60 + p['m']) * 60 + p['s']
+    frac_ns = pd.to_numeric(parts['frac'].str.ljust(9, '0'), errors='coerce').fillna(0).astype(np.int64)
+
+    durations = pd.to_timedelta(seconds * 1_000_000_000 + frac_ns, unit='ns')
+    return durations.where(parts['s'].notna())
+
+
+def decode_duration(column):
+    """Return Series of Timedelta; UNLIMITED, INVALID etc. are NaT"""
+    column = _as_str(column)
+    m, lengths = _byte_matrix(column)
+
+    # fraction of a second, to whole nanoseconds
+    dot = _first(m, lengths, ord('.'), np.zeros_like(lengths))
+    has_frac = dot < lengths
+    frac, frac_ok = _parse_uint(m, dot + 1, np.where(has_frac, lengths, dot + 1))
+    n_frac = lengths - dot - 1
+    frac_ok = ~has_frac | (frac_ok & (n_frac <= 9))
+    frac_ns = np.where(has_frac, frac * 10 ** (9 - np.clip(n_frac, 0, 9)), 0)
+
+    # [DD-][HH:]MM:SS, from the end
+    end = np.where(has_frac, dot, lengths)
+    s, ok = _parse_uint(m, end - 2, end)
+    mins, mins_ok = _parse_uint(m, end - 5, end - 3)
+    ok &= mins_ok & (_char_at(m, end - 3) == ord(':')) & frac_ok
+
+    has_h = _char_at(m, end - 6) == ord(':')
+    h, h_ok = _parse_uint(m, end - 8, end - 6)
+    has_d = has_h & (_char_at(m, end - 9) == ord('-'))
+    d, d_ok = _parse_uint(m, np.zeros_like(end), np.where(has_d, end - 9, 0))
+
+    ok &= np.where(has_d, h_ok & d_ok,
+                   np.where(has_h, h_ok & (end == 8), end == 5))
+
+    ns = (((d * 24 + np.where(has_h, h, 0)) * 60 + mins) * 60 + s) * 1_000_000_000 + frac_ns
+    durations = pd.Series(ns.astype('timedelta64[ns]'), index=column.index)
+    durations[~ok] = pd.NaT
+
+    # anything else starting with a digit, e.g. with surrounding spaces;
+    # UNLIMITED etc. are left NaT
+    odd = ~ok & (_is_digit(m[:, 0]) | (m[:, 0] == ord(' ')))
+    if odd.any():
+        durations[odd] = _decode_duration_regex(column[odd])
+
+    return durations
+
+
+def decode_size(column, unit='', default_unit=''):
+    """Return Series of float sizes in unit ('' is bytes, 'K', 'M', 'G', ...)
+
+    Numbers without a suffix are taken to be in default_unit.
+    """
+    column = _as_str(column)
+    m, lengths = _byte_matrix(column)
+
+    # ReqMem per CPU/per node
+    last = _char_at(m, lengths - 1)
+    lengths = lengths - ((last == ord('c')) | (last == ord('n')))
+
+    multipliers = np.full(256, np.nan)
+    multipliers[0] = SIZE_UNITS[default_unit.upper()]
+    for suffix, multiplier in SIZE_UNITS.items():
+        if suffix:
+            multipliers[ord(suffix)] = multipliers[ord(suffix.lower())] = multiplier
+
+    suffix = _char_at(m, lengths - 1)
+    has_suffix = (lengths > 0) & ~_is_digit(suffix) & (suffix != ord('.'))
+    n_number = lengths - has_suffix
+
+    # the number alone, NUL-terminated
+    numbers = m.copy()
+    numbers[np.arange(m.shape[1]) >= n_number[:, None]] = 0
+    numbers = np.ascontiguousarray(numbers).view(f'S{m.shape[1]}').ravel()
+    numbers[n_number <= 0] = b'nan'
+    try:
+        values = numbers.astype(np.float64)
+    except ValueError:
+        values = pd.to_numeric(pd.Series(numbers.astype(str)), errors='coerce').to_numpy(dtype=np.float64)
+
+    sizes = values * multipliers[np.where(has_suffix, suffix, 0)] / SIZE_UNITS[unit.upper()]
+    return pd.Series(sizes, index=column.index)
+
+
+def decode_reqmem(req_mem, alloc_cpus, nnodes, unit=''):
+    """Return Series of the total memory requested by each job, in unit
+
+    ReqMem ending in c is per CPU and in n per node; without either (newer
+    Slurm) it is the job's total.
+    """
+    req_mem = _as_str(req_mem)
+    m, lengths = _byte_matrix(req_mem)
+    last = _char_at(m, lengths - 1)
+
+    scale = np.where(last == ord('c'), pd.to_numeric(alloc_cpus, errors='coerce'),
+                     np.where(last == ord('n'), pd.to_numeric(nnodes, errors='coerce'), 1.))
+
+    return decode_size(req_mem, unit=unit) * scale
+
+
+def _tres_count(tres, name):
+    for item in tres.split(','):
+        key, _, count = item.partition('=')
+        if key == name:
+            try:
+                return float(count)
+            except ValueError:
+                return np.nan
+
+    return np.nan
+
+
+def decode_tres(column, name):
+    """Return Series of float counts of TRES name (e.g. billing, cpu, node) in
+    a TRES list such as AllocTRES; NaN where it is not listed
+
+    A month of jobs has comparatively few distinct TRES lists, so each is
+    decoded once.
+    """
+    column = _as_str(column)
+    counts = _by_distinct(column, lambda tres: _tres_count(tres, name))
+    return pd.Series(counts.astype(np.float64), index=column.index)
+
+
+def decode_timestamp(column):
+    """Return Series of datetime64; Unknown, None and empty are NaT"""
+    return pd.to_datetime(_as_str(column), format=SACCT_TIME_FORMAT, errors='coerce')
+
+
+def _base_state(state):
+    state = state.strip().split(' ', 1)[0]
+    if state.endswith('+'):
+        # truncated; complete it if unambiguous
+        matches = [s for s in JOB_STATES if s.startswith(state[:-1])]
+        if len(matches) == 1:
+            return matches[0]
+
+    return state or np.nan
+
+
+def decode_state(column):
+    """Return categorical Series of base job states, e.g. CANCELLED for "CANCELLED by 1234"
+
+    Truncated names (ending in +) are completed where unambiguous.
+    """
+    column = _as_str(column)
+    return pd.Series(_by_distinct(column, _base_state), index=column.index).astype('category')
+
+
+def _jobid_suffix(suffix):
+    """Return (ArrayTaskID, HetJobOffset, Step) of what follows the job ID number; None if invalid"""
+    match = JOBID_SUFFIX_RE.match(suffix.decode('ascii'))
+    if match is None:
+        return None
+
+    return match.group('ArrayTaskID', 'HetJobOffset', 'Step')
+
+
+def decode_jobid(column):
+    """Return DataFrame with JobIDBase, ArrayTaskID, HetJobOffset, Step columns
+
+    JobIDBase and HetJobOffset are integers; ArrayTaskID (a task number, or a
+    bracketed range for pending array jobs) and Step (batch, extern, 0, ...)
+    are categorical strings. Step is NA for the job allocation's own record.
+    All four are NA for an invalid job ID.
+    """
+    column = _as_str(column)
+    m, lengths = _byte_matrix(column)
+
+    # leading digits are the job ID
+    not_digit = ~_is_digit(m) | (np.arange(m.shape[1]) >= lengths[:, None])
+    base_end = np.where(not_digit.any(axis=1), not_digit.argmax(axis=1), lengths)
+    base, ok = _parse_uint(m, np.zeros_like(base_end), base_end)
+
+    # the rest (e.g. _7.batch) has few distinct values over a month of jobs
+    codes, suffixes = pd.factorize(_substrings(m, base_end, lengths))
+    parts = [_jobid_suffix(s) for s in suffixes]
+    ok &= np.array([p is not None for p in parts], dtype=bool)[codes]
+    parts = [p or (None, None, None) for p in parts]
+
+    def part(i):
+        values = pd.Categorical([p[i] for p in parts])
+        return pd.Categorical.from_codes(np.where(ok, values.codes[codes], -1), values.categories)
+
+    het = pd.to_numeric(pd.Series(part(1)), errors='coerce').to_numpy(dtype=np.float64)
+
+    return pd.DataFrame({'JobIDBase': pd.array(np.where(ok, base, np.nan), dtype='Int64'),
+                         'ArrayTaskID': part(0),
+                         'HetJobOffset': pd.array(het, dtype='Int64'),
+                         'Step': part(2)},
+                        index=column.index)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+import sys
+import io
+import re
+import time
+import asyncio
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+# Shared runner for sreport, sacct, sacctmgr invocations.
+#
+# All calls go through SlurmRunner so that:
+# * at most max_concurrency Slurm commands run at once (slurmdbd is a
+#   single daemon; we do not want to hammer it)
+# * each call has a timeout
+# * calls failing with a transient slurmdbd/slurmctld error are retried
+#   with exponential backoff
+# * each call's latency and output size is recorded for tracing
+#
+# SlurmRunner.stream() runs one command and hands its stdout pipe to a
+# parser, for outputs too large to hold in memory (e.g. a month of sacct
+# job steps). Streams are limited to max_concurrency at once too, by a
+# semaphore of their own, since they run in threads rather than in an event
+# loop.
+
+debug_p = False
+
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_TIMEOUT = 600.    # seconds per attempt
+DEFAULT_RETRIES = 3       # retries after the first attempt
+DEFAULT_BACKOFF = 2.      # seconds; doubled after every failed attempt
+
+# stderr messages which indicate slurmdbd/slurmctld was busy or briefly
+# unreachable, rather than a bad command line
+TRANSIENT_ERROR_PATS = [re.compile(p, re.IGNORECASE) for p in (
+    r'Socket timed out',
+    r'Unable to contact slurm controller',
+    r'Problem talking to the database',
+    r'Zero Bytes were transmitted or received',
+    r'Connection refused',
+    r'Connection reset by peer',
+    r'Resource temporarily unavailable',
+    r'slurmdbd.*not responding',
+)]
+
+
+class SlurmCommandError(Exception):
+    """Slurm command failed (after any retries)"""
+
+    def __init__(self, cmdline, returncode, stderr='', timed_out=False):
+        self.cmdline = cmdline
+        self.returncode = returncode
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+        if timed_out:
+            msg = f'{" ".join(cmdline)} - timed out'
+        else:
+            msg = f'{" ".join(cmdline)} - return code {returncode} - {stderr.strip()}'
+
+        super().__init__(msg)
+
+
+@dataclass
+class CommandResult:
+    cmdline: list
+    returncode: int
+    stdout: str
+    stderr: str
+
+
+@dataclass
+class CommandTrace:
+    cmdline: list
+    returncode: int
+    attempts: int
+    latency: float        # seconds, over all attempts
+    stdout_bytes: int
+    stderr_bytes: int
+    timed_out: bool = False
+
+
+def is_transient_error(stderr: str):
+    return any(pat.search(stderr) for pat in TRANSIENT_ERROR_PATS)
+
+
+class CountingReader(io.RawIOBase):
+    """Raw reader which counts the bytes read through it"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.nbytes = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.raw.readinto(b)
+        if n:
+            self.nbytes += n
+        return n
+
+
+class CommandStream:
+    """stdout of a running command, as a text stream
+
+    returncode and stderr are set once the stream has been closed.
+    """
+
+    def __init__(self, cmdline, stdout, counter):
+        self.cmdline = cmdline
+        self.stdout = stdout
+        self.counter = counter
+        self.returncode = None
+        self.stderr = ''
+        self.timed_out = False
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+
+class SlurmRunner:
+    """Run Slurm CLI commands concurrently, with timeouts, retries, and tracing"""
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.traces = []
+        self._semaphore = None
+        self._semaphore_loop = None
+        self._stream_semaphore = None
+        self._stream_lock = threading.Lock()
+
+    def _get_semaphore(self):
+        # asyncio primitives are bound to one event loop; each asyncio.run()
+        # has its own loop
+        loop = asyncio.get_running_loop()
+        if self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+
+        return self._semaphore
+
+    def _get_stream_semaphore(self):
+        # streams run in threads, outside any event loop; created on first
+        # use, since entry points set max_concurrency after the runner exists
+        with self._stream_lock:
+            if self._stream_semaphore is None:
+                self._stream_semaphore = threading.BoundedSemaphore(self.max_concurrency)
+
+        return self._stream_semaphore
+
+    async def _run_once(self, cmdline, timeout, input_bytes):
+        proc = await asyncio.create_subprocess_exec(
+            *cmdline,
+            stdin=asyncio.subprocess.PIPE if input_bytes is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(input_bytes), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None, b'', b''
+
+        return proc.returncode, stdout, stderr
+
+    async def run(self, cmdline, check=True, timeout=None, input=None):
+        """Run one command; return CommandResult
+
+        Raises SlurmCommandError if check is True and the command fails
+        after all retries.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        cmdline = [str(c) for c in cmdline]
+        input_bytes = input.encode('utf-8') if input is not None else None
+
+        if debug_p:
+            print(f'DEBUG: SlurmRunner.run(): cmdline = {cmdline}', flush=True)
+
+        delay = self.backoff
+        attempts = 0
+        async with self._get_semaphore():
+            # latency does not include time spent waiting for a free slot
+            tic = time.monotonic()
+            while True:
+                attempts += 1
+                returncode, stdout, stderr = await self._run_once(cmdline, timeout, input_bytes)
+                timed_out = returncode is None
+                stderr_str = stderr.decode('utf-8', errors='replace')
+
+                transient = timed_out or (returncode != 0 and is_transient_error(stderr_str))
+                if not transient or attempts > self.retries:
+                    break
+
+                print(f'WARNING: {cmdline[0]} - transient failure (attempt {attempts}); retrying in {delay:.1f} s', flush=True)
+                await asyncio.sleep(delay)
+                delay *= 2.
+
+            toc = time.monotonic()
+
+        self.traces.append(CommandTrace(cmdline=cmdline,
+                                        returncode=returncode if not timed_out else -1,
+                                        attempts=attempts,
+                                        latency=toc - tic,
+                                        stdout_bytes=len(stdout),
+                                        stderr_bytes=len(stderr),
+                                        timed_out=timed_out))
+
+        if debug_p:
+            print(f'DEBUG: SlurmRunner.run(): {cmdline[0]} returncode = {returncode}, attempts = {attempts}, {toc - tic:.3f} s, {len(stdout)} bytes', flush=True)
+
+        if check and (timed_out or returncode != 0):
+            raise SlurmCommandError(cmdline, returncode, stderr_str, timed_out)
+
+        return CommandResult(cmdline=cmdline,
+                             returncode=returncode if not timed_out else -1,
+                             stdout=stdout.decode('utf-8', errors='replace'),
+                             stderr=stderr_str)
+
+    async def run_many(self, cmdlines, check=True, timeout=None, on_done=None):
+        """Run several commands concurrently; return list of CommandResult
+        or SlurmCommandError in the same order as cmdlines
+
+        on_done(cmdline), if given, is called as each command finishes,
+        e.g. to report progress.
+        """
+        async def run_one(cmdline):
+            try:
+                return await self.run(cmdline, check=check, timeout=timeout)
+            finally:
+                if on_done is not None:
+                    on_done(cmdline)
+
+        return await asyncio.gather(*[run_one(c) for c in cmdlines],
+                                    return_exceptions=True)
+
+    def run_sync(self, cmdline, check=True, timeout=None, input=None):
+        return asyncio.run(self.run(cmdline, check=check, timeout=timeout, input=input))
+
+    def run_many_sync(self, cmdlines, check=True, timeout=None, on_done=None):
+        return asyncio.run(self.run_many(cmdlines, check=check, timeout=timeout, on_done=on_done))
+
+    @contextmanager
+    def stream(self, cmdline, check=True, timeout=None):
+        """Run one command, yielding a CommandStream over its stdout
+
+        The caller parses stdout incrementally inside the with block; output
+        is never held in memory as a whole. The command is not retried, since
+        its output may already have been consumed. Raises SlurmCommandError on
+        leaving the block if check is True and the command failed.
+
+        At most max_concurrency streams run at once, counted separately
+        from the commands of run() and run_many().
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        cmdline = [str(c) for c in cmdline]
+
+        if debug_p:
+            print(f'DEBUG: SlurmRunner.stream(): cmdline = {cmdline}', flush=True)
+
+        # stderr goes to a file so that a chatty command cannot block on a
+        # full stderr pipe while we are reading stdout
+        with self._get_stream_semaphore(), tempfile.TemporaryFile() as errfile:
+            tic = time.monotonic()
+            proc = subprocess.Popen(cmdline, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=errfile,
+                                    bufsize=0)
+
+            cmd_stream = None
+            timed_out = threading.Event()
+
+            def kill_on_timeout():
+                timed_out.set()
+                proc.kill()
+
+            watchdog = threading.Timer(timeout, kill_on_timeout)
+            watchdog.start()
+            try:
+                counter = CountingReader(proc.stdout)
+                stdout = io.TextIOWrapper(io.BufferedReader(counter), encoding='utf-8', errors='replace')
+                cmd_stream = CommandStream(cmdline, stdout, counter)
+
+                yield cmd_stream
+
+                # drain anything the parser did not read, so the command can exit
+                while counter.read(65536):
+                    pass
+            except BaseException:
+                proc.kill()
+                raise
+            finally:
+                proc.wait()
+                watchdog.cancel()
+                toc = time.monotonic()
+                proc.stdout.close()
+
+                errfile.seek(0)
+                stderr = errfile.read()
+                nbytes = cmd_stream.counter.nbytes if cmd_stream else 0
+
+                if cmd_stream:
+                    cmd_stream.returncode = proc.returncode
+                    cmd_stream.stderr = stderr.decode('utf-8', errors='replace')
+                    cmd_stream.timed_out = timed_out.is_set()
+
+                self.traces.append(CommandTrace(cmdline=cmdline,
+                                                returncode=proc.returncode,
+                                                attempts=1,
+                                                latency=toc - tic,
+                                                stdout_bytes=nbytes,
+                                                stderr_bytes=len(stderr),
+                                                timed_out=timed_out.is_set()))
+
+                if debug_p:
+                    print(f'DEBUG: SlurmRunner.stream(): {cmdline[0]} returncode = {proc.returncode}, {toc - tic:.3f} s, {nbytes} bytes', flush=True)
+
+        if check and (cmd_stream.timed_out or cmd_stream.returncode != 0):
+            raise SlurmCommandError(cmdline, cmd_stream.returncode, cmd_stream.stderr, cmd_stream.timed_out)
+
+    def print_trace_summary(self, file=sys.stdout):
+        if not self.traces:
+            print('Slurm command trace: no commands run', file=file)
+            return
+
+        total_latency = sum(t.latency for t in self.traces)
+        total_bytes = sum(t.stdout_bytes for t in self.traces)
+
+        print(f'Slurm command trace: {len(self.traces)} commands, {total_latency:.2f} s total latency, {total_bytes:,} bytes output', file=file)
+        print(f'    {"Command":<12} {"RC":>4} {"Tries":>5} {"Latency (s)":>12} {"Output (B)":>12}  Arguments', file=file)
+        for t in sorted(self.traces, key=lambda t: t.latency, reverse=True):
+            rc = 'TIME' if t.timed_out else t.returncode
+            print(f'    {t.cmdline[0].split("/")[-1]:<12} {rc:>4} {t.attempts:>5} {t.latency:>12.3f} {t.stdout_bytes:>12,}  {" ".join(t.cmdline[1:])}', file=file)
+
+
+# runner shared by all entry points in a process
+runner = SlurmRunner()
@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+import sys
+import os
+import csv
+import json
+import time
+import random
+import calendar
+import datetime
+import argparse
+from pathlib import Path
+from dataclasses import dataclass
+
+# Stand-in sreport/sacct/sacctmgr/sshare for exercising the entry points without
+# a live cluster.
+#
+# A synthetic organization (PIs, projects, users, jobs) is generated
+# deterministically from a seed, so every invocation -- and every
+# process -- sees the same data, and sreport totals are consistent with
+# the sacct job records they summarize.
+#
+# Set up a directory with wrapper executables and the input files which
+# slurm_accounting_free and generate_monthly_sreports read:
+#
+#     slurm_emulator setup --prefix /tmp/emu --pis 500
+#     export PATH=/tmp/emu/bin:$PATH SLURM_BINDIR=/tmp/emu/bin
+#     generate_monthly_sreports --reports-prefix /tmp/emu/RCM --when 2023-12
+#
+# The wrappers read the organization size and injected latency from
+# SLURM_EMULATOR_* environment variables (written into the wrappers by
+# "setup"):
+#
+#     SLURM_EMULATOR_PIS                number of PIs
+#     SLURM_EMULATOR_PROJECTS_PER_PI    projects per PI
+#     SLURM_EMULATOR_USERS_PER_PROJECT  users per project
+#     SLURM_EMULATOR_JOBS_PER_USER      jobs per user per month (max. 999)
+#     SLURM_EMULATOR_SEED               random seed
+#     SLURM_EMULATOR_LATENCY            seconds to sleep before responding
+#     SLURM_EMULATOR_JITTER             uniform random extra latency, seconds
+#     SLURM_EMULATOR_STATE              JSON file persisting sacctmgr changes
+#
+# Only the options the entry points use are implemented.
+
+TOOLS = ('sreport', 'sacct', 'sacctmgr', 'sshare')
+
+CLUSTER = 'mycluster'
+SACCT_TIME_FMT = '%Y-%m-%dT%H:%M:%S'
+
+UNFUNDED_GRPTRESMINS = 487805
+CLASS_GRPTRESMINS = 2880000
+
+SYLLABLES = ['ba', 'ce', 'di', 'fo', 'gu', 'ha', 'ke', 'li', 'mo', 'nu',
+             'pa', 're', 'si', 'to', 'vu', 'wa', 'ye', 'zo', 'ch', 'th']
+FIRSTNAMES = ['Alex', 'Blair', 'Casey', 'Devon', 'Emery', 'Finley', 'Gray',
+              'Harper', 'Jordan', 'Kai', 'Logan', 'Morgan', 'Parker', 'Quinn',
+              'Reese', 'Rowan', 'Sage', 'Taylor']
+MAX_WALLTIME = 7 * 86400
+PARTITIONS = [('def', 1), ('bm', 68), ('gpu', 43)]
+TERMINAL_STATES = ['COMPLETED'] * 14 + ['FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED by 0']
+
+
+@dataclass
+class OrgSpec:
+    pis: int = 50
+    projects_per_pi: int = 2
+    users_per_project: int = 5
+    jobs_per_user: int = 40
+    seed: int = 1
+    latency: float = 0.
+    jitter: float = 0.
+
+    @classmethod
+    def from_env(cls):
+        spec = cls()
+        for name, conv in (('pis', int), ('projects_per_pi', int),
+                           ('users_per_project', int), ('jobs_per_user', int),
+                           ('seed', int), ('latency', float), ('jitter', float)):
+            value = os.environ.get(f'SLURM_EMULATOR_{name.upper()}')
+            if value:
+                setattr(spec, name, conv(value))
+
+        spec.jobs_per_user = min(spec.jobs_per_user, 999)
+        return spec
+
+
+def lastname_for(i):
+    # unique, letters-only surnames
+    name = ''
+    n = i
+    while True:
+        name += SYLLABLES[n % len(SYLLABLES)]
+        n //= len(SYLLABLES)
+        if n == 0:
+            break
+
+    return (name + 'son').capitalize()
+
+
+class Organization:
+    """Synthetic PIs, projects, and users"""
+
+    def __init__(self, spec: OrgSpec):
+        self.spec = spec
+        rng = random.Random(spec.seed)
+
+        self.pis = []
+        self.projects = {}     # project name -> dict
+        self.users = {}        # login -> full name
+        self.assocs = []       # (project, login), index used to build job IDs
+
+        for i in range(spec.pis):
+            lastname = lastname_for(i)
+            firstname = FIRSTNAMES[rng.randrange(len(FIRSTNAMES))]
+            account = lastname.lower()
+            pi = {'Last Name': lastname,
+                  'First Name': firstname,
+                  'User ID': f'{firstname[0].lower()}{account[:6]}{i}',
+                  'Email': f'{account}@example.com',
+                  'College': 'Example College',
+                  'Department': 'Example Dept.',
+                  'Active?': 1,
+                  'account': account,
+                  'projects': []}
+            self.pis.append(pi)
+
+            # users are shared between a PI's projects
+            pool = [f'u{i:05d}{k:02d}' for k in range(spec.users_per_project + spec.projects_per_pi)]
+            for k, login in enumerate(pool):
+                self.users[login] = f'{FIRSTNAMES[(i + k) % len(FIRSTNAMES)]} {lastname_for(i * 7 + k + 1)}'
+
+            for p in range(spec.projects_per_pi):
+                name = f'{account}prj' if p == 0 else f'{account}{p + 1}prj'
+                is_class = (p > 0) and (rng.random() < 0.1)
+                funded = rng.random() < 0.6
+                fundorg = f'{rng.randrange(100000, 999999)}-{rng.randrange(1000, 9999)}' if funded else 'xxxxxx-xxxx'
+                members = pool[p:p + spec.users_per_project]
+                self.projects[name] = {'pi': pi,
+                                       'is_class': is_class,
+                                       'fundorg_code': fundorg,
+                                       'members': members,
+                                       'grptresmins': None if funded else (CLASS_GRPTRESMINS if is_class else UNFUNDED_GRPTRESMINS)}
+                pi['projects'].append(name)
+
+                for login in members:
+                    self.assocs.append((name, login))
+
+        self.assoc_index = {a: n for n, a in enumerate(self.assocs)}
+
+    def write_inputs(self, rcm_prefix: Path):
+        """Write myorg_pis.csv, fundorg_codes.csv, courses.txt"""
+        os.makedirs(rcm_prefix, exist_ok=True)
+
+        pi_fields = ['Last Name', 'First Name', 'User ID', 'Email', 'College', 'Department', 'Active?']
+        with open(rcm_prefix / 'myorg_pis.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=pi_fields, extrasaction='ignore')
+            writer.writeheader()
+            for pi in self.pis:
+                writer.writerow(pi)
+
+        fundorg_fields = ['Project', 'Fund-Org code', 'Email', 'Class?', 'MRI?',
+                          'Startup/Grant?', 'Monthly credit?', 'Share expiration']
+        with open(rcm_prefix / 'fundorg_codes.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fundorg_fields)
+            writer.writeheader()
+            for name, p in self.projects.items():
+                writer.writerow({'Project': name,
+                                 'Fund-Org code': p['fundorg_code'],
+                                 'Email': p['pi']['Email'],
+                                 'Class?': 'TRUE' if p['is_class'] else 'FALSE',
+                                 'MRI?': 'FALSE',
+                                 'Startup/Grant?': 'FALSE',
+                                 'Monthly credit?': 'TRUE' if p['fundorg_code'].startswith('1') else 'FALSE',
+                                 'Share expiration': 'n/a'})
+
+        with open(rcm_prefix / 'courses.txt', 'w') as f:
+            for name, p in self.projects.items():
+                if p['is_class']:
+                    f.write(f'{name}\n')
+
+    def jobs(self, project, login, year, month):
+        """Yield the jobs submitted by login in project during year-month
+
+        Each job is a dict; 'steps' is a list of step dicts.
+        """
+        rng = random.Random(f'{self.spec.seed}:{project}:{login}:{year}:{month}')
+        month_start = datetime.datetime(year, month, 1)
+        month_secs = calendar.monthrange(year, month)[1] * 86400
+        month_serial = (year - 2020) * 12 + month
+        base_jobid = month_serial * 10**8 + self.assoc_index[(project, login)] * 1000
+
+        for i in range(self.spec.jobs_per_user):
+            partition, billing_per_unit = PARTITIONS[0] if rng.random() < 0.85 else PARTITIONS[rng.randrange(1, 3)]
+            ncpus = rng.choice([1, 1, 2, 4, 8, 16, 32, 48])
+            nnodes = 1 if ncpus <= 48 else 2
+            submit = month_start + datetime.timedelta(seconds=rng.randrange(month_secs))
+            start = submit + datetime.timedelta(seconds=min(int(rng.expovariate(1. / 900.)), 86400))
+            elapsed = min(int(rng.lognormvariate(7.5, 1.3)), MAX_WALLTIME)
+            end = start + datetime.timedelta(seconds=elapsed)
+            state = rng.choice(TERMINAL_STATES)
+            reqmem_mib = ncpus * rng.choice([1000, 2000, 4000, 8000])
+            maxrss_kib = int(reqmem_mib * 1024 * rng.uniform(0.02, 1.0))
+            totalcpu = elapsed * ncpus * rng.uniform(0.05, 1.0)
+
+            if partition == 'def':
+                billing = ncpus
+            elif partition == 'bm':
+                billing = max(ncpus, int(reqmem_mib / 1048576. * billing_per_unit))
+            else:
+                billing = billing_per_unit
+
+            jobid = base_jobid + i
+            job = {'JobID': str(jobid),
+                   'JobIDRaw': str(jobid),
+                   'JobName': f'job{i}',
+                   'Account': project,
+                   'User': login,
+                   'Partition': partition,
+                   'State': state,
+                   'Submit': submit,
+                   'Start': start,
+                   'End': end,
+                   'AllocCPUS': ncpus,
+                   'NNodes': nnodes,
+                   'ReqMem': f'{reqmem_mib}M',
+                   'AllocTRES': f'billing={billing},cpu={ncpus},mem={reqmem_mib}M,node={nnodes}',
+                   'TotalCPU': totalcpu,
+                   'MaxRSS': '',
+                   'MaxVMSize': '',
+                   'MaxDiskRead': '',
+                   'MaxDiskWrite': '',
+                   'ExitCode': '0:0' if state == 'COMPLETED' else '1:0',
+                   'billing': billing}
+
+            batch = dict(job, JobID=f'{jobid}.batch', JobIDRaw=f'{jobid}.batch', JobName='batch',
+                         User='', Partition='', AllocTRES=f'cpu={ncpus},mem={reqmem_mib}M,node=1',
+                         State=state.split()[0] if state.startswith('CANCELLED') else state,
+                         MaxRSS=f'{maxrss_kib}K',
+                         MaxVMSize=f'{int(maxrss_kib * rng.uniform(1.0, 3.0))}K',
+                         MaxDiskRead=f'{rng.uniform(0., 2000.):.2f}M',
+                         MaxDiskWrite=f'{rng.uniform(0., 500.):.2f}M')
+            extern = dict(job, JobID=f'{jobid}.extern', JobIDRaw=f'{jobid}.extern', JobName='extern',
+                          User='', Partition='', AllocTRES=f'billing={billing},cpu={ncpus},node={nnodes}',
+                          State='COMPLETED', TotalCPU=0.001, MaxRSS='0', MaxVMSize='4K',
+                          MaxDiskRead='0', MaxDiskWrite='0', ExitCode='0:0')
+            job['steps'] = [batch, extern]
+
+            yield job
+
+    def jobs_in_window(self, start, end, accounts=None, users=None):
+        """Yield jobs which were running in [start, end)"""
+        # jobs wait at most a day and run for at most MAX_WALLTIME, so only
+        # jobs submitted shortly before the window can overlap it
+        first = (start - datetime.timedelta(days=1, seconds=MAX_WALLTIME)).replace(day=1)
+        months = []
+        m = first
+        while m < end:
+            months.append((m.year, m.month))
+            m = (m + datetime.timedelta(days=32)).replace(day=1)
+
+        for project, login in self.assocs:
+            if accounts and project not in accounts:
+                continue
+            if users and login not in users:
+                continue
+
+            for year, month in months:
+                for job in self.jobs(project, login, year, month):
+                    if job['Start'] < end and job['End'] > start:
+                        yield job
+
+    def billing_usage(self, start, end, divisor=3600.):
+        """Return {(project, login): billing TRES-hours used in [start, end)}"""
+        usage = {}
+        for job in self.jobs_in_window(start, end):
+            overlap = (min(job['End'], end) - max(job['Start'], start)).total_seconds()
+            key = (job['Account'], job['User'])
+            usage[key] = usage.get(key, 0.) + job['billing'] * overlap / divisor
+
+        return usage
+
+
+def load_state(org):
+    state_file = os.environ.get('SLURM_EMULATOR_STATE')
+    if state_file and os.path.exists(state_file):
+        with open(state_file) as f:
+            for account, grptresmins in json.load(f).items():
+                if account in org.projects:
+                    org.projects[account]['grptresmins'] = grptresmins
+
+
+def save_state(org):
+    state_file = os.environ.get('SLURM_EMULATOR_STATE')
+    if state_file:
+        state = {name: p['grptresmins'] for name, p in org.projects.items()}
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+
+
+def inject_latency(spec):
+    delay = spec.latency
+    if spec.jitter:
+        delay += random.uniform(0., spec.jitter)
+    if delay > 0.:
+        time.sleep(delay)
+
+
+def parse_slurm_date(s):
+    for fmt in (SACCT_TIME_FMT, '%Y-%m-%d-%H:%M:%S', '%Y-%m-%d', '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+
+    raise ValueError(f'bad date {s}')
+
+
+def format_duration(seconds, frac=False):
+    # [DD-]HH:MM:SS; TotalCPU style is MM:SS.mmm under an hour
+    if frac and seconds < 3600.:
+        m, s = divmod(seconds, 60.)
+        return f'{int(m):02d}:{s:06.3f}'
+
+    seconds = int(seconds)
+    d, rem = divmod(seconds, 86400)
+    h, rem = divmod(rem, 3600)
+    m, s = divmod(rem, 60)
+    if d:
+        return f'{d}-{h:02d}:{m:02d}:{s:02d}'
+    return f'{h:02d}:{m:02d}:{s:02d}'
+
+
+def sreport(org, argv, out):
+    parsable = '-P' in argv or '--parsable2' in argv
+    noheader = '-n' in argv or '--noheader' in argv
+    tree = 'Tree' in argv or 'tree' in argv
+    opts = {}
+    for a in argv:
+        if '=' in a:
+            k, v = a.split('=', 1)
+            opts[k.lower()] = v
+
+    units = 'Hours'
+    if '-t' in argv:
+        units = argv[argv.index('-t') + 1].capitalize()
+    divisor = {'Hours': 3600., 'Minutes': 60., 'Seconds': 1.}[units]
+
+    start = parse_slurm_date(opts['start'])
+    end = parse_slurm_date(opts['end'])
+    wanted = set(opts['account'].split(',')) if 'account' in opts else None
+
+    usage = org.billing_usage(start, end, divisor)
+
+    if not parsable:
+        print('ERROR: slurm_emulator: sreport only supports -P output', file=sys.stderr)
+        return 1
+
+    if not noheader:
+        out.write('-' * 80 + '\n')
+        out.write(f'Cluster/Account/User Utilization {start.strftime(SACCT_TIME_FMT)} - {(end - datetime.timedelta(seconds=1)).strftime(SACCT_TIME_FMT)} ({int((end - start).total_seconds())} secs)\n')
+        out.write(f'Usage reported in TRES {units}\n')
+        out.write('-' * 80 + '\n')
+        out.write('Cluster|Account|Login|Proper Name|TRES Name|Used\n')
+
+    def project_rows(project, depth):
+        indent = ' ' * depth if tree else ''
+        users = [(login, u) for (p, login), u in usage.items() if p == project]
+        out.write(f'{CLUSTER}|{indent}{project}|||billing|{round(sum(u for _, u in users))}\n')
+        indent = ' ' * (depth + 1) if tree else ''
+        for login, u in sorted(users):
+            out.write(f'{CLUSTER}|{indent}{project}|{login}|{org.users[login]}|billing|{round(u)}\n')
+
+    if wanted is None:
+        out.write(f'{CLUSTER}|root|||billing|{round(sum(usage.values()))}\n')
+
+    for pi in org.pis:
+        if wanted is None or pi['account'] in wanted:
+            depth = 1 if wanted is None else 0
+            total = sum(u for (p, _), u in usage.items() if p in pi['projects'])
+            out.write(f'{CLUSTER}|{" " * depth if tree else ""}{pi["account"]}|||billing|{round(total)}\n')
+            for project in pi['projects']:
+                project_rows(project, depth + 1)
+        else:
+            for project in pi['projects']:
+                if project in wanted:
+                    project_rows(project, 0)
+
+    return 0
+
+
+def sacct_fields(argv):
+    fields = None
+    for i, a in enumerate(argv):
+        if a in ('-o', '--format'):
+            fields = argv[i + 1]
+        elif a.startswith('--format='):
+            fields = a.split('=', 1)[1]
+
+    if not fields:
+        fields = 'JobID,JobName,Partition,Account,AllocCPUS,State,ExitCode'
+
+    return [f.split('%')[0] for f in fields.split(',')]
+
+
+def sacct_option(argv, short, long):
+    for i, a in enumerate(argv):
+        if a == short or a == long:
+            return argv[i + 1]
+        if a.startswith(short) and len(a) > len(short) and not a.startswith('--'):
+            return a[len(short):]
+        if a.startswith(long + '='):
+            return a.split('=', 1)[1]
+
+    return None
+
+
+def sacct(org, argv, out):
+    fields = sacct_fields(argv)
+    truncate = '-T' in argv or '--truncate' in argv
+    allocations = '-X' in argv or '--allocations' in argv
+    noheader = '-n' in argv or '--noheader' in argv
+
+    start = parse_slurm_date(sacct_option(argv, '-S', '--starttime'))
+    end_str = sacct_option(argv, '-E', '--endtime')
+    end = parse_slurm_date(end_str) if end_str else datetime.datetime.now()
+    if end.second == 59:
+        # sacct end times like 23:59:59 are inclusive
+        end += datetime.timedelta(seconds=1)
+
+    accounts = sacct_option(argv, '-A', '--accounts')
+    accounts = set(accounts.split(',')) if accounts else None
+    users = sacct_option(argv, '-u', '--user')
+    users = set(users.split(',')) if users else None
+
+    if not noheader:
+        out.write('|'.join(fields) + '\n')
+
+    for job in org.jobs_in_window(start, end, accounts, users):
+        records = [job] if allocations else [job] + job['steps']
+        for rec in records:
+            rec_start, rec_end = rec['Start'], rec['End']
+            if truncate:
+                rec_start, rec_end = max(rec_start, start), min(rec_end, end)
+            elapsed = (rec_end - rec_start).total_seconds()
+
+            row = []
+            for f in fields:
+                if f in ('Submit', 'Start', 'End'):
+                    t = {'Submit': rec['Submit'], 'Start': rec_start, 'End': rec_end}[f]
+                    row.append(t.strftime(SACCT_TIME_FMT))
+                elif f == 'Elapsed':
+                    row.append(format_duration(elapsed))
+                elif f == 'ElapsedRaw':
+                    row.append(str(int(elapsed)))
+                elif f == 'TotalCPU':
+                    row.append(format_duration(rec['TotalCPU'], frac=True))
+                else:
+                    row.append(str(rec.get(f, '')))
+            out.write('|'.join(row) + '\n')
+
+    return 0
+
+
+def sacctmgr(org, argv, out):
+    args = [a for a in argv if not a.startswith('-')]
+
+    if len(args) >= 2 and args[0] == 'show' and args[1].startswith('assoc'):
+        fields = ['cluster', 'account', 'user', 'grptresmins']
+        for a in args:
+            if a.lower().startswith('format='):
+                fields = a.split('=', 1)[1].lower().split(',')
+
+        names = {'cluster': 'Cluster', 'account': 'Account', 'user': 'User', 'grptresmins': 'GrpTRESMins'}
+        sep = '|'
+        out.write(sep.join(names.get(f, f) for f in fields) + '\n')
+
+        def row(account, user, grptresmins):
+            values = {'cluster': CLUSTER, 'account': account, 'user': user,
+                      'grptresmins': f'billing={grptresmins}' if grptresmins is not None and not user else ''}
+            out.write(sep.join(values.get(f, '') for f in fields) + '\n')
+
+        row('root', '', None)
+        for pi in org.pis:
+            row(pi['account'], '', None)
+            for project in pi['projects']:
+                p = org.projects[project]
+                row(project, '', p['grptresmins'])
+                for login in p['members']:
+                    row(project, login, None)
+
+        return 0
+
+    if len(args) >= 4 and args[0] == 'modify' and args[1] == 'account':
+        account = args[2]
+        if account not in org.projects:
+            print(' Nothing modified', file=out)
+            return 1
+
+        for a in args[3:]:
+            if a.lower().startswith('grptresmins='):
+                org.projects[account]['grptresmins'] = int(a.split('=')[-1])
+        save_state(org)
+        out.write(f' Modified account associations...\n  C = {CLUSTER:<10} A = {account}\n')
+        return 0
+
+    print(f'ERROR: slurm_emulator: unsupported sacctmgr command {argv}', file=sys.stderr)
+    return 1
+
+
+def sshare(org, argv, out):
+    # GrpTRESRaw is the billing usage counted against GrpTRESMins; the
+    # emulated cluster resets it at the start of every month
+    fields = sacct_fields(argv) if ('-o' in argv or any(a.startswith('--format') for a in argv)) else ['Account', 'User', 'RawShares', 'GrpTRESRaw']
+    noheader = '-n' in argv or '--noheader' in argv
+
+    now = datetime.datetime.now()
+    usage = org.billing_usage(now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), now, divisor=60.)
+
+    if not noheader:
+        out.write('|'.join(fields) + '\n')
+
+    def row(account, user, billing_mins, depth):
+        values = {'Account': ' ' * depth + account, 'User': user, 'RawShares': '1',
+                  'GrpTRESRaw': f'cpu={int(billing_mins)},mem=0,energy=0,node=0,billing={int(billing_mins)},fs/disk=0,vmem=0,pages=0'}
+        out.write('|'.join(values.get(f, '') for f in fields) + '\n')
+
+    row('root', '', sum(usage.values()), 0)
+    for pi in org.pis:
+        row(pi['account'], '', sum(u for (p, _), u in usage.items() if p in pi['projects']), 1)
+        for project in pi['projects']:
+            row(project, '', sum(u for (p, _), u in usage.items() if p == project), 2)
+            for login in org.projects[project]['members']:
+                row(project, login, usage.get((project, login), 0.), 3)
+
+    return 0
+
+
+def emulate(tool, argv, spec=None, out=None):
+    """Emulate tool (one of TOOLS) called with argv; return exit code"""
+    if spec is None:
+        spec = OrgSpec.from_env()
+    if out is None:
+        out = sys.stdout
+
+    org = Organization(spec)
+    load_state(org)
+    inject_latency(spec)
+
+    return {'sreport': sreport, 'sacct': sacct, 'sacctmgr': sacctmgr, 'sshare': sshare}[tool](org, argv, out)
+
+
+def setup(prefix: Path, spec: OrgSpec):
+    """Write wrapper executables to prefix/bin and input files to prefix/RCM"""
+    bindir = prefix / 'bin'
+    os.makedirs(bindir, exist_ok=True)
+
+    env = (f'export SLURM_EMULATOR_PIS={spec.pis} '
+           f'SLURM_EMULATOR_PROJECTS_PER_PI={spec.projects_per_pi} '
+           f'SLURM_EMULATOR_USERS_PER_PROJECT={spec.users_per_project} '
+           f'SLURM_EMULATOR_JOBS_PER_USER={spec.jobs_per_user} '
+           f'SLURM_EMULATOR_SEED={spec.seed} '
+           f'SLURM_EMULATOR_LATENCY=${{SLURM_EMULATOR_LATENCY:-{spec.latency}}} '
+           f'SLURM_EMULATOR_JITTER=${{SLURM_EMULATOR_JITTER:-{spec.jitter}}} '
+           f'SLURM_EMULATOR_STATE=${{SLURM_EMULATOR_STATE:-{prefix.resolve() / "sacctmgr_state.json"}}}')
+
+    for tool in TOOLS:
+        wrapper = bindir / tool
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\n')
+            f.write(f'{env}\n')
+            f.write(f'exec {sys.executable} -m slurm_accounting_free.slurm_emulator {tool} "$@"\n')
+        os.chmod(wrapper, 0o755)
+
+    org = Organization(spec)
+    org.write_inputs(prefix / 'RCM')
+
+    return org
+
+
+def main():
+    tool = Path(sys.argv[0]).name
+    argv = sys.argv[1:]
+    if tool not in TOOLS and argv and argv[0] in TOOLS:
+        tool = argv.pop(0)
+
+    if tool in TOOLS:
+        try:
+            sys.exit(emulate(tool, argv))
+        except BrokenPipeError:
+            # reader went away, e.g. "| head"
+            sys.stderr.close()
+            sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Stand-in Slurm CLI tools with a synthetic organization')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    setup_parser = subparsers.add_parser('setup', help='Write wrapper executables and input files')
+    setup_parser.add_argument('-p', '--prefix', required=True, help='Directory for bin/ and RCM/')
+    defaults = OrgSpec()
+    setup_parser.add_argument('--pis', type=int, default=defaults.pis, help=f'Number of PIs (default {defaults.pis})')
+    setup_parser.add_argument('--projects-per-pi', type=int, default=defaults.projects_per_pi)
+    setup_parser.add_argument('--users-per-project', type=int, default=defaults.users_per_project)
+    setup_parser.add_argument('--jobs-per-user', type=int, default=defaults.jobs_per_user,
+                              help='Jobs per user per month (max. 999)')
+    setup_parser.add_argument('--seed', type=int, default=defaults.seed)
+    setup_parser.add_argument('--latency', type=float, default=defaults.latency,
+                              help='Seconds each command sleeps before responding')
+    setup_parser.add_argument('--jitter', type=float, default=defaults.jitter,
+                              help='Maximum uniform random extra latency, seconds')
+    args = parser.parse_args()
+
+    if args.command == 'setup':
+        spec = OrgSpec(pis=args.pis, projects_per_pi=args.projects_per_pi,
+                       users_per_project=args.users_per_project,
+                       jobs_per_user=min(args.jobs_per_user, 999), seed=args.seed,
+                       latency=args.latency, jitter=args.jitter)
+        org = setup(Path(args.prefix), spec)
+        print(f'slurm_emulator: {len(org.pis)} PIs, {len(org.projects)} projects, {len(org.users)} users, {len(org.assocs) * spec.jobs_per_user:,} jobs per month')
+        print(f'    export PATH={Path(args.prefix).resolve() / "bin"}:$PATH SLURM_BINDIR={Path(args.prefix).resolve() / "bin"}')
+
+
+if __name__ == '__main__':
+    main()
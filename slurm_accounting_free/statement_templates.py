@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+import html
+from decimal import Decimal
+from string import Template
+
+# Statement templates.
+#
+# A statement is a plain dict built by make_statement_data() in __main__
+# (or by billing_report for a compute-only report):
+#
+#   {'cluster': str, 'project': str, 'period': 'March 2024', 'rate': Decimal,
+#    'pi_lastname', 'pi_firstname', 'pi_email': str,
+#    'is_class', 'is_mri', 'is_startup': bool,
+#    'share_expiration', 'fundorg_code': str,
+#    'charges': {'compute_su', 'compute_charge',
+#                'disk_su', 'disk_charge', 'total_su', 'total_charge': Decimal},
+#    'users': [{'fullname', 'login': str, 'su', 'charge': Decimal}, ...],
+#    'job_stats': {'n_jobs': int, 'pct_completed': float,
+#                  'completed': {'n': int, 'rows': [{'field', 'min', 'q1',
+#                                'median', 'q3', 'max', 'mean'}, ...]},
+#                  'incomplete': {'n': int, 'rows': [...]}},
+#    'efficiency': {'jobs': int, 'core_hours', 'cpu_efficiency', 'wasted_core_hours',
+#                   'mem_efficiency', 'wasted_gib_hours': float},
+#    'ytd': {'compute', 'storage': Decimal},
+#    'members': [{'surname', 'givenname', 'email': str}, ...]}
+#
+# Sections whose key is missing or None are left out. billing_report only
+# fills in cluster, project, period, rate, charges (compute only) and users,
+# which render_text() handles; render_html() needs the full charges.
+#
+# Templates are compiled once, at import. Rendering formats the numbers,
+# substitutes each section and joins the pieces into one string.
+
+# Bump whenever a template or the rendering changes, so that statements
+# rendered with the old templates are rebuilt (see statement_fingerprint()
+# in __main__)
+TEMPLATE_VERSION = 2
+
+penny = Decimal('0.01')
+
+
+def fmt_su(su, width=12):
+    return f'{float(su):>{width}.6e}'
+
+
+def fmt_charge(charge, width=9):
+    return f'{Decimal(charge).quantize(penny):>{width},.2f}'
+
+
+# job statistics columns: row key, title
+JOB_STATS = {'min': 'Min.', 'q1': '25%', 'median': 'Median', 'q3': '75%', 'max': 'Max.', 'mean': 'Mean'}
+
+
+def fmt_stat(field, value):
+    if field == 'Virtual memory (GiB)':
+        return f'{value:.2f}'
+    return f'{value}'
+
+
+def fmt_pct(value):
+    # NaN when no job had a known peak memory
+    if value is None or value != value:
+        return 'n/a'
+    return f'{value:.1f}%'
+
+
+HTML_HEAD = Template('''\
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional/EN"
+  "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+  <head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+    <title>$cluster Usage Report for $project</title>
+  </head>
+<body>
+''')
+
+HTML_HEADER = Template('''\
+<h4>$cluster usage charges for period $period</h4>
+<p>&nbsp;</p>
+<table><tr><td>PI:</td>      <td>$pi_lastname, $pi_firstname <tt>&lt;$pi_email&gt;</tt></td></tr>
+<tr><td>Project:</td>        <td>$project</td></tr>
+<tr><td>Coursework?</td>     <td>$is_class</td></tr>
+<tr><td>MRI?</td>            <td>$is_mri</td></tr>
+<tr><td>Startup/Grant?</td>  <td>$is_startup</td></tr>
+<tr><td>Share (MRI/Startup/Grant) expiration:</td> <td>$share_expiration</td></tr>
+<tr><td>Fund-Org code:</td> <td><tt>$fundorg_code</tt></td></tr></table>
+
+<p><br/></p><span class="rates"><table><tr><td colspan="2">Rate: $$$rate per SU</td></tr>\
+<tr><td>&nbsp;</td><td>Standard compute: 1 SU per core-hour</td></tr>\
+<tr><td>&nbsp;</td><td>Big memory compute: 68 SU per RAM TiB-hour</td></tr>\
+<tr><td>&nbsp;</td><td>GPU compute: 43 SU per GPU device-hour</td></tr>\
+<tr><td>&nbsp;</td><td>Storage: 1081 SU per TiB-month</td></tr>\
+</table></span>
+
+''')
+
+HTML_CHARGES = Template('''\
+<pre><b>               Usage (SU)               Charge</b>
+Compute      $compute_su           $$$compute_charge
+Storage      $disk_su           $$$disk_charge
+             ------------           ----------
+<b>TOTAL        $total_su           $$$total_charge</b>
+             ============           ==========</pre>
+
+
+''')
+
+HTML_USERS_HEAD = Template('''\
+<b>Compute usage by user</b><pre><b>Name                      User ID     Usage (SU)         Charge</b>
+''')
+HTML_USERS_ROW = Template('$fullname $login $su     $$$charge\n')
+HTML_USERS_NONE = Template('<b>Compute usage by user</b><pre>n/a\n')
+HTML_USERS_TAIL = Template('</pre>\n<br>')
+
+HTML_JOBS_HEAD = Template('<h3>Job Statistics</h3><p>Number of jobs = $n_jobs<br/>')
+HTML_JOBS_SUMMARY = Template('''\
+% of jobs completed successfully = $pct_completed%
+</p><h4>Completed Jobs</h4><p>Number of completed jobs = $n_completed</p>''')
+HTML_JOBS_INCOMPLETE = Template('''\
+<h4>Incomplete Jobs</h4>\
+<p><i>Jobs which may not have completed due to <a href="https://slurm.schedmd.com/sacct.html#SECTION_JOB-STATE-CODES">a variety of reasons</a>.</i></p>''')
+HTML_JOBS_N_INCOMPLETE = Template('<p>Number of incomplete jobs = $n_incomplete</p>')
+HTML_JOBS_TABLE_HEAD = Template('''\
+<p><table id="jobstats">
+<tr>
+ <th>&nbsp;</th>
+ <th>Min.</th>
+ <th>25%</th>
+ <th>Median</th>
+ <th>75%</th>
+ <th>Max.</th>
+ <th>Mean</th>
+</tr>
+''')
+HTML_JOBS_TABLE_ROW = Template('<tr><td>$field</td><td>$min</td><td>$q1</td><td>$median</td><td>$q3</td><td>$max</td><td>$mean</td></tr>')
+HTML_JOBS_TABLE_TAIL = Template('</table></p>\n')
+
+HTML_EFFICIENCY = Template('''\
+<h3>Job Efficiency</h3>
+<pre>Jobs ended in the month:            $jobs
+Core-hours allocated:               $core_hours
+CPU efficiency:                     $cpu_efficiency
+Wasted core-hours:                  $wasted_core_hours
+Memory efficiency:                  $mem_efficiency
+Wasted GiB-hours of memory:         $wasted_gib_hours</pre>
+''')
+
+HTML_YTD = Template('''\
+<b>Cumulative charges for current fiscal year</b>
+<pre>Compute usage:                      $$$compute
+Storage usage:                      $$$storage
+                                    ----------
+<b>TOTAL CUMULATIVE CHARGE:            $$$total</b>
+                                    ==========</pre>
+''')
+
+HTML_MEMBERS_HEAD = Template('''\
+<h3>Project Members</h3>
+<table id="projectmembers">
+<tr>
+<th>&nbsp;</th>
+<th>Name</th>
+<th>Email</th>
+</tr>''')
+HTML_MEMBERS_ROW = Template('''\
+<tr>
+<td>$counter</td>
+<td>$surname, $givenname</td>
+<td>$email</td>
+</tr>''')
+HTML_MEMBERS_TAIL = Template('</table>\n')
+
+HTML_TAIL = Template('</body>\n</html>')
+
+
+TEXT_HEADER = Template('''\
+USAGE REPORT FOR $project ON CLUSTER $cluster - $period
+Rate = $$ $rate per SU
+
+''')
+TEXT_PI = Template('''\
+PI:                $pi_lastname, $pi_firstname <$pi_email>
+Coursework?        $is_class
+MRI?               $is_mri
+Startup/Grant?     $is_startup
+Share expiration:  $share_expiration
+Fund-Org code:     $fundorg_code
+
+''')
+
+TEXT_COMPUTE = Template('''\
+Compute usage: $compute_su SU
+Charge: $$ $compute_charge
+
+
+''')
+TEXT_CHARGES = Template('''\
+               Usage (SU)               Charge
+Compute      $compute_su           $$$compute_charge
+Storage      $disk_su           $$$disk_charge
+             ------------           ----------
+TOTAL        $total_su           $$$total_charge
+             ============           ==========
+
+
+''')
+
+TEXT_USERS_HEAD = Template('''\
+    Per-user usage and charge
+    Name                      User ID     Usage (SU)         Charge
+''')
+TEXT_USERS_ROW = Template('    $fullname $login $su     $$$charge\n')
+
+TEXT_JOBS_HEAD = Template('''
+Job statistics
+    Number of jobs = $n_jobs
+''')
+TEXT_JOBS_SUMMARY = Template('    % of jobs completed successfully = $pct_completed%\n')
+TEXT_JOBS_GROUP = Template('    $title: $n\n')
+TEXT_JOBS_ROW = Template('        $field $min $q1 $median $q3 $max $mean\n')
+
+TEXT_EFFICIENCY = Template('''
+Job efficiency
+    Jobs ended in the month:            $jobs
+    Core-hours allocated:               $core_hours
+    CPU efficiency:                     $cpu_efficiency
+    Wasted core-hours:                  $wasted_core_hours
+    Memory efficiency:                  $mem_efficiency
+    Wasted GiB-hours of memory:         $wasted_gib_hours
+''')
+
+TEXT_YTD = Template('''
+Cumulative charges for current fiscal year
+    Compute usage:                      $$$compute
+    Storage usage:                      $$$storage
+                                        ----------
+    TOTAL CUMULATIVE CHARGE:            $$$total
+''')
+
+TEXT_MEMBERS_HEAD = Template('\nProject members\n')
+TEXT_MEMBERS_ROW = Template('    $counter. $surname, $givenname <$email>\n')
+
+
+def header_fields(statement, escape):
+    fields = {k: escape(f'{statement.get(k, "")}')
+              for k in ('cluster', 'project', 'period', 'pi_lastname', 'pi_firstname', 'pi_email',
+                        'is_class', 'is_mri', 'is_startup', 'share_expiration', 'fundorg_code')}
+    fields['rate'] = f'{float(statement["rate"]):.4f}'
+    return fields
+
+
+def charge_fields(charges):
+    fields = {}
+    for k in ('compute', 'disk', 'total'):
+        if charges.get(f'{k}_su') is not None:
+            fields[f'{k}_su'] = fmt_su(charges[f'{k}_su'])
+            fields[f'{k}_charge'] = fmt_charge(charges[f'{k}_charge'])
+    return fields
+
+
+def user_fields(user, escape):
+    return {'fullname': escape(f'{user["fullname"]:<20}'),
+            'login': escape(f'{user["login"]:>12}'),
+            'su': fmt_su(user['su'], 14),
+            'charge': fmt_charge(user['charge'])}
+
+
+def efficiency_fields(efficiency):
+    return {'jobs': f'{efficiency["jobs"]:>10,}',
+            'core_hours': f'{efficiency["core_hours"]:>10,.1f}',
+            'cpu_efficiency': f'{fmt_pct(efficiency["cpu_efficiency"]):>10}',
+            'wasted_core_hours': f'{efficiency["wasted_core_hours"]:>10,.1f}',
+            'mem_efficiency': f'{fmt_pct(efficiency["mem_efficiency"]):>10}',
+            'wasted_gib_hours': f'{efficiency["wasted_gib_hours"]:>10,.1f}'}
+
+
+def ytd_fields(ytd):
+    return {'compute': fmt_charge(ytd['compute']),
+            'storage': fmt_charge(ytd['storage']),
+            'total': fmt_charge(ytd['compute'] + ytd['storage'])}
+
+
+def render_html(statement):
+    """Return statement as an HTML document"""
+    esc = html.escape
+    out = []
+
+    fields = header_fields(statement, esc)
+    out.append(HTML_HEAD.substitute(fields))
+    out.append(HTML_HEADER.substitute(fields))
+    out.append(HTML_CHARGES.substitute(charge_fields(statement['charges'])))
+
+    if statement.get('users'):
+        out.append(HTML_USERS_HEAD.substitute())
+        out.extend(HTML_USERS_ROW.substitute(user_fields(u, esc)) for u in statement['users'])
+    else:
+        out.append(HTML_USERS_NONE.substitute())
+    out.append(HTML_USERS_TAIL.substitute())
+
+    job_stats = statement.get('job_stats')
+    if job_stats is not None:
+        out.append(HTML_JOBS_HEAD.substitute(n_jobs=f'{job_stats["n_jobs"]:,}'))
+        if job_stats['n_jobs'] > 0:
+            out.append(HTML_JOBS_SUMMARY.substitute(pct_completed=f'{job_stats["pct_completed"]:.2f}',
+                                                    n_completed=f'{job_stats["completed"]["n"]:,}'))
+            if job_stats['completed']['n'] > 0:
+                out.append(render_html_job_table(job_stats['completed']['rows']))
+
+            out.append(HTML_JOBS_INCOMPLETE.substitute())
+            if job_stats['incomplete']['n'] > 0:
+                out.append(HTML_JOBS_N_INCOMPLETE.substitute(n_incomplete=f'{job_stats["incomplete"]["n"]:,}'))
+                out.append(render_html_job_table(job_stats['incomplete']['rows']))
+        else:
+            out.append('</p>\n')
+
+    if statement.get('efficiency') is not None:
+        out.append(HTML_EFFICIENCY.substitute(efficiency_fields(statement['efficiency'])))
+
+    if statement.get('ytd') is not None:
+        out.append(HTML_YTD.substitute(ytd_fields(statement['ytd'])))
+
+    if statement.get('members') is not None:
+        out.append(HTML_MEMBERS_HEAD.substitute())
+        out.extend(HTML_MEMBERS_ROW.substitute(counter=i, surname=esc(m['surname']),
+                                               givenname=esc(m['givenname']), email=esc(m['email']))
+                   for i, m in enumerate(statement['members'], start=1))
+        out.append(HTML_MEMBERS_TAIL.substitute())
+
+    out.append(HTML_TAIL.substitute())
+
+    return ''.join(out)
+
+
+def render_html_job_table(rows):
+    out = [HTML_JOBS_TABLE_HEAD.substitute()]
+    out.extend(HTML_JOBS_TABLE_ROW.substitute(field=r['field'],
+                                              **{s: fmt_stat(r['field'], r[s]) for s in JOB_STATS})
+               for r in rows)
+    out.append(HTML_JOBS_TABLE_TAIL.substitute())
+    return ''.join(out)
+
+
+def render_text(statement):
+    """Return statement as plain text"""
+    def noesc(s):
+        return s
+
+    out = []
+
+    fields = header_fields(statement, noesc)
+    out.append(TEXT_HEADER.substitute(fields))
+    if statement.get('pi_lastname'):
+        out.append(TEXT_PI.substitute(fields))
+
+    charges = statement['charges']
+    if charges.get('disk_su') is None:
+        out.append(TEXT_COMPUTE.substitute(compute_su=f'{float(charges["compute_su"]):>8.6e}',
+                                           compute_charge=f'{Decimal(charges["compute_charge"]).quantize(penny):,}'))
+    else:
+        out.append(TEXT_CHARGES.substitute(charge_fields(charges)))
+
+    if statement.get('users') is not None:
+        out.append(TEXT_USERS_HEAD.substitute())
+        out.extend(TEXT_USERS_ROW.substitute(user_fields(u, noesc)) for u in statement['users'])
+
+    job_stats = statement.get('job_stats')
+    if job_stats is not None:
+        out.append(TEXT_JOBS_HEAD.substitute(n_jobs=f'{job_stats["n_jobs"]:,}'))
+        if job_stats['n_jobs'] > 0:
+            out.append(TEXT_JOBS_SUMMARY.substitute(pct_completed=f'{job_stats["pct_completed"]:.2f}'))
+            for title, group in (('Completed jobs', job_stats['completed']),
+                                 ('Incomplete jobs', job_stats['incomplete'])):
+                out.append(TEXT_JOBS_GROUP.substitute(title=title, n=f'{group["n"]:,}'))
+                if group['n'] > 0:
+                    out.append(TEXT_JOBS_ROW.substitute(field=f'{"":<22}',
+                                                        **{s: f'{title:>16}' for s, title in JOB_STATS.items()}))
+                    out.extend(TEXT_JOBS_ROW.substitute(field=f'{r["field"]:<22}',
+                                                        **{s: f'{fmt_stat(r["field"], r[s]):>16}' for s in JOB_STATS})
+                               for r in group['rows'])
+
+    if statement.get('efficiency') is not None:
+        out.append(TEXT_EFFICIENCY.substitute(efficiency_fields(statement['efficiency'])))
+
+    if statement.get('ytd') is not None:
+        out.append(TEXT_YTD.substitute(ytd_fields(statement['ytd'])))
+
+    if statement.get('members') is not None:
+        out.append(TEXT_MEMBERS_HEAD.substitute())
+        out.extend(TEXT_MEMBERS_ROW.substitute(counter=i, **m)
+                   for i, m in enumerate(statement['members'], start=1))
+
+    return ''.join(out)
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import os
 import sys
-import subprocess
 import datetime
 import delorean
 import calendar
@@ -9,14 +8,24 @@ import argparse
 from pathlib import Path
 import grp
 import csv
-import io
 import glob
 import xml.etree.ElementTree as ET
 import time
 import math
+import json
+import fcntl
+
+from . import slurm_cli
+from . import profiling
+from . import progress
+from . import metrics
 
 DOLLARS_TO_SU = 60./0.0123
 RCM_PREFIX = None
+# SU per day given back to each account debited, to avoid underflow
+UNDERFLOW_FIDDLE = 5
+# SLURM_BINDIR may point at another Slurm installation, e.g. slurm_emulator
+SACCTMGR = os.path.join(os.environ.get('SLURM_BINDIR', '/cm/shared/apps/slurm/current/bin'), 'sacctmgr')
 
 # Storage rate = 1081 SU per TiB-month; $0.0123 per SU
 
@@ -29,6 +38,18 @@ RCM_PREFIX = None
 # * read daily isilon quota report
 # * for each group which has no charge code - know if the GrpTRESMins field exists
 #   * reduce the GrpTRESMins by some amount
+# Nightly and hourly runs debit the same accounts: those with a positive
+# GrpTRESMins whose group (fooGrp for account fooprj) is in the report.
+#
+# With --hourly, run every hour from cron instead of nightly:
+#   5 * * * * root /ifs/sysadmin/bin/update_grptresmins.py --hourly
+# The prorated debit's fractional remainder is carried between runs in
+# RCM/grptresmins_hourly_state.json. Hourly runs give back UNDERFLOW_FIDDLE
+# SU per day, prorated, as the nightly run gives it back once a night.
+#
+# Every run holds an exclusive lock on RCM/grptresmins.lock from reading
+# GrpTRESMins until it has written them back, so that overlapping runs,
+# hourly or nightly, cannot debit the same usage twice.
 
 def get_list_of_reports(reports_dir: Path, debug_p=False):
     reports = glob.glob(str(reports_dir / 'scheduled_quota_report_*.xml'))
@@ -40,6 +61,31 @@ def get_list_of_reports(reports_dir: Path, debug_p=False):
     return retval
 
 
+def read_quota_report(report, debug_p=False):
+    """Return dict account: physical usage in bytes from one Isilon quota report"""
+    MINGID = 10000
+
+    acct_bytes = {}
+    tree = ET.parse(report)
+    root = tree.getroot()
+    for domain in root.iter('domain'):
+        if domain.attrib['type'] == 'group':
+            gid = int(domain.attrib['id'])
+            if gid > MINGID:
+                gr_name = grp.getgrgid(gid).gr_name
+
+                # translate group name to account name
+                acct = gr_name.lower().replace('grp', 'prj')
+                if debug_p:
+                    print(f'DEBUG: gr_name = {gr_name}; acct = {acct}')
+
+                for usage in domain.findall('usage'):
+                    if usage.attrib['resource'] == 'physical':
+                        acct_bytes[acct] = float(usage.text)
+
+    return acct_bytes
+
+
 def get_disk_usage(when: datetime.date, debug_p=False):
     global RCM_PREFIX
 
@@ -53,7 +99,6 @@ def get_disk_usage(when: datetime.date, debug_p=False):
         print(f'DEBUG: base_rate = {base_rate}')
         print(f'DEBUG: ndays for {when} = {ndays}')
 
-    MINGID = 10000
     reports_dir = RCM_PREFIX / 'isilon' / 'reports'
     reports = get_list_of_reports(reports_dir)
     acct_usage = {}
@@ -62,23 +107,9 @@ def get_disk_usage(when: datetime.date, debug_p=False):
             if debug_p:
                 print(f'FOUND DATE MATCH: {r[0].date}, {r[1]}')
 
-            tree = ET.parse(r[1])
-            root = tree.getroot()
-            for domain in root.iter('domain'):
-                if domain.attrib['type'] == 'group':
-                    gid = int(domain.attrib['id'])
-                    if gid > MINGID:
-                        gr_name = grp.getgrgid(gid).gr_name
-
-                        # translate group name to account name
-                        acct = gr_name.lower().replace('grp', 'prj')
-                        if debug_p:
-                            print(f'DEBUG: gr_name = {gr_name}; acct = {acct}')
-
-                        for usage in domain.findall('usage'):
-                            if usage.attrib['resource'] == 'physical':
-                                # amount of SU consumed for one day = usage * base_rate / ndays
-                                acct_usage[acct] = round(float(usage.text) * base_rate / ndays)
+            for acct, usage_bytes in read_quota_report(r[1], debug_p).items():
+                # amount of SU consumed for one day = usage * base_rate / ndays
+                acct_usage[acct] = round(usage_bytes * base_rate / ndays)
         else:
             if debug_p:
                 print(f'NO DATE MATCH: {r[0].date}, {r[1]}')
@@ -91,6 +122,121 @@ def get_disk_usage(when: datetime.date, debug_p=False):
     return acct_usage
 
 
+def lock_grptresmins():
+    """Wait for, and take, the exclusive lock on GrpTRESMins updates
+
+    Returns the open lock file; the lock is held until it is closed, or
+    the process exits.
+    """
+    lock_file = open(RCM_PREFIX / 'grptresmins.lock', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f'update_grptresmins: waiting for another run to release {lock_file.name}', flush=True)
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    return lock_file
+
+
+def load_hourly_state(state_file: Path):
+    if state_file.exists():
+        with open(state_file) as f:
+            return json.load(f)
+
+    return {'report': None, 'report_mtime': None, 'usage_bytes': {},
+            'last_run': None, 'remainder': {}}
+
+
+def save_hourly_state(state_file: Path, state):
+    # write-then-rename so an interrupted run cannot leave a truncated state
+    tmp_file = state_file.with_suffix('.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def hourly_storage_debits(associations, now: float, debug_p=False):
+    """Debit storage usage accrued since the last run against GrpTRESMins
+
+    Usage comes from the latest Isilon quota report; it is reparsed only
+    when a newer report appears. Each account accrues
+        (usage * base_rate / ndays - UNDERFLOW_FIDDLE) * (hours since last run) / 24
+    plus the fractional remainder carried over from earlier runs. Only the
+    whole part is debited (or, for accounts using less storage than the
+    fiddle, credited), so sacctmgr is only called for accounts whose accrued
+    debit reached a whole SU, and nothing is lost to rounding.
+
+    The caller holds lock_grptresmins(), and read associations under it.
+    Return (updates, number of sacctmgr updates which failed).
+    """
+    global RCM_PREFIX
+
+    TIBI = 1024. * 1024. * 1024. * 1024.
+    base_rate = 1081. / TIBI
+    today = datetime.date.fromtimestamp(now)
+    ndays = float(calendar.monthrange(today.year, today.month)[1])
+
+    state_file = RCM_PREFIX / 'grptresmins_hourly_state.json'
+    state = load_hourly_state(state_file)
+
+    reports = get_list_of_reports(RCM_PREFIX / 'isilon' / 'reports')
+    if reports:
+        latest = reports[-1][1]
+        latest_mtime = os.stat(latest).st_mtime
+        if latest != state['report'] or latest_mtime != state['report_mtime']:
+            if debug_p:
+                print(f'DEBUG: hourly_storage_debits(): reading new quota report {latest}')
+            state['usage_bytes'] = read_quota_report(latest, debug_p)
+            state['report'] = latest
+            state['report_mtime'] = latest_mtime
+        elif debug_p:
+            print(f'DEBUG: hourly_storage_debits(): quota report unchanged, {latest}')
+
+    # first run accrues one hour
+    if state['last_run'] is None:
+        elapsed_hours = 1.
+    else:
+        elapsed_hours = max(0., (now - state['last_run']) / 3600.)
+
+    if elapsed_hours > 24.:
+        print(f'WARNING: update_grptresmins: {elapsed_hours:.1f} hours since last hourly run; debiting all of it')
+
+    updates = {}
+    remainder = state['remainder']
+    for acct, usage_bytes in state['usage_bytes'].items():
+        grptresmins = associations.get(acct)
+        if grptresmins is None or grptresmins <= 0:
+            continue
+
+        accrued = (usage_bytes * base_rate / ndays - UNDERFLOW_FIDDLE) * elapsed_hours / 24. + remainder.get(acct, 0.)
+        debit = math.floor(accrued)
+        remainder[acct] = accrued - debit
+
+        if debit != 0:
+            updates[acct] = (grptresmins - debit, debit)
+
+        if debug_p:
+            print(f'DEBUG: {acct} - GrpTRESMins = {grptresmins}, accrued = {accrued:.4f}, debit = {debit}')
+
+    cmdlines = [f'{SACCTMGR} -Q -i modify account {acct} set grptresmins=billing={new_grptresmins}'.split()
+                for acct, (new_grptresmins, _) in updates.items()]
+    results = slurm_cli.runner.run_many_sync(cmdlines)
+
+    n_failed = 0
+    for (acct, (_, debit)), result in zip(updates.items(), results):
+        if isinstance(result, Exception):
+            # not debited; carry it to the next run
+            print(f'ERROR: {acct} - {result}')
+            remainder[acct] += debit
+            n_failed += 1
+
+    state['remainder'] = remainder
+    state['last_run'] = now
+    save_hourly_state(state_file, state)
+
+    return updates, n_failed
+
+
 def get_myorg_grants(debug_p=False):
     global RCM_PREFIX
     global DOLLARS_TO_SU
@@ -108,19 +254,18 @@ def get_myorg_grants(debug_p=False):
 
 
 def get_associations(grantees):
-    associations = subprocess.run(
-        ['/cm/shared/apps/slurm/current/bin/sacctmgr', '--quiet', '--parsable2', 'show',
-         'assoc', 'format=cluster,account,grptresmins'],
-        stdout=subprocess.PIPE, check=False).stdout.decode('utf-8')
-
     grantee_prjs = []
     for g in grantees:
         grantee_prjs.append(g[0])
 
-    reader = csv.DictReader(io.StringIO(associations), delimiter='|')
-
-    return dict([(row['Account'], int(row['GrpTRESMins'].split('=')[1])) for row in reader if (row['GrpTRESMins'] != '' and row['Account'] not in grantee_prjs)])
+    # parse straight from the sacctmgr pipe
+    with slurm_cli.runner.stream(
+            [SACCTMGR, '--quiet', '--parsable2', 'show',
+             'assoc', 'format=cluster,account,grptresmins'],
+            check=False) as associations:
+        reader = csv.DictReader(associations.stdout, delimiter='|')
 
+        return dict([(row['Account'], int(row['GrpTRESMins'].split('=')[1])) for row in reader if (row['GrpTRESMins'] != '' and row['Account'] not in grantee_prjs)])
 
 def main():
     global RCM_PREFIX
@@ -131,10 +276,24 @@ def main():
     # today's date in local timezone
     today = datetime.date.today()
     parser.add_argument('-w', '--when', default=f'{today}', help='Date (local timezone) in format YYYY-MM-DD (default today)')
+    parser.add_argument('-j', '--max-concurrency', type=int, default=4,
+                        help='Maximum number of concurrent sacctmgr updates (default 4)')
+    parser.add_argument('--hourly', action='store_true',
+                        help='Debit the storage usage accrued since the previous --hourly run, from the latest quota report; replaces the nightly run')
+    parser.add_argument('--trace', action='store_true', help='Print latency and output size of each sacctmgr call')
+    profiling.add_arguments(parser)
+    progress.add_arguments(parser)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
 
     debug_p = args.debug
+    slurm_cli.debug_p = debug_p
+    slurm_cli.runner.max_concurrency = args.max_concurrency
+    profiling.start('update_grptresmins', args)
+    progress.start(args)
+    # hourly and nightly runs are scheduled, and alerted on, separately
+    metrics.start('update_grptresmins_hourly' if args.hourly else 'update_grptresmins', args)
 
     if debug_p:
         RCM_PREFIX = Path('/ifs/sysadmin/RCM/DEBUG')
@@ -157,45 +316,66 @@ def main():
     if debug_p:
         print(f'DEBUG: date_of_interest = {date_of_interest}')
 
-    grantees = get_myorg_grants(debug_p=debug_p)
+    # profile goes next to the month's du files
+    profile_dir = RCM_PREFIX / f'{date_of_interest.year}-{date_of_interest.month:02d}'
+
+    with profiling.stage('grants'):
+        grantees = get_myorg_grants(debug_p=debug_p)
 
     if debug_p:
         for g in grantees:
             print(f'DEBUG: grantee - {g}')
 
-    associations = get_associations(grantees)
+    # held until the updates are done
+    lock_file = lock_grptresmins()
+
+    with profiling.stage('associations'):
+        associations = get_associations(grantees)
 
     if debug_p:
         for a in associations.items():
             print(f'DEBUG: association - {a}')
 
-    du = get_disk_usage(date_of_interest, debug_p)
+    if args.hourly:
+        tic = time.time()
+        with profiling.stage('hourly'):
+            updates, n_failed = hourly_storage_debits(associations, tic, debug_p)
+        lock_file.close()
+        toc = time.time()
+        now = delorean.Delorean(timezone='US/Eastern')
+        print(f'{now.datetime.strftime("%Y-%m-%d %H:%M:%S %Z")} - update_grptresmins.py - hourly: {len(updates) - n_failed} accounts debited, {n_failed} failed in {toc - tic} sec.')
 
-    if debug_p:
-        for k, v in du.items():
-            print(f'DEBUG: du - du[{k}] = {v}')
+        if args.trace:
+            slurm_cli.runner.print_trace_summary()
 
-    # find matching group
-    du_keyset = set(k.lower() for k in du.keys())
+        profiling.finish(profile_dir)
+        metrics.finish(success=not n_failed)
 
-    if debug_p:
-        print(f'DEBUG: du_keyset = {du_keyset}')
+        return
+
+    with profiling.stage('disk_usage'):
+        du = get_disk_usage(date_of_interest, debug_p)
 
+    if debug_p:
+        for k, v in du.items():
+            print(f'DEBUG: du - du[{k}] = {v}')
 
     tic = time.time()
     # sacctmgr cmdline:
     #    sacctmgr modify account math540prj set grptresmins=billing=2880000
 
+    updates = []
     for acct, grptresmins in associations.items():
         if debug_p:
             print(f'DEBUG: acct = {acct}; acct in du = {acct in du}; grptresmins = {grptresmins}')
 
-        if (acct.replace('prj', 'grp') in du_keyset) and (grptresmins > 0):
+        # du is keyed by account, as the hourly debits are (see read_quota_report())
+        if (acct in du) and (grptresmins > 0):
             if debug_p:
                 print(f'DEBUG: found {acct} in du - {du[acct]}')
 
             # fiddle factor of +5 to avoid underflow
-            new_grptresmins = grptresmins - du[acct] + 5
+            new_grptresmins = grptresmins - du[acct] + UNDERFLOW_FIDDLE
 
             # FYI
             # $100 per month credit = 100/0.0123 hrs = 100/0.0123*60 mins
@@ -203,29 +383,44 @@ def main():
 
             # to perform sacctmgr operation without prompting, use "-i";
             # "-Q" for quiet operation
-            cmdline = f'/cm/shared/apps/slurm/current/bin/sacctmgr -Q -i modify account {acct} set grptresmins=billing={new_grptresmins}'
+            cmdline = f'{SACCTMGR} -Q -i modify account {acct} set grptresmins=billing={new_grptresmins}'
 
             if debug_p:
                 print(f'DEBUG: {acct} - GrpTRESMins = {grptresmins}, du = {du[acct]}')
                 print(f'DEBUG: cmdline = {cmdline}')
                 print()
 
-            try:
-                sacctmgr_output = subprocess.run(
-                    cmdline.split(),
-                    stdout=subprocess.PIPE,
-                    check=False).stdout.decode('utf-8')
+            updates.append(cmdline.split())
 
-                if debug_p:
-                    print(f'DEBUG: sacctmgr_output = {sacctmgr_output}')
-            except subprocess.CalledProcessError as e:
-                print(f'ERROR: {e.cmd} - {e.returncode} - {e.stderr}')
-                continue
+    # sacctmgr updates run concurrently, up to --max-concurrency at a time
+    tracker = progress.Progress('sacctmgr', total=len(updates), unit='accounts')
+    with profiling.stage('sacctmgr'):
+        results = slurm_cli.runner.run_many_sync(updates, on_done=lambda cmdline: tracker.update())
+    tracker.done()
+
+    n_failed = 0
+    for result in results:
+        if isinstance(result, slurm_cli.SlurmCommandError):
+            print(f'ERROR: {result.cmdline} - {result.returncode} - {result.stderr}')
+            n_failed += 1
+        elif isinstance(result, Exception):
+            print(f'ERROR: {result}')
+            n_failed += 1
+        elif debug_p:
+            print(f'DEBUG: sacctmgr_output = {result.stdout}')
+
+    lock_file.close()
 
     toc = time.time()
     now = delorean.Delorean(timezone='US/Eastern')
     print(f'{now.datetime.strftime("%Y-%m-%d %H:%M:%S %Z")} - update_grptresmins.py - completed in {toc - tic} sec.')
 
+    if args.trace:
+        slurm_cli.runner.print_trace_summary()
+
+    profiling.finish(profile_dir)
+    metrics.finish(success=not n_failed)
+
 
 if __name__ == '__main__':
     main()